@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Length bucketed batching of aligned neg/pos sequence pairs.
+
+Each codeflaws line is a whole program, so line lengths span orders of
+magnitude, and random batches are mostly padding. Here pairs are grouped
+into buckets of similar length first, and batches are drawn from inside a
+bucket, either with a fixed number of pairs or with a budget on the number
+of (padded) tokens per batch, so that short programs come in large batches
+and long ones in small batches.
+
+In the pipeline, the seq2seq configs with 'buckets': 'auto' take their
+bucket boundaries from auto_buckets over the training pair lengths, and
+BucketBatcher is there for training loops run in python. SeqGAN pads every
+sequence to its fixed length and the markov chain does not pad at all, so
+neither gains from length bucketing.
+
+Sequences can be read from
+    - a binary corpus (<path>.tok / <path>.off, see ganapg_corpus), unless
+      it is older than the text file at path,
+    - a text file of hashed ids (e.g. pos.hash),
+    - a text file of tokens, hashed with a vocabulary file on the fly.
+
+@author: bbradt
+"""
+
+import random
+import numpy as np
+from ganapg_corpus import corpus_is_current, CorpusReader
+from ganapg_vocabulary import vocabfile_to_hashdict, vocab_index, hash_line
+from ganapg_vocabulary import UNK_TOKEN
+
+# not a vocabulary id (0 may be UNK), so batch != PAD_ID masks the padding
+PAD_ID = -1
+
+
+def read_sequences(path, vocabfile=None, unk_token=UNK_TOKEN):
+    """
+        Load every line of path as an int array. With a vocabfile the lines
+        are tokens which are hashed on the fly (unknown tokens map to
+        unk_token if it is in the vocabulary, and are dropped otherwise);
+        without one they are hashed ids, read from the binary corpus at
+        path if there is one which is not older than the text file.
+    """
+    if vocabfile is None and corpus_is_current(path):
+        return CorpusReader(path)
+    index = None
+    unk_hash = None
+    if vocabfile is not None:
+        index = vocab_index(vocabfile_to_hashdict(vocabfile))
+        unk_hash = index.get(unk_token)
+    sequences = []
+    with open(path, 'r') as file:
+        for line in file:
+            if index is None:
+                ids = line.split()
+            else:
+                ids = hash_line(line, index, unk_hash=unk_hash)
+            sequences.append(np.array(ids, dtype=np.int32))
+    return sequences
+
+
+def sequence_lengths(sequences):
+    if isinstance(sequences, CorpusReader):
+        return sequences.lengths()
+    return np.array([len(seq) for seq in sequences], dtype=np.int64)
+
+
+def file_lengths(path):
+    """ Number of tokens of every line of a text file or binary corpus """
+    if corpus_is_current(path):
+        return CorpusReader(path).lengths()
+    with open(path, 'r') as file:
+        return np.array([len(line.split()) for line in file], dtype=np.int64)
+
+
+def auto_buckets(lengths, n_buckets=8):
+    """
+        Bucket boundaries which split lengths into n_buckets groups of
+        about the same number of sequences (length quantiles), usable as
+        the seq2seq buckets.
+    """
+    lengths = np.asarray(lengths)
+    if not len(lengths) or n_buckets < 2:
+        return []
+    quantiles = np.linspace(0, 100, n_buckets + 1)[1:-1]
+    boundaries = np.unique(np.ceil(np.percentile(lengths, quantiles)))
+    return [int(b) for b in boundaries if b > 0]
+
+
+def pad_batch(sequences, pad_id=PAD_ID, length=None):
+    """
+        Stack sequences into a (batch, length) int32 array padded with
+        pad_id. Returns the array and the length of each sequence. The
+        default pad_id is no token id, so batch != PAD_ID is the mask of
+        the real tokens.
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    if length is None:
+        length = int(lengths.max()) if len(lengths) else 0
+    batch = np.full((len(sequences), length), pad_id, dtype=np.int32)
+    for i, seq in enumerate(sequences):
+        batch[i, :len(seq)] = seq[:length]
+    return batch, lengths
+
+
+class BucketBatcher():
+    """
+        Batches of aligned (source, target) pairs, e.g. (neg, pos), drawn
+        from length buckets. The length of a pair is the longer of its two
+        sequences, and pair i falls in bucket j if
+            boundaries[j - 1] <= length < boundaries[j]
+        as with the seq2seq buckets (so n boundaries make n + 1 buckets).
+        boundaries default to auto_buckets(lengths, n_buckets).
+
+        A batch holds batch_size pairs, or, with max_tokens, as many pairs
+        as fit in max_tokens tokens once padded (but at least one). With
+        shuffle, pairs are shuffled within their bucket and the batches are
+        shuffled across buckets on every pass.
+
+            batcher = BucketBatcher(read_sequences('neg.hash'),
+                                    read_sequences('pos.hash'),
+                                    max_tokens=20000)
+            for src, src_len, tgt, tgt_len, index in batcher:
+                ...
+    """
+    def __init__(self, sources, targets=None, boundaries=None, n_buckets=8,
+                 batch_size=32, max_tokens=None, shuffle=True, seed=None,
+                 pad_id=PAD_ID):
+        if targets is not None and len(targets) != len(sources):
+            raise ValueError('%d sources but %d targets' % (len(sources),
+                                                          len(targets)))
+        self.sources = sources
+        self.targets = targets
+        self.lengths = sequence_lengths(sources)
+        if targets is not None:
+            self.lengths = np.maximum(self.lengths, sequence_lengths(targets))
+        if boundaries is None:
+            boundaries = auto_buckets(self.lengths, n_buckets)
+        self.boundaries = list(boundaries)
+        self.buckets = np.searchsorted(self.boundaries, self.lengths,
+                                       side='right')
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.random = random.Random(seed)
+        self.pad_id = pad_id
+
+    def _split(self, indices):
+        """ Cut the indices of one bucket into batches """
+        batches = []
+        batch = []
+        longest = 0
+        for i in indices:
+            length = max(int(self.lengths[i]), 1)
+            if batch:
+                if self.max_tokens is not None:
+                    full = (max(longest, length) * (len(batch) + 1) >
+                            self.max_tokens)
+                else:
+                    full = len(batch) >= self.batch_size
+                if full:
+                    batches.append(batch)
+                    batch = []
+                    longest = 0
+            batch.append(i)
+            longest = max(longest, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def index_batches(self):
+        """ The pair indices of every batch of one pass """
+        batches = []
+        for bucket in range(len(self.boundaries) + 1):
+            indices = [int(i) for i in np.flatnonzero(self.buckets == bucket)]
+            if self.shuffle:
+                self.random.shuffle(indices)
+            else:
+                # sorted by length, for the least padding
+                indices.sort(key=lambda i: self.lengths[i])
+            batches.extend(self._split(indices))
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for index in self.index_batches():
+            source, source_lengths = pad_batch(
+                [self.sources[i] for i in index], pad_id=self.pad_id)
+            if self.targets is None:
+                yield source, source_lengths, None, None, index
+                continue
+            target, target_lengths = pad_batch(
+                [self.targets[i] for i in index], pad_id=self.pad_id)
+            yield source, source_lengths, target, target_lengths, index
+
+    def padding_ratio(self, batches=None):
+        """
+            Fraction of the tokens of the padded batches which are padding
+            (counting sources only).
+        """
+        if batches is None:
+            batches = self.index_batches()
+        lengths = sequence_lengths(self.sources)
+        real = padded = 0
+        for index in batches:
+            real += int(lengths[index].sum())
+            padded += int(lengths[index].max()) * len(index)
+        return 1.0 - float(real) / padded if padded else 0.0
+
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fingerprint based caching of pipeline steps.
+
+Each step is described by a fingerprint of
+    - its input files (paths, sizes and modification times),
+    - its parameters,
+    - the source code of the module implementing it, and of every ganapg
+      module it imports, directly or not.
+After a step runs, the fingerprint is recorded along with a fingerprint of
+the step's outputs. When the pipeline is rerun, a step whose fingerprint
+matches the record, and whose outputs are still unchanged on disk, can be
+skipped and its previous outputs reused.
+
+FileManifest does the same at the level of single files, so that the
+directory walkers can reprocess only the files which were added or changed.
+
+@author: bbradt
+"""
+
+import os
+import sys
+import json
+import hashlib
+import types
+import inspect
+from ganapg_util import BufferedWriter
+from ganapg_walk import scan_files
+
+# Modules whose source is part of the fingerprint of a step
+CODE_PREFIX = 'ganapg'
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def tree_fingerprint(path, extensions=None):
+    """
+        Fingerprint a file, or all files below a directory, from their
+        relative paths, sizes and modification times. Only files whose
+        extension is in extensions are considered (all files if None), and
+        hidden files (such as manifests) are ignored.
+        A missing path has its own fingerprint, so that creating it later
+        counts as a change.
+    """
+    if not os.path.exists(path):
+        return _sha1('missing:%s' % path)
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return _sha1('%s:%d:%r' % (path, stat.st_size, stat.st_mtime))
+    entries = []
+    for file_path in scan_files(path, extensions):
+        stat = os.stat(file_path)
+        entries.append('%s:%d:%r' % (os.path.relpath(file_path, path),
+                                     stat.st_size, stat.st_mtime))
+    return _sha1('\n'.join(entries))
+
+
+def paths_fingerprint(paths):
+    """
+        Fingerprint a list of paths, where each entry is either a path or a
+        (path, extensions) tuple as accepted by tree_fingerprint. None
+        entries (e.g. an unset save_dir) are ignored.
+    """
+    prints = []
+    for entry in paths:
+        if isinstance(entry, tuple):
+            path, extensions = entry
+        else:
+            path, extensions = entry, None
+        if path is None:
+            continue
+        prints.append(tree_fingerprint(path, extensions=extensions))
+    return _sha1('\n'.join(prints))
+
+
+def _project_modules(module, prefix=CODE_PREFIX):
+    """
+        module and every module named prefix* it refers to, directly or
+        through other such modules (by import, or through functions and
+        classes imported from them), sorted by name.
+    """
+    found = {module.__name__: module}
+    stack = [module]
+    while stack:
+        for value in list(vars(stack.pop()).values()):
+            if isinstance(value, types.ModuleType):
+                name = value.__name__
+            else:
+                name = getattr(value, '__module__', None)
+            if (not isinstance(name, str) or not name.startswith(prefix) or
+                    name in found or name not in sys.modules):
+                continue
+            found[name] = sys.modules[name]
+            stack.append(found[name])
+    return [found[name] for name in sorted(found)]
+
+
+def code_fingerprint(fn):
+    """
+        Fingerprint the source of the module which defines fn, and of the
+        ganapg modules it uses, so that editing a helper module (e.g.
+        ganapg_walk) also counts as a change of the step.
+    """
+    module = sys.modules.get(fn.__module__)
+    if module is None:
+        return _sha1('%s.%s' % (fn.__module__, fn.__name__))
+    prints = []
+    for dep in _project_modules(module):
+        try:
+            source_file = inspect.getsourcefile(dep)
+            with open(source_file, 'rb') as file:
+                digest = hashlib.sha1(file.read()).hexdigest()
+        except (TypeError, IOError, OSError):
+            digest = _sha1(dep.__name__)
+        prints.append('%s:%s' % (dep.__name__, digest))
+    return _sha1('\n'.join(prints))
+
+
+def params_fingerprint(params):
+    """ Fingerprint a dictionary of (json-able) parameters """
+    return _sha1(json.dumps(params, sort_keys=True, default=str))
+
+
+def step_fingerprint(fn, **params):
+    """
+        Fingerprint of the code of fn and of the parameters which decide
+        what it writes for each file, for a FileManifest
+    """
+    return _sha1('%s:%s' % (code_fingerprint(fn), params_fingerprint(params)))
+
+
+class StepCache():
+    """
+        Store of step fingerprints, kept as one small json record per step
+        in cache_dir.
+    """
+    def __init__(self, cache_dir='.ganapg_cache'):
+        self.cache_dir = cache_dir
+
+    def _record_path(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % key)
+
+    def fingerprint(self, fn, inputs, params):
+        """ Fingerprint of a step about to call fn(**params) """
+        return {'inputs': paths_fingerprint(inputs),
+                'params': params_fingerprint(params),
+                'code': code_fingerprint(fn)}
+
+    def is_fresh(self, key, fingerprint, outputs):
+        """
+            True if the step was last run with the same fingerprint and its
+            outputs have not changed since.
+        """
+        record_path = self._record_path(key)
+        if not os.path.exists(record_path):
+            return False
+        with open(record_path, 'r') as file:
+            try:
+                record = json.load(file)
+            except ValueError:
+                return False
+        return (record.get('fingerprint') == fingerprint and
+                record.get('outputs') == paths_fingerprint(outputs))
+
+    def store(self, key, fingerprint, outputs):
+        """ Record a completed step """
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            # already there, possibly made by a step running alongside
+            if not os.path.isdir(self.cache_dir):
+                raise
+        record = {'fingerprint': fingerprint,
+                  'outputs': paths_fingerprint(outputs)}
+        with open(self._record_path(key), 'w') as file:
+            json.dump(record, file, sort_keys=True)
+
+    def invalidate(self, key):
+        record_path = self._record_path(key)
+        if os.path.exists(record_path):
+            os.remove(record_path)
+
+    def call(self, key, fn, inputs, outputs, **params):
+        """
+            Call fn(**params) unless the step recorded under key is fresh.
+            Returns (ran, result), where result is None for skipped steps.
+        """
+        fingerprint = self.fingerprint(fn, inputs, params)
+        if self.is_fresh(key, fingerprint, outputs):
+            return False, None
+        self.invalidate(key)
+        result = fn(**params)
+        self.store(key, fingerprint, outputs)
+        return True, result
+
+
+def file_hash(path):
+    """ sha1 of a file's contents """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FileManifest():
+    """
+        Per-file record of the source files processed by a directory walker,
+        used to preprocess incrementally. For every source path the manifest
+        keeps its mtime, size and content hash, the outputs written for it,
+        and the shared outputs (e.g. one corpus of all sources) it was
+        written into. Only its own outputs are deleted with the source, see
+        remove_missing. A source counts as changed if it is new, or if its mtime or size
+        differ and its content hash does too (so touching a file does not
+        trigger reprocessing).
+
+        fingerprint (see step_fingerprint) describes how the outputs are
+        made. If it differs from the one the manifest was saved with,
+        every source counts as changed.
+    """
+    def __init__(self, path, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.seen = set()
+        self.stale = False
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                try:
+                    record = json.load(file)
+                except ValueError:
+                    record = {}
+            # manifests saved without a fingerprint are stale too
+            self.entries = record.get('entries', {})
+            self.stale = record.get('fingerprint') != fingerprint
+
+    def is_changed(self, src):
+        """
+            True if src must be reprocessed. Missing outputs also count as
+            a change.
+        """
+        self.seen.add(src)
+        entry = self.entries.get(src)
+        if entry is None or self.stale:
+            return True
+        outputs = entry['outputs'] + entry.get('shared', [])
+        if any([not os.path.exists(out) for out in outputs]):
+            return True
+        stat = os.stat(src)
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return False
+        if entry['hash'] != file_hash(src):
+            return True
+        entry['mtime'] = stat.st_mtime
+        entry['size'] = stat.st_size
+        return False
+
+    def outputs(self, src):
+        """ The outputs recorded for src """
+        return self.entries[src]['outputs']
+
+    def shared(self, src):
+        """ The shared outputs recorded for src """
+        return self.entries[src].get('shared', [])
+
+    def update(self, src, outputs=(), shared=()):
+        """
+            Record that src was processed into outputs, which belong to src
+            alone, and into the shared outputs
+        """
+        self.seen.add(src)
+        stat = os.stat(src)
+        self.entries[src] = {'mtime': stat.st_mtime,
+                             'size': stat.st_size,
+                             'hash': file_hash(src),
+                             'outputs': list(outputs),
+                             'shared': list(shared)}
+
+    def remove_missing(self):
+        """
+            Forget every source which was not seen since the manifest was
+            loaded (i.e. removed from the corpus) and delete its outputs.
+            Shared outputs are kept, the caller rewrites them. Returns the
+            list of removed sources.
+        """
+        removed = [src for src in self.entries if src not in self.seen]
+        for src in removed:
+            for out in self.entries[src].get('outputs', []):
+                if os.path.exists(out):
+                    os.remove(out)
+            del self.entries[src]
+        return removed
+
+    def save(self):
+        out_dir = os.path.dirname(self.path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with BufferedWriter(self.path) as file:
+            json.dump({'fingerprint': self.fingerprint,
+                       'entries': self.entries}, file, sort_keys=True)
@@ -14,6 +14,15 @@ SEQ2SEQ_DIR = '../seq2seq'
 MARKOV_DIR = ''
 DEEPFIX_DIR = ''
 BASE_VOCAB = './vocab/c_base_vocab.txt'
+SYMBOL_MAP = 'C_SYMBOL_MAP.json'  # C operators and their symbol tokens
+WORKERS = 1  # Default size of the process pool for parallel steps
+STRIP_METHOD = 'gcc'  # How obfuscate strips comments: 'gcc' or 'python'
+CACHE_DIR = './.ganapg_cache/'  # Fingerprints of completed pipeline steps
+INCREMENTAL = True  # Only reprocess new or changed files in the file walkers
+BINARY_CORPUS = True  # Also write hashed corpora in the binary .tok/.off format
+MARKOV_ORDER = 2  # Number of context tokens of the markov chain
+POSNEG_SHARD_SIZE = None  # Split pos/neg into aligned shards of this size
+STEP_WORKERS = 2  # Number of independent pipeline steps run at the same time
 ALL_STEPS = ['astseq',
              'obfuscate',
              'symbols',
@@ -29,8 +38,7 @@ ALL_STEPS = ['astseq',
 
 name = 'cgc_tokens'
 cgc_tokens = {'name': name,
-              'steps': ['obfuscate',
-                        'cgc-posneg',
+              'steps': ['cgc-posneg',
                         'symbols',
                         'vocabgen',
                         'vocabhash'],
@@ -48,8 +56,7 @@ cgc_tokens = {'name': name,
 
 name = 'cgc_ast'
 cgc_ast = {'name': name,
-           'steps': ['obfuscate',
-                     'cgc-posneg',
+           'steps': ['cgc-posneg',
                      'symbols',
                      'vocabgen',
                      'vocabhash'],
@@ -96,10 +103,10 @@ cf_tokens_seq2seq = {'name': name,
                      'save_dir':
                          {k: './%s_%s/' % (name, k) for k in ALL_STEPS},
                      'iters': 2000,
+                     'batch_size': 32,
+                     'buckets': 'auto',
+                     'model_config': 'nmt_small.yml',
                      'vocab': './%s_vocabgen/vocab.txt' % name,
-                     'config': 'ganapg_export_seq2seq.sh',
-                     'run': 'ganapg_run_seq2seq.sh',
-                     'eval': 'ganapg_predict_seq2seq.sh',
                      'pos': 'pos.nosym',
                      'neg': 'neg.nosym'
                      }
@@ -165,9 +172,10 @@ cf_ast_seq2seq = {'name': name,
                   'save': True,
                   'save_dir': {k: './%s_%s/' % (name, k) for k in ALL_STEPS},
                   'iters': 2000,
+                  'batch_size': 32,
+                  'buckets': 'auto',
+                  'model_config': 'nmt_small.yml',
                   'vocab': './%s_vocabgen/vocab.txt' % name,
-                  'run': 'ganapg_run_seq2seq.sh',
-                  'eval': 'ganapg_predict_seq2seq.sh',
                   'pos': 'pos',
                   'neg': 'neg'
                   }
@@ -197,3 +205,10 @@ cf_ast_deepfix = {'name': name,
                   }
 
 name = 'ganapg_config'
+
+# Every config, for running them all in one step graph
+CONFIGS = ['cgc_tokens', 'cgc_ast',
+           'cf_tokens_seqgan', 'cf_tokens_seq2seq', 'cf_tokens_markov',
+           'cf_tokens_deepfix',
+           'cf_ast_seqgan', 'cf_ast_seq2seq', 'cf_ast_markov',
+           'cf_ast_deepfix']
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary on-disk format for hashed corpora (e.g. pos.hash / neg.hash).
+
+A corpus at path is stored in two raw little-endian files:
+    <path>.tok - every token id of every line, as one flat int32 buffer
+    <path>.off - int64 offsets into the token buffer; line i is
+                 tokens[offsets[i]:offsets[i + 1]], so there are
+                 (number of lines + 1) offsets, starting with 0
+
+Both files can be memory mapped with numpy, so reading a line is a
+zero-copy slice and nothing has to be re-parsed from decimal text.
+
+@author: bbradt
+"""
+
+import os
+import numpy as np
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+
+TOKENS_EXT = '.tok'
+OFFSETS_EXT = '.off'
+TOKEN_DTYPE = np.dtype('<i4')
+OFFSET_DTYPE = np.dtype('<i8')
+
+
+def corpus_exists(path):
+    return (os.path.exists(path + TOKENS_EXT) and
+            os.path.exists(path + OFFSETS_EXT))
+
+
+def corpus_is_current(path):
+    """
+        True if there is a corpus at path which is not older than the text
+        file at path (if there is one), i.e. was written with that text
+        and not left over from an earlier run.
+    """
+    if not corpus_exists(path):
+        return False
+    if not os.path.exists(path):
+        return True
+    return (min(os.path.getmtime(path + TOKENS_EXT),
+                os.path.getmtime(path + OFFSETS_EXT)) >=
+            os.path.getmtime(path))
+
+
+def remove_corpus(path):
+    """ Delete the corpus at path, if there is one """
+    for ext in (TOKENS_EXT, OFFSETS_EXT):
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+
+
+class CorpusWriter():
+    """
+        Stream lines of token ids into a binary corpus. The token buffer is
+        written as lines are appended; the offsets are written on close.
+        Both files appear atomically when the writer is closed.
+
+            with CorpusWriter('pos.hash') as corpus:
+                for ids in lines:
+                    corpus.append(ids)
+    """
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.tokens = BufferedWriter(path + TOKENS_EXT,
+                                     buffer_size=buffer_size, mode='wb')
+        self.offsets = [0]
+
+    def append(self, ids):
+        ids = np.asarray(ids, dtype=TOKEN_DTYPE)
+        self.tokens.write(ids.tobytes())
+        self.offsets.append(self.offsets[-1] + len(ids))
+
+    def close(self):
+        self.tokens.close()
+        with BufferedWriter(self.path + OFFSETS_EXT, mode='wb') as file:
+            file.write(np.asarray(self.offsets, dtype=OFFSET_DTYPE).tobytes())
+
+    def discard(self):
+        self.tokens.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+
+def _map(filename, dtype):
+    if os.path.getsize(filename) == 0:
+        # numpy can not memory map empty files
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+
+class CorpusReader():
+    """
+        Memory mapped view of a binary corpus. corpus[i] is a zero-copy
+        int32 view of the token ids of line i.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tokens = _map(path + TOKENS_EXT, TOKEN_DTYPE)
+        self.offsets = _map(path + OFFSETS_EXT, OFFSET_DTYPE)
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('corpus line %d out of range' % i)
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """ Number of tokens of every line """
+        return np.diff(self.offsets)
+
+
+def write_corpus(path, lines, buffer_size=DEFAULT_BUFFER_SIZE):
+    """ Write an iterable of token id sequences as a binary corpus """
+    with CorpusWriter(path, buffer_size=buffer_size) as corpus:
+        for ids in lines:
+            corpus.append(ids)
+
+
+def text_to_corpus(in_filename, path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+        Convert a text corpus of space separated ids (e.g. pos.hash) into a
+        binary corpus, by default stored next to it.
+    """
+    if path is None:
+        path = in_filename
+    with open(in_filename, 'r') as in_file:
+        write_corpus(path, (np.array(line.split(), dtype=TOKEN_DTYPE)
+                            for line in in_file), buffer_size=buffer_size)
+    return path
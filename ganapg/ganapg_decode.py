@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decoding of model outputs back into C text. Generated sequences from SeqGAN
+are lines of vocabulary hashes, and those from seq2seq are lines of symbol
+tokens, so decoding is done in two optional stages:
+
+    hashes  --(array lookup)-->  tokens  --(inverse translator)-->  C text
+
+Both stages work line by line, so whole prediction files are streamed.
+
+@author: bbradt
+"""
+
+import os
+from ganapg_vocabulary import vocabfile_to_hashdict, hashdict_to_tokenlist
+from ganapg_vocabulary import unhash_line
+from ganapg_symbols import get_inverse_translator
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+
+
+def decode_lines(lines, token_list=None, translator=None):
+    """
+        Decode an iterable of lines, yielding one decoded line (without the
+        trailing newline) per input line.
+        If token_list is given, each line is first unhashed. If translator
+        is given, symbol tokens are then translated back into C operators.
+    """
+    for line in lines:
+        if token_list is not None:
+            line = ' '.join(unhash_line(line, token_list))
+        else:
+            line = line.rstrip('\n')
+        if translator is not None:
+            line = translator.translate(line)
+        yield line
+
+
+def decode_file(in_filename, out_filename=None, vocabfile=None,
+                vocab_hashdict=None, symbols=True,
+                symbol_json_filename="C_SYMBOL_MAP.json",
+                out_extension='.decoded', buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+        Decode a predictions file, one generated sequence per line.
+
+        in_filename - predictions from SeqGAN (hashes) or seq2seq (tokens)
+        vocabfile/vocab_hashdict - the vocabulary used to hash the training
+                                   data. If neither is given, the lines are
+                                   assumed to be tokens already.
+        symbols - translate symbol tokens back into C operators
+
+        Returns the number of decoded lines.
+    """
+    if not out_filename:
+        out_filename = os.path.splitext(in_filename)[0] + out_extension
+    token_list = None
+    if (not vocab_hashdict or type(vocab_hashdict) is not dict) and vocabfile:
+        vocab_hashdict = vocabfile_to_hashdict(vocabfile)
+    if vocab_hashdict:
+        token_list = hashdict_to_tokenlist(vocab_hashdict)
+    translator = None
+    if symbols:
+        translator = get_inverse_translator(symbol_json_filename)
+
+    n_lines = 0
+    with open(in_filename, 'r') as in_file, \
+            BufferedWriter(out_filename, buffer_size=buffer_size) as out_file:
+        for line in decode_lines(in_file, token_list=token_list,
+                                 translator=translator):
+            out_file.write(line + '\n')
+            n_lines += 1
+    return n_lines
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized n-gram (Markov chain) model over integer encoded tokens.
+
+For every order k = 0..m the model keeps a sorted table of the contexts
+(the k tokens preceding a position) seen in the training data, and a sorted
+table of (context, next token) pairs with their counts. Contexts are
+identified hierarchically: the key of an order k context is
+    id(order k - 1 context of its first k - 1 tokens) * V + last token
+so every key fits in an int64 whatever the order, and all tables are built
+with a handful of numpy passes over the whole corpus.
+
+Prediction backs off from order m to lower orders when a context has not
+been seen. Scoring interpolates the orders (Witten-Bell), so that scores are
+proper log probabilities. Both are done for a whole batch of prefixes at
+once.
+
+@author: bbradt
+"""
+
+import os
+import json
+import numpy as np
+from ganapg_util import BufferedWriter
+
+NGRAM_META = 'ngram.json'
+TABLES = ['context_keys', 'pair_keys', 'pair_counts', 'context_counts',
+          'best_next']
+
+
+def _flatten(sequences):
+    """ Concatenate sequences, returning the tokens and line start offsets """
+    sequences = [np.asarray(seq, dtype=np.int64) for seq in sequences]
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    if len(sequences):
+        tokens = np.concatenate(sequences)
+    else:
+        tokens = np.zeros(0, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)])[:-1]
+    # start of the line of each token
+    line_start = np.repeat(starts, lengths)
+    return tokens, line_start
+
+
+class NgramModel():
+    """
+        Array backed n-gram model of order m over tokens 0..vocab_size - 1.
+
+        Per order k the model stores
+            context_keys[k] - sorted unique context keys
+            pair_keys[k]    - sorted unique context_id * V + next keys
+            pair_counts[k]  - count of each pair
+            context_counts[k] - total count of each context
+            best_next[k]    - most frequent next token of each context
+    """
+    def __init__(self, m=2, vocab_size=None):
+        self.m = m
+        self.vocab_size = vocab_size
+        self.context_keys = []
+        self.pair_keys = []
+        self.pair_counts = []
+        self.context_counts = []
+        self.best_next = []
+        self._types = {}
+
+    def build(self, sequences, vocab_size=None):
+        """
+            Count all n-grams of orders 0..m in sequences (an iterable of
+            integer arrays, e.g. the lines of a corpus). N-grams never cross
+            sequence boundaries.
+        """
+        if vocab_size is not None:
+            self.vocab_size = vocab_size
+        self._types = {}
+        tokens, line_start = _flatten(sequences)
+        if self.vocab_size is None:
+            self.vocab_size = int(tokens.max()) + 1 if len(tokens) else 0
+        V = max(self.vocab_size, 1)
+        positions = np.arange(len(tokens), dtype=np.int64)
+
+        # order 0: a single empty context before every token
+        ctx_ids = np.zeros(len(tokens), dtype=np.int64)
+        self._add_order(np.zeros(1, dtype=np.int64), ctx_ids, tokens, V)
+        for k in range(1, self.m + 1):
+            # ctx_ids[j] is the id of tokens[j - k:j], or -1 if that
+            # context crosses the start of the line of token j
+            prev_ids = ctx_ids
+            ctx_ids = np.full(len(tokens), -1, dtype=np.int64)
+            valid = positions - k >= line_start
+            j = positions[valid]
+            raw = prev_ids[j - 1] * V + tokens[j - 1]
+            keys, inverse = np.unique(raw, return_inverse=True)
+            ctx_ids[j] = inverse.ravel()
+            self._add_order(keys, ctx_ids, tokens, V)
+        return self
+
+    def _add_order(self, keys, ctx_ids, tokens, V):
+        valid = ctx_ids >= 0
+        pairs = ctx_ids[valid] * V + tokens[valid]
+        pair_keys, pair_counts = np.unique(pairs, return_counts=True)
+        pair_ctx = pair_keys // V
+        pair_next = pair_keys % V
+        context_counts = np.bincount(pair_ctx, weights=pair_counts,
+                                     minlength=len(keys)).astype(np.int64)
+        # most frequent next token per context, ties to the smallest token
+        order = np.lexsort((pair_next, -pair_counts, pair_ctx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pair_ctx[order][1:] != pair_ctx[order][:-1]
+        best_next = np.full(len(keys), -1, dtype=np.int64)
+        best_next[pair_ctx[order][first]] = pair_next[order][first]
+        self.context_keys.append(keys)
+        self.pair_keys.append(pair_keys)
+        self.pair_counts.append(pair_counts.astype(np.int64))
+        self.context_counts.append(context_counts)
+        self.best_next.append(best_next)
+
+    def save(self, out_dir):
+        """
+            Save the model to out_dir as one .npy file per table and order,
+            plus a small json description. The description is written last,
+            so an interrupted save is never mistaken for a model.
+        """
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        meta_filename = os.path.join(out_dir, NGRAM_META)
+        if os.path.exists(meta_filename):
+            os.remove(meta_filename)
+        for name in TABLES:
+            for k, table in enumerate(getattr(self, name)):
+                np.save(os.path.join(out_dir, '%s_%d.npy' % (name, k)),
+                        np.asarray(table))
+        with BufferedWriter(meta_filename) as file:
+            json.dump({'m': self.m, 'vocab_size': self.vocab_size}, file)
+
+    def context_ids(self, contexts, k):
+        """
+            Ids of the order k contexts formed by the last k columns of
+            contexts (a (batch, m) int array, with -1 for unknown or missing
+            tokens). Returns -1 for contexts which were never seen.
+        """
+        batch = len(contexts)
+        ids = np.zeros(batch, dtype=np.int64)
+        V = max(self.vocab_size, 1)
+        for i in range(1, k + 1):
+            tok = contexts[:, contexts.shape[1] - k + i - 1]
+            keys = self.context_keys[i]
+            key = ids * V + tok
+            pos = np.searchsorted(keys, key)
+            found = (ids >= 0) & (tok >= 0) & (pos < len(keys))
+            found[found] = keys[pos[found]] == key[found]
+            ids = np.where(found, pos, -1)
+        return ids
+
+    def _contexts(self, prefixes):
+        """ (batch, m) array of the last m tokens of each prefix """
+        contexts = np.full((len(prefixes), self.m), -1, dtype=np.int64)
+        if self.m == 0:
+            return contexts
+        for b, prefix in enumerate(prefixes):
+            prefix = np.asarray(prefix, dtype=np.int64)[-self.m:]
+            if len(prefix):
+                contexts[b, self.m - len(prefix):] = prefix
+        return contexts
+
+    def next_tokens(self, contexts):
+        """
+            Most likely next token for each row of contexts, backing off to
+            the longest context which has been seen.
+        """
+        result = np.full(len(contexts), -1, dtype=np.int64)
+        todo = np.ones(len(contexts), dtype=bool)
+        for k in range(self.m, -1, -1):
+            if not todo.any():
+                break
+            ids = self.context_ids(contexts[todo], k)
+            hit = ids >= 0
+            idx = np.flatnonzero(todo)[hit]
+            result[idx] = self.best_next[k][ids[hit]]
+            todo[idx] = False
+        return result
+
+    def predict(self, prefixes, N):
+        """
+            Greedily continue every prefix (a list of token arrays) by N
+            tokens. Returns an (batch, N) int array.
+        """
+        contexts = self._contexts(prefixes)
+        out = np.full((len(prefixes), N), -1, dtype=np.int64)
+        for i in range(N):
+            nxt = self.next_tokens(contexts)
+            out[:, i] = nxt
+            if self.m:
+                contexts = np.roll(contexts, -1, axis=1)
+                contexts[:, -1] = nxt
+        return out
+
+    def _n_types(self, k):
+        """ Number of distinct tokens seen after each order k context """
+        if k not in self._types:
+            V = max(self.vocab_size, 1)
+            self._types[k] = np.bincount(
+                np.asarray(self.pair_keys[k]) // V,
+                minlength=len(self.context_keys[k])).astype(np.int64)
+        return self._types[k]
+
+    def log_prob(self, contexts, tokens):
+        """
+            Natural log probability of each token given the matching row
+            of contexts, with Witten-Bell interpolation:
+                P_k(w | h) = (c(h, w) + T(h) P_k-1(w | h')) / (c(h) + T(h))
+            where h' is h without its oldest token and T(h) the number of
+            distinct tokens seen after h. An unseen context falls back to
+            P_k-1, and order 0 is an add-one estimate over the vocabulary
+            and one unknown token (any id outside 0..V - 1), so the
+            probabilities of every context sum to one.
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        V = max(self.vocab_size, 1)
+        known = (tokens >= 0) & (tokens < V)
+        total = int(self.context_counts[0].sum()) \
+            if len(self.context_counts) else 0
+        unigram = np.zeros(len(tokens))
+        if len(self.pair_keys):
+            # order 0 pair keys are the tokens themselves
+            keys = self.pair_keys[0]
+            pos = np.searchsorted(keys, tokens)
+            hit = known & (pos < len(keys))
+            hit[hit] = keys[pos[hit]] == tokens[hit]
+            unigram[hit] = self.pair_counts[0][pos[hit]]
+        probs = (unigram + 1.0) / (total + V + 1)
+        for k in range(1, self.m + 1):
+            ids = self.context_ids(contexts, k)
+            seen = ids >= 0
+            if not seen.any():
+                continue
+            rows = np.flatnonzero(seen)
+            ids = ids[seen]
+            count = np.zeros(len(rows))
+            key = ids * V + tokens[rows]
+            keys = self.pair_keys[k]
+            pos = np.searchsorted(keys, key)
+            hit = known[rows] & (pos < len(keys))
+            hit[hit] = keys[pos[hit]] == key[hit]
+            count[hit] = self.pair_counts[k][pos[hit]]
+            n_context = self.context_counts[k][ids]
+            n_types = self._n_types(k)[ids]
+            probs[rows] = ((count + n_types * probs[rows]) /
+                           (n_context + n_types))
+        return np.log(probs)
+
+    def score(self, sequences):
+        """
+            Log likelihood of each sequence (an iterable of token arrays),
+            the sum of the log_prob of its tokens
+        """
+        sequences = [np.asarray(seq, dtype=np.int64) for seq in sequences]
+        tokens, line_start = _flatten(sequences)
+        positions = np.arange(len(tokens), dtype=np.int64)
+        contexts = np.full((len(tokens), self.m), -1, dtype=np.int64)
+        for c in range(self.m):
+            # column c holds the token at offset m - c before each position
+            j = positions - (self.m - c)
+            ok = j >= line_start
+            contexts[ok, c] = tokens[j[ok]]
+        scores = self.log_prob(contexts, tokens)
+        lengths = [len(seq) for seq in sequences]
+        line = np.repeat(np.arange(len(sequences)), lengths)
+        return np.bincount(line, weights=scores, minlength=len(sequences))
+
+
+def ngram_exists(in_dir):
+    return os.path.exists(os.path.join(in_dir, NGRAM_META))
+
+
+def load_ngram(in_dir, mmap_mode='r'):
+    """
+        Load a model saved with NgramModel.save. By default the tables are
+        memory mapped rather than read, so loading takes no time whatever
+        the size of the model.
+    """
+    with open(os.path.join(in_dir, NGRAM_META), 'r') as file:
+        meta = json.load(file)
+    model = NgramModel(meta['m'], meta['vocab_size'])
+    for name in TABLES:
+        tables = []
+        for k in range(model.m + 1):
+            filename = os.path.join(in_dir, '%s_%d.npy' % (name, k))
+            tables.append(np.load(filename, mmap_mode=mmap_mode))
+        setattr(model, name, tables)
+    return model
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar binary format for corpora of AST node sequences (as made by
+ast_to_nodesequence), replacing one json dump per program.
+
+Every node is a dict of fields. All strings (node types, field names and
+string values) are interned once in a string table, and the fields of all
+nodes of all programs are stored as flat arrays:
+
+    programs    prog_offsets[i]:prog_offsets[i + 1] are the nodes of
+                program i, prog_names[i] the string id of its name
+    nodes       node_offsets[j]:node_offsets[j + 1] are the fields of
+                node j, node_types[j] the string id of its _nodetype
+    fields      field_keys (string id of the field name), field_kinds and
+                field_values, whose meaning depends on the kind:
+                    NONE  -
+                    STR   string id
+                    INT   the integer itself (t_i, ...)
+                    LIST  list id
+                    JSON  string id of the json dump (anything else)
+    lists       list_offsets[l]:list_offsets[l + 1] index list_kinds and
+                list_values, which hold the elements (e.g. child t_i) with
+                the same kinds as fields
+    strings     str_offsets into str_data, utf-8
+
+The corpus is one file: a magic number, the length of a json header and
+the header, which gives the dtype, offset and length of every array,
+followed by the 8 byte aligned arrays. Each integer array is stored with
+the smallest dtype which holds its values. The reader memory maps the file, so
+any program can be decoded without reading the others.
+
+@author: bbradt
+"""
+
+import os
+import json
+import struct
+from array import array
+import numpy as np
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+
+NODESEQ_EXT = '.nseq'
+MAGIC = b'GNSQ0001'
+NONE, STR, INT, LIST, JSON = 0, 1, 2, 3, 4
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+STRING_TYPES = (str, type(u''))
+INT_TYPES = (int, type(1 << 64))
+
+# name, array typecode while writing
+COLUMNS = [('prog_offsets', 'q'),
+           ('prog_names', 'q'),
+           ('node_offsets', 'q'),
+           ('node_types', 'q'),
+           ('field_keys', 'q'),
+           ('field_kinds', 'b'),
+           ('field_values', 'q'),
+           ('list_offsets', 'q'),
+           ('list_kinds', 'b'),
+           ('list_values', 'q'),
+           ('str_offsets', 'q')]
+INT_DTYPES = [np.dtype('<i1'), np.dtype('<i2'), np.dtype('<i4'),
+              np.dtype('<i8')]
+
+
+def _compact(values):
+    """ values as an array of the smallest integer dtype holding them """
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return values.astype(INT_DTYPES[0])
+    low, high = values.min(), values.max()
+    for dtype in INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+
+
+class NodeSequenceWriter():
+    """
+        Append node sequences to a columnar corpus, written atomically to
+        path on close.
+
+            with NodeSequenceWriter('seq.nseq') as corpus:
+                for name, seq in seqs:
+                    corpus.append(seq, name=name)
+    """
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.columns = {}
+        for name, typecode in COLUMNS:
+            self.columns[name] = array(typecode)
+        for name in ['prog_offsets', 'node_offsets', 'list_offsets',
+                     'str_offsets']:
+            self.columns[name].append(0)
+        self.strings = {}
+        self.str_data = []
+        self.str_size = 0
+
+    def intern(self, string):
+        idx = self.strings.get(string)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings[string] = idx
+            data = string.encode('utf-8')
+            self.str_data.append(data)
+            self.str_size += len(data)
+            self.columns['str_offsets'].append(self.str_size)
+        return idx
+
+    def _scalar(self, value):
+        """ (kind, value) of a non-list value """
+        if value is None:
+            return NONE, 0
+        if isinstance(value, STRING_TYPES):
+            return STR, self.intern(value)
+        if (isinstance(value, INT_TYPES) and not isinstance(value, bool) and
+                INT64_MIN <= value <= INT64_MAX):
+            return INT, value
+        return JSON, self.intern(json.dumps(value))
+
+    def _value(self, value):
+        if not isinstance(value, list):
+            return self._scalar(value)
+        if any([isinstance(v, (list, dict)) for v in value]):
+            return JSON, self.intern(json.dumps(value))
+        lists = self.columns['list_offsets']
+        for v in value:
+            kind, v = self._scalar(v)
+            self.columns['list_kinds'].append(kind)
+            self.columns['list_values'].append(v)
+        lists.append(len(self.columns['list_values']))
+        return LIST, len(lists) - 2
+
+    def append(self, seq, name=''):
+        """ Add one program, given as a list of node dicts """
+        cols = self.columns
+        for node in seq:
+            node_type = node.get('_nodetype')
+            cols['node_types'].append(self.intern(node_type)
+                                      if node_type is not None else -1)
+            for key, value in node.items():
+                kind, value = self._value(value)
+                cols['field_keys'].append(self.intern(key))
+                cols['field_kinds'].append(kind)
+                cols['field_values'].append(value)
+            cols['node_offsets'].append(len(cols['field_keys']))
+        cols['prog_names'].append(self.intern(name))
+        cols['prog_offsets'].append(len(cols['node_types']))
+
+    def close(self):
+        arrays = []
+        for name, _ in COLUMNS:
+            arrays.append((name, _compact(self.columns[name])))
+        arrays.append(('str_data', np.frombuffer(b''.join(self.str_data),
+                                                 dtype=np.uint8)))
+        header = {}
+        offset = 0
+        for name, data in arrays:
+            header[name] = [data.dtype.str, offset, len(data)]
+            offset += -(-data.nbytes // 8) * 8
+        header = json.dumps(header).encode('utf-8')
+        out_dir = os.path.dirname(self.path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with BufferedWriter(self.path, buffer_size=self.buffer_size,
+                            mode='wb') as file:
+            file.write(MAGIC)
+            file.write(struct.pack('<Q', len(header)))
+            # pad the header so that the arrays start 8 byte aligned
+            header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+            file.write(header)
+            for _, data in arrays:
+                file.write(data.tobytes())
+                file.write(b'\0' * (-data.nbytes % 8))
+
+    def discard(self):
+        self.columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+
+class NodeSequenceReader():
+    """
+        Memory mapped view of a node sequence corpus. reader[i] decodes
+        program i back into its list of node dicts; types(i) gives the
+        node types of its nodes without decoding anything else.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a node sequence corpus' % path)
+            header_len = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(header_len).decode('utf-8'))
+        start = len(MAGIC) + 8 + header_len
+        start += -start % 8
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        for name, (dtype, offset, length) in header.items():
+            dtype = np.dtype(dtype)
+            begin = start + offset
+            view = data[begin:begin + length * dtype.itemsize]
+            setattr(self, name, view.view(dtype))
+        self._strings = None
+        self._index = None
+
+    def strings(self):
+        """ The decoded string table """
+        if self._strings is None:
+            raw = self.str_data.tobytes()
+            offsets = self.str_offsets.tolist()
+            self._strings = [raw[offsets[k]:offsets[k + 1]].decode('utf-8')
+                             for k in range(len(offsets) - 1)]
+        return self._strings
+
+    def string(self, idx):
+        return self.strings()[idx]
+
+    def __len__(self):
+        return len(self.prog_offsets) - 1
+
+    def name(self, i):
+        return self.string(int(self.prog_names[i]))
+
+    def names(self):
+        strings = self.strings()
+        return [strings[k] for k in self.prog_names.tolist()]
+
+    def index(self, name):
+        """ Position of the program called name """
+        if self._index is None:
+            self._index = {n: i for i, n in enumerate(self.names())}
+        return self._index[name]
+
+    def types(self, i):
+        """ The node types of program i """
+        strings = self.strings()
+        ids = self.node_types[self.prog_offsets[i]:self.prog_offsets[i + 1]]
+        return [strings[t] if t >= 0 else None for t in ids.tolist()]
+
+    def _decode(self, kind, value, strings):
+        if kind == INT:
+            return value
+        if kind == STR:
+            return strings[value]
+        if kind == NONE:
+            return None
+        return json.loads(strings[value])
+
+    def _lists(self, kinds, values, strings):
+        """
+            Decode every list of one program at once (the list ids of a
+            program are consecutive). Returns the first list id and the
+            lists.
+        """
+        ids = [v for k, v in zip(kinds, values) if k == LIST]
+        if not ids:
+            return 0, []
+        first, last = min(ids), max(ids)
+        offsets = self.list_offsets[first:last + 2].tolist()
+        base = offsets[0]
+        elements = [self._decode(k, v, strings) for k, v in
+                    zip(self.list_kinds[base:offsets[-1]].tolist(),
+                        self.list_values[base:offsets[-1]].tolist())]
+        return first, [elements[offsets[l] - base:offsets[l + 1] - base]
+                       for l in range(len(offsets) - 1)]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('program %d out of range' % i)
+        strings = self.strings()
+        node_begin = self.prog_offsets[i]
+        node_end = self.prog_offsets[i + 1]
+        bounds = self.node_offsets[node_begin:node_end + 1].tolist()
+        begin, end = bounds[0], bounds[-1]
+        keys = [strings[k] for k in self.field_keys[begin:end].tolist()]
+        kinds = self.field_kinds[begin:end].tolist()
+        values = self.field_values[begin:end].tolist()
+        first_list, lists = self._lists(kinds, values, strings)
+        seq = []
+        for j in range(len(bounds) - 1):
+            node = {}
+            for f in range(bounds[j] - begin, bounds[j + 1] - begin):
+                kind = kinds[f]
+                if kind == INT:
+                    node[keys[f]] = values[f]
+                elif kind == STR:
+                    node[keys[f]] = strings[values[f]]
+                elif kind == LIST:
+                    # copied, so that callers may modify the sequence
+                    node[keys[f]] = list(lists[values[f] - first_list])
+                else:
+                    node[keys[f]] = self._decode(kind, values[f], strings)
+            seq.append(node)
+        return seq
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_nodesequences(path, seqs, names=None,
+                        buffer_size=DEFAULT_BUFFER_SIZE):
+    """ Write an iterable of node sequences as one corpus """
+    with NodeSequenceWriter(path, buffer_size=buffer_size) as corpus:
+        for i, seq in enumerate(seqs):
+            corpus.append(seq, name=names[i] if names else '')
@@ -3,12 +3,21 @@ import ganapg_vocabulary as gvoc
 from ganapg_util import query_yes_no, py3
 import ganapg_preprocess_ast as gast
 import ganapg_config as cfg
-#if py3():
-#    from ganapg_pymarkov import Ganapg_Markov
+from ganapg_cache import StepCache, params_fingerprint
+from ganapg_scheduler import Step, StepGraph
+from ganapg_nodeseq import NODESEQ_EXT
+from ganapg_corpus import remove_corpus
+from ganapg_walk import record_files
+from ganapg_pymarkov import Ganapg_Markov, evaluate_file
+import ganapg_seq2seq as gs2s
+import ganapg_batch as gbat
 import subprocess as sp
+import numpy as np
 import os
 import sys
 
+MODEL_STEPS = ['seq2seq', 'seqgan', 'markov', 'deepfix']
+
 
 class Pipeline():
     """
@@ -34,9 +43,10 @@ class Pipeline():
     """
 
     def __init__(self, method='cf_ast_seqgan', skip=[], data_dir=None,
-                 save_dir=None):
+                 save_dir=None, workers=None, cache=True):
         print('Running model %s' % method)
-        self.meth = getattr(cfg, method)
+        # a copy, as steps are removed from it below
+        self.meth = dict(getattr(cfg, method))
         self.data_dir = self.meth['data_dir']
         self.save_dir = None
         if data_dir is not None:
@@ -46,87 +56,262 @@ class Pipeline():
             self.save_dir = save_dir
         self.meth['steps'] = [s for s in self.meth['steps'] if s not in skip]
         self.extension = None
+        self.workers = workers
+        if self.workers is None:
+            self.workers = self.meth.get('workers', cfg.WORKERS)
+        self.incremental = self.meth.get('incremental', cfg.INCREMENTAL)
+        self.binary = self.meth.get('binary', cfg.BINARY_CORPUS)
+        self.cache = None
+        if cache:
+            self.cache = StepCache(cfg.CACHE_DIR)
+
+    def run(self, step_workers=None):
+        """
+            Run the steps of the config, with up to step_workers
+            independent steps at the same time (see plan).
+        """
+        if step_workers is None:
+            step_workers = self.meth.get('step_workers', cfg.STEP_WORKERS)
+        graph = StepGraph()
+        self.plan(graph)
+        graph.run(workers=step_workers)
 
-    def run(self):
+    def plan(self, graph):
+        """
+            Add the steps of the config to graph, each with the paths it
+            reads and writes, so that steps run as soon as their inputs are
+            ready, and steps shared with other configs in the same graph
+            run once. Returns the steps.
+        """
+        steps = []
         for step in self.meth['steps']:
             if not self.save_dir:
                 save_dir = self.meth['save_dir'][step]
             else:
                 save_dir = self.save_dir
-            save = self.meth['save']
-            if step is 'obfuscate':
-                print('Obfuscating cfiles')
-                self.extension = '.obfs'
-                gtok.obfuscate_cfiles(data_dir=self.data_dir,
-                                      recurse=1, save_dir=None,
-                                      save=save)
-                # self.data_dir = save_dir if save_dir else '.'
-            elif step is 'symbols':
-                print('Converting symbols to tokens')
-                self.extension = '.nosym'
-                gtok.convert_cfiles_symbols(data_dir=self.data_dir,
-                                            save_dir=save_dir,
-                                            save=save)
-                self.data_dir = save_dir if save_dir else '.'
-            elif step is 'posneg':
-                print('Creating positive/negative splits')
-                gtok.codeflaws_posneg(data_dir=self.data_dir,
-                                      save_dir=save_dir,
-                                      extension=self.extension,
-                                      save=save)
-                self.data_dir = save_dir if save_dir else '.'
-            elif step is 'cgc-posneg':
-                print('Creating positive/negative splits')
-                gtok.codeflaws_posneg(data_dir=self.data_dir,
-                                      save_dir=save_dir,
-                                      extension=self.extension,
-                                      save=save)
-                self.data_dir = save_dir if save_dir else '.'
-            elif step is 'vocabgen':
-                print('Generating vocabulary')
-                print(self.meth['vocab'], self.data_dir)
-                gvoc.generate_vocab_to_file(data_dir=self.data_dir,
-                                            vocab_filename=cfg.BASE_VOCAB,
-                                            out_filename=self.meth['vocab'])
-            elif step is 'vocabhash':
-                self.extension = '.hash'
-                print('Hashing codeflaws files')
-                vocabfile = self.meth['vocab']
-                gvoc.hash_files(data_dir=self.data_dir,
-                                vocabfile=vocabfile,
-                                save_dir=save_dir,
-                                save=save)
-                self.data_dir = save_dir if save_dir else '.'
-            elif step is 'astseq':
-                print('Generating AST sequences')
-                gast.cfiles_to_nodesequences(data_dir=self.data_dir,
-                                             save_dir=None,
-                                             save=save, recurse=0)
-            elif step is 'seqtok':
-                self.extension = '.seq.hash'
-                print('Generating AST tokens')
-                _, v = gast.nodesequences_to_tokens(data_dir=self.data_dir,
-                                                    save_dir=None,
-                                                    save=save)
-                print('Redumping AST vocabulary')
-                gvoc.list_to_vocabfile(v.get_feature_names(),
-                                       self.meth['vocab'])
-            elif step is 'seq2seq':
+            steps.append(graph.add(self._declare(step, save_dir,
+                                                 self.meth['save'])))
+        return steps
+
+    def _step(self, step, message, fn, inputs, outputs, **kwargs):
+        """
+            A graph node calling fn(**kwargs) through the step cache. Its
+            key covers everything the call depends on, so the same call
+            from another config is merged into it.
+        """
+        def call():
+            print('[%s] %s' % (self.meth['name'], message))
+            return self._call(step, fn, inputs, outputs, **kwargs)
+        key = params_fingerprint({'fn': '%s.%s' % (fn.__module__,
+                                                   fn.__name__),
+                                  'inputs': inputs,
+                                  'outputs': outputs,
+                                  'params': kwargs})
+        return Step('%s:%s' % (self.meth['name'], step), call,
+                    inputs=inputs, outputs=outputs, key=key)
+
+    def _declare(self, step, save_dir, save):
+        """
+            The graph node of one step. The data directory and extension
+            which each step leaves for the next are followed here, when
+            the graph is built, rather than while it runs.
+        """
+        if step == 'obfuscate':
+            self.extension = '.obfs'
+            return self._step(step, 'Obfuscating cfiles',
+                              gtok.obfuscate_cfiles,
+                              inputs=[(self.data_dir, ['.c'])],
+                              outputs=[(self.data_dir, ['.obfs'])],
+                              data_dir=self.data_dir,
+                              recurse=1, save_dir=None,
+                              save=save, workers=self.workers,
+                              method=self.meth.get('strip_method',
+                                                   cfg.STRIP_METHOD),
+                              incremental=self.incremental)
+        elif step == 'symbols':
+            self.extension = '.nosym'
+            symbol_map = self.meth.get('symbol_map', cfg.SYMBOL_MAP)
+            node = self._step(step, 'Converting symbols to tokens',
+                              gtok.convert_cfiles_symbols,
+                              inputs=[(self.data_dir, ['']), symbol_map],
+                              outputs=self._outputs(
+                                  save_dir, [(self.data_dir, ['.nosym'])]),
+                              data_dir=self.data_dir,
+                              save_dir=save_dir,
+                              symbol_json_filename=symbol_map,
+                              save=save, incremental=self.incremental,
+                              workers=self.workers)
+        elif step == 'posneg':
+            node = self._step(step, 'Creating positive/negative splits',
+                              gtok.codeflaws_posneg,
+                              inputs=[(self.data_dir, [self.extension])],
+                              outputs=self._outputs(save_dir,
+                                                    ['pos', 'neg']),
+                              data_dir=self.data_dir,
+                              save_dir=save_dir,
+                              extension=self.extension,
+                              save=save,
+                              shard_size=self.meth.get(
+                                  'shard_size', cfg.POSNEG_SHARD_SIZE),
+                              return_data=False)
+        elif step == 'cgc-posneg':
+            node = self._step(step, 'Creating positive/negative splits',
+                              gtok.cgc_posneg,
+                              inputs=[(self.data_dir, ['.c', '.md', '.txt'])],
+                              outputs=self._outputs(
+                                  save_dir, ['pos', 'neg', 'labels.txt']),
+                              data_dir=self.data_dir,
+                              save_dir=save_dir,
+                              save=save,
+                              workers=self.workers,
+                              shard_size=self.meth.get(
+                                  'shard_size', cfg.POSNEG_SHARD_SIZE),
+                              return_data=False)
+        elif step == 'vocabgen':
+            unk_token = gvoc.UNK_TOKEN
+            if 'seq2seq' in self.meth['steps']:
+                # seq2seq adds its own UNK to the vocabulary it is given
+                unk_token = None
+            return self._step(step, 'Generating vocabulary %s from %s'
+                              % (self.meth['vocab'], self.data_dir),
+                              gvoc.generate_vocab_to_file,
+                              inputs=[self.data_dir, cfg.BASE_VOCAB],
+                              outputs=[self.meth['vocab']],
+                              data_dir=self.data_dir,
+                              vocab_filename=cfg.BASE_VOCAB,
+                              out_filename=self.meth['vocab'],
+                              min_count=self.meth.get('min_count', 1),
+                              max_size=self.meth.get('max_vocab'),
+                              unk_token=unk_token)
+        elif step == 'vocabhash':
+            self.extension = '.hash'
+            vocabfile = self.meth['vocab']
+            node = self._step(step, 'Hashing codeflaws files',
+                              gvoc.hash_files,
+                              inputs=[self.data_dir, vocabfile],
+                              outputs=self._outputs(
+                                  save_dir, [(self.data_dir,
+                                              ['.hash', '.tok', '.off'])]),
+                              data_dir=self.data_dir,
+                              vocabfile=vocabfile,
+                              save_dir=save_dir,
+                              save=save, unk_token=gvoc.UNK_TOKEN,
+                              binary=self.binary)
+        elif step == 'astseq':
+            corpus_filename = None
+            if self.binary:
+                corpus_filename = os.path.join(self.data_dir,
+                                               'seq' + NODESEQ_EXT)
+            return self._step(step, 'Generating AST sequences',
+                              gast.cfiles_to_nodesequences,
+                              inputs=[(self.data_dir, ['.c'])],
+                              outputs=[(self.data_dir,
+                                        ['.json', NODESEQ_EXT])],
+                              data_dir=self.data_dir,
+                              save_dir=None,
+                              save=save, recurse=0,
+                              incremental=self.incremental,
+                              workers=self.workers,
+                              corpus_filename=corpus_filename,
+                              json_files=not self.binary)
+        elif step == 'seqtok':
+            self.extension = '.seq.hash'
+            return self._step(step, 'Generating AST tokens',
+                              self._seqtok,
+                              inputs=[(self.data_dir,
+                                       ['.json', NODESEQ_EXT])],
+                              outputs=[(self.data_dir,
+                                        ['.hash', '.tok', '.off']),
+                                       self.meth['vocab']],
+                              data_dir=self.data_dir,
+                              save=save,
+                              vocab=self.meth['vocab'],
+                              binary=self.binary)
+        elif step in MODEL_STEPS:
+            return self._declare_model(step, save_dir, save)
+        else:
+            raise ValueError('Unknown step %s' % step)
+        # the following steps read the outputs of this one
+        self.data_dir = save_dir if save_dir else '.'
+        return node
+
+    def _outputs(self, save_dir, default):
+        """ The outputs of a step: save_dir, or default without one """
+        if save_dir:
+            return [save_dir]
+        return default
+
+    def _declare_model(self, step, save_dir, save):
+        """
+            Models are trained and evaluated in one node, after the steps
+            which write their training data.
+        """
+        data_dir = self.data_dir
+        name = self.meth['name']
+        inputs = [data_dir]
+        outputs = []
+        exclusive = False
+        if step == 'seq2seq':
+            inputs += [self.meth['vocab'], self.meth['save_dir']['posneg']]
+            outputs = ['./%s_model/' % name, './%s_predictions/' % name]
+            # tensorflow flags and sys.stdout are process wide
+            exclusive = True
+        elif step == 'markov':
+            outputs = self._outputs(save_dir, [])
+
+        def run():
+            self.data_dir = data_dir
+            if step == 'seq2seq':
                 self._config_seq2seq()
                 self._run_seq2seq()
                 self._eval_seq2seq()
-            elif step is 'seqgan':
+            elif step == 'seqgan':
                 self._config_seqgan()
                 self._run_seqgan()
                 self._eval_seqgan()
-            elif step is 'markov':
-                self._config_markov()
+            elif step == 'markov':
+                self._config_markov(save_dir, save)
                 self._run_markov()
                 self._eval_markov()
-            elif step is 'deepfix':
+            elif step == 'deepfix':
                 self._config_deepfix()
                 self._run_deepfix()
                 self._eval_deepfix()
+        return Step('%s:%s' % (name, step), run, inputs=inputs,
+                    outputs=outputs, exclusive=exclusive)
+
+    def _call(self, step, fn, inputs, outputs, **kwargs):
+        """
+            Run a preprocessing step through the step cache. If the step's
+            inputs, parameters and code are unchanged since its last run,
+            and its outputs are still in place, the step is skipped.
+        """
+        if not self.cache:
+            return fn(**kwargs)
+        key = '%s_%s' % (self.meth['name'], step)
+        ran, result = self.cache.call(key, fn, inputs, outputs, **kwargs)
+        if not ran:
+            print('Skipping %s, cached outputs are up to date' % step)
+        return result
+
+    def _seqtok(self, data_dir, save, vocab, binary=False):
+        corpus_filename = os.path.join(data_dir, 'seq.hash')
+        if not binary:
+            # left over from an earlier binary run
+            remove_corpus(corpus_filename)
+            corpus_filename = None
+        nodeseq_filename = os.path.join(data_dir, 'seq' + NODESEQ_EXT)
+        if not os.path.exists(nodeseq_filename):
+            # json sequences from astseq
+            nodeseq_filename = None
+        _, v = gast.nodesequences_to_tokens(data_dir=data_dir,
+                                            save_dir=None,
+                                            save=save,
+                                            corpus_filename=corpus_filename,
+                                            nodeseq_filename=nodeseq_filename)
+        print('Redumping AST vocabulary')
+        gvoc.list_to_vocabfile(v.get_feature_names(), vocab)
+
     """
         The following functions make external calls to the libraries which
         run particular models. This follows the recommended protocol for each
@@ -139,6 +324,10 @@ class Pipeline():
         return
 
     def _run_seqgan(self):
+        for name in ['pos', 'neg']:
+            if len(record_files(self.data_dir + self.meth[name])) != 1:
+                raise ValueError('SeqGAN reads %s from a single file, run '
+                                 'posneg without shard_size' % name)
         cmd = ('python2 %s --pos %s --neg %s' % (self.meth['run'],
                                             self.data_dir+self.meth['pos'],
                                             self.data_dir+self.meth['neg']))
@@ -153,71 +342,98 @@ class Pipeline():
 
     def _config_seq2seq(self):
         """
-            This function is currently a hacky workaround to implement the
-            seq2seq library as was initially done with the shell files prior
-            to building the python module.
-            It does, however, work.
-
-            TODO: Instead of adding environment variables, just call the 
-            python script directly with command line arguments corresponding
-            to these arguments.
+            Collect the paths and training parameters of the seq2seq model
+            from the config.
         """
         print(self.meth['neg'], self.meth['pos'])
-        os.environ['DATA_PATH'] = '../ganapg/'+self.data_dir
-        os.environ['VOCAB_NAME'] = self.meth['vocab']
-        os.environ['TRAIN_NAME'] = self.meth['neg']
-        os.environ['TARGET_NAME'] = self.meth['pos']
-        os.environ['MODEL_NAME'] = self.meth['name']
-        os.environ['TRAIN_STEPS'] = str(self.meth['iters'])
-        model_dir = '../ganapg/%s/' % (
-                                                self.meth['name']+'_model')
-        pred_dir = '../ganapg/%s/' % (
-                                              self.meth['name']+'_predictions')
-        os.environ['VOCAB_SOURCE'] = '../ganapg/%s' % self.meth['vocab']
-        os.environ['VOCAB_TARGET'] = '../ganapg/%s' % self.meth['vocab']
-        os.environ['TRAIN_SOURCES'] = '../ganapg/%s/%s' % (self.data_dir,
-                                                   self.meth['neg'])
-        os.environ['TRAIN_TARGETS'] = '../ganapg/%s/%s' % (self.data_dir,
-                                                   self.meth['pos'])
-        os.environ['DEV_SOURCES'] = '../ganapg/'+'%s_posneg/neg' % self.meth['name']
-        os.environ['DEV_TARGETS'] = '../ganapg/'+'%s_posneg/pos' % self.meth['name']
-        os.environ['DEV_TARGETS_REF'] = '../ganapg/'+'%s_posneg/pos' % self.meth['name']
-        os.environ['MODEL_DIR'] = model_dir
-        os.environ['PRED_DIR'] = pred_dir
-        if not os.path.exists(model_dir):
-            os.mkdir(model_dir)
-        if not os.path.exists(pred_dir):
-            os.mkdir(pred_dir)
+        name = self.meth['name']
+        posneg_dir = self.meth['save_dir']['posneg']
+        self.seq2seq = {
+            'vocab': self.meth['vocab'],
+            # every shard, if posneg wrote shards
+            'train_sources': record_files(os.path.join(self.data_dir,
+                                                       self.meth['neg'])),
+            'train_targets': record_files(os.path.join(self.data_dir,
+                                                       self.meth['pos'])),
+            'dev_sources': record_files(os.path.join(posneg_dir, 'neg')),
+            'dev_targets': record_files(os.path.join(posneg_dir, 'pos')),
+            'model_dir': './%s_model/' % name,
+            'pred_dir': './%s_predictions/' % name,
+            'batch_size': self.meth.get('batch_size', 32),
+            'buckets': self.meth.get('buckets', None),
+            'model_config': self.meth.get('model_config',
+                                          gs2s.MODEL_CONFIG)}
+        if self.seq2seq['buckets'] == 'auto':
+            # Boundaries at the quantiles of the training pair lengths
+            lengths = np.maximum(
+                np.concatenate([gbat.file_lengths(f) for f in
+                                self.seq2seq['train_sources']]),
+                np.concatenate([gbat.file_lengths(f) for f in
+                                self.seq2seq['train_targets']]))
+            self.seq2seq['buckets'] = gbat.auto_buckets(
+                lengths, self.meth.get('n_buckets', 8))
+            print('seq2seq buckets: %s' % self.seq2seq['buckets'])
+        for out_dir in [self.seq2seq['model_dir'], self.seq2seq['pred_dir']]:
+            if not os.path.exists(out_dir):
+                os.mkdir(out_dir)
         return
 
+    def _progress_seq2seq(self, message):
+        print('[%s] %s' % (self.meth['name'], message))
+
     def _run_seq2seq(self):
-        cmd = './%s' % (self.meth['run'])
-        print("In run seq2seq calling:\n\t%s" % cmd)
-        o = sp.check_output([cmd], shell=True)
-        # print(e)
+        conf = self.seq2seq
+        gs2s.train(vocab_source=conf['vocab'],
+                   vocab_target=conf['vocab'],
+                   train_sources=conf['train_sources'],
+                   train_targets=conf['train_targets'],
+                   dev_sources=conf['dev_sources'],
+                   dev_targets=conf['dev_targets'],
+                   output_dir=conf['model_dir'],
+                   train_steps=self.meth['iters'],
+                   batch_size=conf['batch_size'],
+                   buckets=conf['buckets'],
+                   model_config=conf['model_config'],
+                   seq2seq_dir=cfg.SEQ2SEQ_DIR,
+                   progress=self._progress_seq2seq)
 
     def _eval_seq2seq(self):
-        cmd = './%s' % (self.meth['eval'])
-        print("In run seq2seq calling:\n\t%s" % cmd)
-        o = sp.check_output([cmd], shell=True)
-        # print(o)
+        conf = self.seq2seq
+        out_filename = os.path.join(conf['pred_dir'], 'predictions.txt')
+        gs2s.infer(model_dir=conf['model_dir'],
+                   sources=conf['dev_sources'],
+                   out_filename=out_filename,
+                   batch_size=conf['batch_size'],
+                   seq2seq_dir=cfg.SEQ2SEQ_DIR,
+                   progress=self._progress_seq2seq)
+        self.prediction = out_filename
+        print('Wrote seq2seq predictions to %s' % out_filename)
 
-    def _config_markov(self):
+    def _config_markov(self, save_dir, save):
         self.markov = Ganapg_Markov(data_dir=self.data_dir,
                                     in_filename=self.meth['pos'],
-                                    save_dir=self.meth['save_dir'],
-                                    save=self.meth['save'])
+                                    save_dir=save_dir,
+                                    save=save,
+                                    m=self.meth.get('order', cfg.MARKOV_ORDER))
         return
 
     def _run_markov(self):
-        self.markov.build()
+        if self.markov.build():
+            print('Built markov chain from %s' % self.markov.in_filename)
+        else:
+            print('Loaded markov chain from %s' % self.markov.save_dir)
         return
 
     def _eval_markov(self):
-        with open(os.path.join(self.data_dir, self.meth['neg'])) as file:
-            prediction = self.markov.predict(file.read(), 100)
-        self.prediction = prediction
-        print(self.prediction)
+        in_filename = os.path.join(self.data_dir, self.meth['neg'])
+        out_filename = os.path.join(self.markov.save_dir or self.data_dir,
+                                    '%s.markov.tsv' % self.meth['neg'])
+        n_lines = evaluate_file(self.markov, in_filename, out_filename,
+                                N=self.meth.get('predict_len', 100),
+                                workers=self.workers)
+        self.prediction = out_filename
+        print('Evaluated %d lines of %s into %s' % (n_lines, in_filename,
+                                                   out_filename))
         return
 
     def _config_deepfix(self):
@@ -236,9 +452,27 @@ class Pipeline():
         return
 
 
+def run_pipelines(methods, step_workers=cfg.STEP_WORKERS, **kwargs):
+    """
+        Run several configs as one step graph, so that their independent
+        steps run at the same time and the steps they share (e.g. the
+        obfuscation of the codeflaws corpus) run once. kwargs are passed
+        to every Pipeline. Returns the pipelines.
+    """
+    graph = StepGraph()
+    pipelines = []
+    for method in methods:
+        pipeline = Pipeline(method=method, **kwargs)
+        pipeline.plan(graph)
+        pipelines.append(pipeline)
+    print('%d steps for %d configs' % (len(graph), len(pipelines)))
+    graph.run(workers=step_workers)
+    return pipelines
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        PL = Pipeline(skip=[], method=sys.argv[1])
-    else:
-        PL = Pipeline(skip=[])
-    PL.run()
+    # python ganapg_pipeline.py [config ...], or all for every config
+    methods = sys.argv[1:] or ['cf_ast_seqgan']
+    if methods == ['all']:
+        methods = cfg.CONFIGS
+    run_pipelines(methods)
@@ -12,16 +12,137 @@ Created on Sun Nov 12 22:58:12 2017
 
 import json
 import os
+import re
 from pycparser.plyparser import ParseError
+import pycparser
 from pycparser import c_generator, parse_file
-from ganapg_pycp import pycp_from_dict, pycp_to_dict
-from sklearn.feature_extraction import DictVectorizer
+from ganapg_pycp import pycp_from_dict, pycp_to_cnode, CNode
+from ganapg_pycp import pycp_complete_dict, pycp_ARRAY_CHILDREN
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+from ganapg_cache import FileManifest, step_fingerprint, tree_fingerprint
+from ganapg_corpus import CorpusWriter
+from ganapg_nodeseq import NodeSequenceWriter, NodeSequenceReader
+from ganapg_walk import scan_files, run_units, chunks, PROCESS
+import numpy as np
 import progressbar
+import zlib
+
+AST_MANIFEST = '.astseq.manifest'
+PYCPARSER_DIR = '../pycparser/'
+# key of an element of an unwrapped list feature, e.g. quals0
+RE_LIST_FEATURE = re.compile(r'^(.*\D)(\d+)$')
+
+
+def _node_children(node):
+    """
+        The child nodes of a dict node, in the order in which they are
+        assigned sequence indices.
+    """
+    for v in node.values():
+        if isinstance(v, dict):
+            yield v
+        elif isinstance(v, list):
+            for child in v:
+                if isinstance(child, dict):
+                    yield child
+
+
+def _subtree_sizes(ast):
+    """
+        Iteratively count the nodes in every subtree of ast, keyed by the
+        id of each subtree's root.
+    """
+    sizes = {}
+    stack = [(ast, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            sizes[id(node)] = 1 + sum([sizes[id(child)]
+                                       for child in _node_children(node)])
+            continue
+        stack.append((node, True))
+        for child in _node_children(node):
+            stack.append((child, False))
+    return sizes
+
+
+def iter_nodesequence(ast, t0=0, child_prefix='_children_%s'):
+    """
+        Generator version of ast_to_nodesequence, yielding the nodes of the
+        flattened tree one at a time in t_i order.
+
+        Subtree sizes are counted first, so the t_i of each child is known
+        when its parent is visited, and every node is complete when it is
+        yielded. Both passes are iterative and linear in the size of the
+        tree.
+    """
+    sizes = _subtree_sizes(ast)
+    stack = [(ast, t0)]
+    while stack:
+        node, t = stack.pop()
+        node['t_i'] = t
+        unwrapped_subtree = {}
+        children = []
+        next_t = t + 1
+        for k, v in node.items():
+            if isinstance(v, dict):
+                v = [v]
+            if isinstance(v, list) and len(v) > 0:
+                for child in v:
+                    if isinstance(child, dict):
+                        child_key = child_prefix % (k)
+                        if child_key not in unwrapped_subtree:
+                            unwrapped_subtree[child_key] = []
+                        unwrapped_subtree[child_key].append(next_t)
+                        children.append((child, next_t))
+                        next_t += sizes[id(child)]
+                        continue
+                    if k not in unwrapped_subtree:
+                        unwrapped_subtree[k] = []
+                    unwrapped_subtree[k].append(child)
+                continue
+            unwrapped_subtree[k] = v
+        # visit the children left to right
+        stack.extend(reversed(children))
+        yield unwrapped_subtree
+
+
+def iter_cnode_sequence(root, t0=0, child_prefix='_children_%s'):
+    """
+        iter_nodesequence for a tree of CNodes (see pycp_to_cnode), which
+        yields the same node dicts as iter_nodesequence over the
+        pycp_to_dict form of the tree, without building that form. Subtree
+        sizes are already known from the CNodes.
+    """
+    stack = [(root, t0)]
+    while stack:
+        node, t = stack.pop()
+        flat = {'_nodetype': node.nodetype}
+        children = []
+        next_t = t + 1
+        for name, value in node.items():
+            if isinstance(value, CNode):
+                value = [value]
+            elif not (isinstance(value, list) and value and
+                      isinstance(value[0], CNode)):
+                flat[name] = list(value) if isinstance(value, list) \
+                    else value
+                continue
+            edges = []
+            for child in value:
+                edges.append(next_t)
+                children.append((child, next_t))
+                next_t += child.size
+            flat[child_prefix % (name)] = edges
+        flat['t_i'] = t
+        # visit the children left to right
+        stack.extend(reversed(children))
+        yield flat
 
 
 def ast_to_nodesequence(ast, t0=0, child_prefix='_children_%s'):
     """
-        This function takes a recursive, depth-first strategy
+        This function takes a depth-first strategy
         to flatten an Absract Syntax Tree.
         Starting at given root, follow a path to the deepest, left-most
         unvisited child node. Each node encountered along the path, then
@@ -49,56 +170,14 @@ def ast_to_nodesequence(ast, t0=0, child_prefix='_children_%s'):
              '_children_body': [1, 2, 3],
              '_root_field':0
             }
-    """
-    t = t0
-    seq = []
-    ast['t_i'] = t
-    unwrapped_subtree = {}  # the root node's unwrapped subtree
-    if isinstance(ast, dict):
-        for k, v in ast.items():
-            child_key = child_prefix % (k)
-            if isinstance(v, dict):
-                """
-                    if the child is a single dictionary, just place it into
-                    a dictionary so that we reduce the number of object
-                    type cases
-                """
-                v = [v]
-
-            if isinstance(v, list) and len(v) > 0:
-                """
-                    If the child object is a list, that list could contain
-                    non-node objects, or it might contain a set of child
-                    nodes.
-
-                    If the child object in the lsit is a dictionary,
-                    it indicates we've hit another node along the path
-                    to the deepest child.
-                    We increment the current point in the sequence, and then
-                    recurse into that child's subtree, keeping track of how
-                    deep that child goes to make sure the resulting sequence
-                    is correctly ordered.
-                """
-                for child in v:
-                    if isinstance(child, dict):
-                        t += 1
-                        child_seq, child_t = ast_to_nodesequence(child, t0=t)
-                        seq += child_seq
-                        if child_key not in unwrapped_subtree.keys():
-                            unwrapped_subtree[child_key] = []
-                        unwrapped_subtree[child_key].append(t)
-                        t = child_t
-                        continue
-                    if k not in unwrapped_subtree.keys():
-                        unwrapped_subtree[k] = []
-                    unwrapped_subtree[k].append(child)
-                continue
-            unwrapped_subtree[k] = v
-        seq.append(unwrapped_subtree)
 
-        # make sure the resulting sequence is correctly sorted
-        seq = sorted(seq, key=lambda k: k['t_i'])
-    return seq, t
+        The tree is walked iteratively (see iter_nodesequence), so deep
+        trees do not hit the recursion limit, and nodes are emitted directly
+        in t_i order without any sorting. Returns the sequence and the t_i
+        of its last node.
+    """
+    seq = list(iter_nodesequence(ast, t0=t0, child_prefix=child_prefix))
+    return seq, t0 + len(seq) - 1
 
 
 def grab_children_from_sequence(seq, t_i):
@@ -111,37 +190,51 @@ def grab_children_from_sequence(seq, t_i):
     return [seq[t] for t in t_i]
 
 
-def nodesequence_to_ast(seq, child_prefix='_children_',
-                        full_seq=None, nodes_hit=[]):
+def nodesequence_to_ast(seq, child_prefix='_children_'):
     """
         Given a sequence of nodes converted by ast_to_nodesequence,
-        convert that sequence back to an Abstract Syntax Tree.
-
-        full_seq is the full node sequence of the entire tree, which has
-        to be pased to each recursion to make sure that the correct
-        children are grabbed.
+        convert that sequence back to an Abstract Syntax Tree in the dict
+        form of pycp_to_dict, ready for pycp_from_dict.
 
-        nodes_hit is a list of nodes already visited, to prevent duplication
+        Children always come after their parent in a sequence, so the
+        nodes are rebuilt in one pass from the last to the first, and every
+        edge is resolved by its t_i in a dict of the nodes built so far.
+        Each node can only be claimed by one parent, and edges to missing
+        (or already claimed) nodes raise a ValueError, which also rules out
+        cycles in generated sequences. Nodes no parent refers to are
+        dropped. The fields left out of a node (e.g. by NodeTokenEncoder)
+        are filled in with pycp_complete_dict.
     """
-    if full_seq is None:  # this should be the case at the root node
-        full_seq = seq
-    for node in seq:
+    if not seq:
+        raise ValueError('Empty node sequence')
+    built = {}
+    for node in reversed(seq):
+        t = node['t_i']
         ast = {}
-        if node['t_i'] in nodes_hit:
-            continue
+        arrays = pycp_ARRAY_CHILDREN.get(node.get('_nodetype'), ())
         for name, field in node.items():
-            if name is 't_i':
+            if name == 't_i':
                 continue
-            if child_prefix in name:  # we've found edges to children
-                children = grab_children_from_sequence(full_seq, field)
-                cname = name.replace(child_prefix, '')
-                ast[cname] = nodesequence_to_ast(children, fullseq=full_seq,
-                                                 nodes_hit=nodes_hit)
-                nodes_hit += field
+            if not name.startswith(child_prefix):
+                ast[name] = field
                 continue
-            ast[name] = field
-            nodes_hit.extend(node['t_i'])
-    return ast
+            # we've found edges to children
+            children = []
+            for child_t in field:
+                if child_t not in built:
+                    raise ValueError('Node %s refers to a missing node %s'
+                                     % (t, child_t))
+                children.append(built.pop(child_t))
+            cname = name[len(child_prefix):]
+            if cname in arrays:
+                ast[cname] = children
+            elif len(children) == 1:
+                ast[cname] = children[0]
+            else:
+                raise ValueError('Node %s has %d %s children'
+                                 % (t, len(children), cname))
+        built[t] = pycp_complete_dict(ast)
+    return built[seq[0]['t_i']]
 
 
 def nodesequence_to_ctext(seq):
@@ -156,122 +249,525 @@ def nodesequence_to_ctext(seq):
     return c_text
 
 
-def nodesequence_to_tokens(seq, v=None):
+def features_to_nodesequence(features, t0=0, child_prefix='_children_'):
     """
-        Uses the sklearn DictVectorizer to convert AST sequences to
-        sequences of tokens (hashes for the features in the dictionaries)
+        Inverse of NodeTokenEncoder.node_features over a whole sequence:
+        rebuild the node dicts from a flat list of feature=value strings,
+        e.g. the tokens generated by a model. Every '_nodetype' feature
+        starts a new node, list elements (key0, key1, ...) are collected
+        back into lists and relative child edges are made absolute again.
+        Features before the first node or without a '=' are skipped.
     """
-    tokens = []
-    if not v:
-        v = DictVectorizer(sparse=False)
-    for node in seq:
-        uw_node = {}
+    seq = []
+    node = None
+    for feature in features:
+        key, sep, value = feature.partition('=')
+        if not sep:
+            continue
+        if key == '_nodetype':
+            node = {'_nodetype': value, 't_i': t0 + len(seq)}
+            seq.append(node)
+            continue
+        if node is None:
+            continue
+        match = RE_LIST_FEATURE.match(key)
+        if match is None:
+            node[key] = None if value == 'None' else value
+            continue
+        key = match.group(1)
+        if key.startswith(child_prefix):
+            try:
+                value = node['t_i'] + int(value)
+            except ValueError:
+                continue
+        node.setdefault(key, []).append(value)
+    return seq
+
+
+class NodeTokenEncoder():
+    """
+        Encode AST node sequences as sequences of integer tokens, one token
+        per feature=value pair of each node. Lists are unwrapped like
+        DictVectorizer does (key0, key1, ...), and child edges are encoded
+        relative to the node (e.g. _children_body0=+1) so the same subtree
+        shape gives the same tokens wherever it occurs. Fields in ignore
+        (by default the absolute t_i and the file coordinates) are skipped.
+
+        With n_features=None every feature=value pair gets a stable global
+        id from a single shared vocabulary, which grows as new pairs are
+        seen unless the encoder is frozen (e.g. after fit). Otherwise pairs
+        are hashed into n_features buckets with crc32, which needs no
+        vocabulary at all.
+
+        Fit once and transform many:
+            encoder = NodeTokenEncoder().fit(seqs)
+            tokens = encoder.transform(seq)  # int32 array
+    """
+    def __init__(self, n_features=None, ignore=('t_i', 'coord'),
+                 child_prefix='_children_'):
+        self.n_features = n_features
+        self.ignore = set(ignore)
+        self.child_prefix = child_prefix
+        self.vocabulary_ = {}
+        self.feature_names_ = []
+        self.frozen = False
+        self.n_unknown = 0
+
+    def node_features(self, node):
+        """ The feature=value strings of a single node """
+        features = []
+        t = node.get('t_i', 0)
         for key, val in node.items():
+            if key in self.ignore:
+                continue
             if type(val) is list:
+                relative = key.startswith(self.child_prefix)
                 for i, e in enumerate(val):
-                    uw_node["%s%d" % (str(key), i)] = e
+                    if relative:
+                        e = '%+d' % (e - t)
+                    features.append('%s%d=%s' % (key, i, e))
             else:
-                uw_node[key] = val
-        node_transform = v.fit_transform(uw_node)
-        tokens.append(list(node_transform))
+                features.append('%s=%s' % (key, val))
+        return features
+
+    def _feature_id(self, feature, grow):
+        if self.n_features is not None:
+            return (zlib.crc32(feature.encode('utf-8')) & 0xffffffff) \
+                % self.n_features
+        idx = self.vocabulary_.get(feature)
+        if idx is None and grow:
+            idx = len(self.feature_names_)
+            self.vocabulary_[feature] = idx
+            self.feature_names_.append(feature)
+        return idx
+
+    def _encode(self, seq, grow):
+        if isinstance(seq, CNode):
+            # a tree (see pycp_to_cnode) is encoded as it is flattened
+            seq = iter_cnode_sequence(seq)
+        ids = []
+        for node in seq:
+            for feature in self.node_features(node):
+                idx = self._feature_id(feature, grow)
+                if idx is None:
+                    self.n_unknown += 1
+                    continue
+                ids.append(idx)
+        return np.array(ids, dtype=np.int32)
+
+    def fit(self, seqs):
+        """ Add the features of every sequence in seqs, then freeze """
+        for seq in seqs:
+            self._encode(seq, grow=True)
+        self.frozen = True
+        return self
+
+    def transform(self, seq):
+        """
+            Encode one sequence (or the CNode tree it would be flattened
+            from). Unless the encoder is frozen, new features
+            are added to the vocabulary; otherwise they are dropped and
+            counted in n_unknown.
+        """
+        return self._encode(seq, grow=not self.frozen)
+
+    def fit_transform(self, seq):
+        return self._encode(seq, grow=True)
+
+    def inverse_transform(self, ids):
+        """
+            The node sequence of a sequence of token ids, e.g. generated by
+            a model (see features_to_nodesequence). Ids outside the
+            vocabulary are skipped. Hashed features can not be inverted.
+        """
+        if self.n_features is not None:
+            raise ValueError('Hashed features can not be decoded')
+        names = self.feature_names_
+        return features_to_nodesequence([names[i] for i in ids
+                                         if 0 <= i < len(names)],
+                                        child_prefix=self.child_prefix)
+
+    def get_feature_names(self):
+        if self.n_features is not None:
+            return [str(i) for i in range(self.n_features)]
+        return list(self.feature_names_)
+
+
+def nodesequence_to_tokens(seq, v=None):
+    """
+        Uses a NodeTokenEncoder to convert an AST sequence to an int32 array
+        of tokens (ids of the feature=value pairs of its nodes).
+        Pass the same encoder for every sequence so that ids are shared.
+    """
+    if not v:
+        v = NodeTokenEncoder()
+    tokens = v.transform(seq)
     return tokens, v
 
 
+def _load_nodesequences(paths):
+    for path in paths:
+        with open(path, "r") as json_file:
+            yield json.load(json_file)
+
+
 def nodesequences_to_tokens(header='', data_dir='.', save=True,
                             save_dir=None, delimiter=' ',
                             in_ext=".json",
                             out_ext=".hash",
-                            recurse=0, v=None):
+                            recurse=0, v=None,
+                            buffer_size=DEFAULT_BUFFER_SIZE,
+                            fit_first=False, corpus_filename=None,
+                            nodeseq_filename=None):
     """
         Recursively parses a subdirectory, converting sequences to token hashes
+
+        All files share one NodeTokenEncoder (v), so token ids are stable
+        across nodes and files. With fit_first=True the encoder is fitted on
+        every file first and then frozen, and the second pass only
+        transforms. A frozen encoder passed as v is used as is.
+
+        If corpus_filename is given, the tokens of all files are also
+        written to a single binary corpus (see ganapg_corpus), one entry
+        per file in walk order.
+
+        If nodeseq_filename is given, the sequences are read from that
+        columnar corpus (see ganapg_nodeseq) instead of from the in_ext
+        json files, and each output is named as if it was read from the
+        json file of its program's c file (a.c gives a.seq.hash).
     """
     if not v:
-        v = DictVectorizer(sparse=False)
+        v = NodeTokenEncoder()
     all_tokens = []
-    walk = os.walk(data_dir)
-    i = 0
-    with progressbar.ProgressBar(max_value=8000) as bar:
-        for root, dirnames, filenames in walk:
-            for j, filename in enumerate(filenames):
-                bar.update(i)
-                if os.path.splitext(filename)[1] == in_ext:
-                    i += 1
-                    in_path = os.path.join(root, filename)
-                    if save_dir is None:
-                        out_path = in_path
-                    else:
-                        if not os.path.exists(save_dir):
-                            os.mkdir(save_dir)
-                        out_path = os.path.join(save_dir, filename)
-                    out_path = out_path.replace(in_ext, out_ext)
-                    with open(in_path, "r") as json_file:
-                        seq = json.load(json_file)
-                    tokens, v = nodesequence_to_tokens(seq, v=v)
-                    if save:
-                        with open(out_path, 'w') as file:  # flush with header
-                            file.write(header)
-                        with open(out_path, 'a') as file:
-                            flattokens = [str(item)
-                                          for sublist in tokens
-                                          for subsublist in sublist
-                                          for item in subsublist]
-                            file.write(delimiter.join(flattokens) + '\n')
-                    all_tokens.append(tokens)
+    paths = []
+    nodeseqs = None
+    if nodeseq_filename:
+        nodeseqs = NodeSequenceReader(nodeseq_filename)
+        # the names the json files of cfiles_to_nodesequences have
+        paths = [os.path.splitext(name)[0] + '.seq' + in_ext
+                 for name in nodeseqs.names()]
+    else:
+        paths = scan_files(data_dir, in_ext)
+    if fit_first and not v.frozen:
+        print('Fitting AST token encoder')
+        v.fit(nodeseqs if nodeseqs is not None
+              else _load_nodesequences(paths))
+    corpus = None
+    if corpus_filename:
+        corpus = CorpusWriter(corpus_filename, buffer_size=buffer_size)
+    seqs = nodeseqs if nodeseqs is not None else _load_nodesequences(paths)
+    try:
+        with progressbar.ProgressBar(max_value=max(8000, len(paths))) as bar:
+            for i, (in_path, seq) in enumerate(zip(paths, seqs)):
+                bar.update(i + 1)
+                if save_dir is None:
+                    out_path = in_path
+                else:
+                    if not os.path.exists(save_dir):
+                        os.mkdir(save_dir)
+                    out_path = os.path.join(save_dir,
+                                            os.path.basename(in_path))
+                out_path = out_path[:-len(in_ext)] + out_ext
+                tokens, v = nodesequence_to_tokens(seq, v=v)
+                if save:
+                    with BufferedWriter(out_path,
+                                        buffer_size=buffer_size) as file:
+                        file.write(header)
+                        file.write(delimiter.join([str(t) for t in tokens]))
+                        file.write('\n')
+                if corpus is not None:
+                    corpus.append(tokens)
+                all_tokens.append(tokens)
+    except Exception:
+        if corpus is not None:
+            corpus.discard()
+        raise
+    if corpus is not None:
+        corpus.close()
     return all_tokens, v
 
 
-def cfile_to_nodesequence(c_filename):
+_worker_vocab = None
+
+
+def _init_decode_worker(vocab):
+    """ Pool initializer, sets the vocabulary once per worker process """
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def tokens_to_ctext(tokens, vocab=None):
+    """
+        C text of one generated program, given as a list of feature=value
+        tokens, or of ids into vocab (a list of feature names, e.g. the
+        lines of the AST vocabulary file). The program is returned on one
+        line.
+    """
+    if vocab is not None:
+        ids = [int(token) for token in tokens if token.isdigit()]
+        tokens = [vocab[i] for i in ids if i < len(vocab)]
+    c_text = nodesequence_to_ctext(features_to_nodesequence(tokens))
+    return c_text.replace('\n', ' ').strip()
+
+
+def _decode_unit(lines):
     """
-        Implements pycparser's parse_file and dictionary conversion
+        Worker for predictions_to_ctext, decodes one chunk of lines.
+        Returns the C text of each line, or None if it could not be
+        decoded.
+    """
+    results = []
+    for line in lines:
+        try:
+            results.append(tokens_to_ctext(line.split(), _worker_vocab))
+        except Exception:
+            # generated programs are often not valid trees
+            results.append(None)
+    return results
+
+
+def predictions_to_ctext(in_filename, out_filename, vocabfile=None,
+                         workers=1, chunk_lines=256,
+                         buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+        Turn every line of a predictions file of an AST model back into C.
+        Lines are space separated feature=value tokens, or token ids if
+        the AST vocabulary file (written by the seqtok step) is given.
+        Writes one program per line to out_filename, aligned with the
+        predictions, and an empty line for each prediction which is not a
+        valid tree. Chunks of chunk_lines lines are decoded in a pool of
+        workers processes if workers > 1.
+        Returns the number of lines and the (0 based) numbers of the lines
+        which failed to decode.
+    """
+    vocab = None
+    if vocabfile is not None:
+        with open(vocabfile, 'r') as file:
+            vocab = [word.strip() for word in file]
+    n_lines = 0
+    failed = []
+    with open(in_filename, 'r') as in_file, \
+            BufferedWriter(out_filename, buffer_size=buffer_size) as out_file:
+        results = run_units(_decode_unit, chunks(in_file, chunk_lines),
+                            workers=workers,
+                            initializer=_init_decode_worker,
+                            initargs=(vocab,))
+        try:
+            for c_texts in results:
+                for c_text in c_texts:
+                    if c_text is None:
+                        failed.append(n_lines)
+                        c_text = ''
+                    out_file.write(c_text + '\n')
+                    n_lines += 1
+        finally:
+            results.close()
+    return n_lines, failed
+
+
+def fake_libc_path(pycparser_dir=PYCPARSER_DIR):
+    """ Absolute path of pycparser's fake libc headers """
+    return os.path.abspath(os.path.join(pycparser_dir, 'utils',
+                                        'fake_libc_include'))
+
+
+def cfile_to_nodesequence(c_filename, fake_libc_include=None):
+    """
+        Implements pycparser's parse_file and CNode conversion
         in combination with the custom conversion functions
-        in order to convert c code into a sequence of nodes.
+        in order to convert c code into a sequence of nodes. The parsed
+        tree is flattened straight from its CNodes, without the nested
+        dict form of pycp_to_dict.
+
+        fake_libc_include is the include path for pycparser's fake libc
+        headers. Passing it as an absolute path means the caller does not
+        have to change into the pycparser directory.
     """
+    if fake_libc_include is None:
+        fake_libc_include = fake_libc_path()
     try:
         ast = parse_file(c_filename, use_cpp=True,
                          cpp_path='gcc',
-                         cpp_args=['-E', r'-Iutils/fake_libc_include'])
-        ast_dict = pycp_to_dict(ast)
-        seq, t_n = ast_to_nodesequence(ast_dict)
-        return seq, t_n
-    except ParseError:
+                         cpp_args=['-E', '-I%s' % fake_libc_include])
+        seq = list(iter_cnode_sequence(pycp_to_cnode(ast)))
+        return seq, len(seq) - 1
+    except (ParseError, RuntimeError):
+        # RuntimeError is raised by parse_file if the preprocessor fails
         return None, False
 
 
+def _nodesequence_unit(unit):
+    """ Worker for _parse_cfiles, unpacks a single work unit """
+    c_filename, fake_libc_include = unit
+    seq, _ = cfile_to_nodesequence(c_filename,
+                                   fake_libc_include=fake_libc_include)
+    return c_filename, seq
+
+
+def _parse_cfiles(c_filenames, workers=1, fake_libc_include=None,
+                  chunksize=4, executor=PROCESS):
+    """
+        Parse c files, serially or in a pool of workers, yielding
+        (filename, seq) in the order of c_filenames. seq is None for files
+        which failed to parse.
+    """
+    if fake_libc_include is None:
+        fake_libc_include = fake_libc_path()
+    units = [(c_filename, fake_libc_include) for c_filename in c_filenames]
+    return run_units(_nodesequence_unit, units, workers=workers,
+                     executor=executor, chunksize=chunksize)
+
+
+def iter_cfiles_nodesequences(c_filenames, workers=1, fake_libc_include=None,
+                              failures=None, chunksize=4, executor=PROCESS):
+    """
+        Stream (filename, seq) for each of the c_filenames which parses,
+        in order. Files are parsed in a pool of workers processes if
+        workers > 1. The names of files which fail to parse are appended to
+        failures, if a list is given.
+    """
+    for c_filename, seq in _parse_cfiles(c_filenames, workers=workers,
+                                         fake_libc_include=fake_libc_include,
+                                         chunksize=chunksize,
+                                         executor=executor):
+        if seq is None:
+            if failures is not None:
+                failures.append(c_filename)
+            continue
+        yield c_filename, seq
+
+
+def _is_saved(manifest, in_path, old_corpus):
+    """
+        Whether the sequence of an unchanged file can be loaded: from its
+        json file, or else from the corpus of the last run, which must be
+        the one it was written into and still hold it
+    """
+    if manifest.outputs(in_path) or not manifest.shared(in_path):
+        return True
+    if old_corpus is None or manifest.shared(in_path) != [old_corpus.path]:
+        return False
+    try:
+        old_corpus.index(in_path)
+    except KeyError:
+        return False
+    return True
+
+
 def cfiles_to_nodesequences(header='', data_dir='.', save=True,
                             save_dir=None, delimiter=',',
-                            out_ext=".seq.json", recurse=0, maxfiles=8000):
+                            out_ext=".seq.json", recurse=0, maxfiles=8000,
+                            incremental=False, manifest_name=AST_MANIFEST,
+                            workers=1, pycparser_dir=PYCPARSER_DIR,
+                            corpus_filename=None, json_files=True,
+                            executor=PROCESS):
     """
         Given a directory, parse through all of the c files and convert them
-        into sequences. Optionally write these sequences to json files.
+        into sequences. Optionally write these sequences to json files
+        (json_files), and/or to one columnar corpus at corpus_filename (see
+        ganapg_nodeseq), where each program is named by its c file.
+
+        With incremental=True (and save=True), a FileManifest stored in
+        save_dir (or data_dir) is used to only parse files which are new
+        or changed since the last run; the saved sequences of the other files
+        are loaded instead, from their json file or else from the corpus of
+        the last run. The json files of removed source files are deleted;
+        the corpus is shared by all files and is rewritten instead.
+
+        With workers > 1 the files are parsed in a pool of processes (or
+        threads, see ganapg_walk.run_units). Results are collected in walk
+        order, so the output is the same as a serial run.
     """
-    cwd = os.getcwd()
+    units = []
+    manifest = None
+    old_corpus = None
+    if corpus_filename and os.path.exists(corpus_filename):
+        # Sequences of unchanged files can be read back from the last run
+        old_corpus = NodeSequenceReader(corpus_filename)
+    if incremental and save:
+        fake_libc = fake_libc_path(pycparser_dir)
+        fingerprint = step_fingerprint(
+            cfiles_to_nodesequences, out_ext=out_ext,
+            pycparser=pycparser.__version__,
+            fake_libc=tree_fingerprint(fake_libc))
+        manifest = FileManifest(os.path.join(save_dir or data_dir,
+                                             manifest_name),
+                                fingerprint=fingerprint)
+    for in_path in scan_files(data_dir, '.c'):
+        if save_dir is None:
+            out_path = in_path
+        else:
+            out_path = os.path.join(save_dir, os.path.basename(in_path))
+        out_path = os.path.splitext(out_path)[0] + out_ext
+        units.append((in_path, out_path))
+
+    todo = units
+    if manifest is not None:
+        todo = [unit for unit in units
+                if manifest.is_changed(unit[0]) or
+                not _is_saved(manifest, unit[0], old_corpus)]
+    todo_paths = set([unit[0] for unit in todo])
+    results = _parse_cfiles([in_path for in_path, _ in todo],
+                            workers=workers,
+                            fake_libc_include=fake_libc_path(pycparser_dir),
+                            executor=executor)
 
     seqs = []
-    walk = os.walk(data_dir)
-    i = 0
-    with progressbar.ProgressBar(max_value=maxfiles) as bar:
-        for root, dirnames, filenames in walk:
-            for filename in filenames:
-                os.chdir('../pycparser/')
-                if os.path.splitext(filename)[1] == '.c':
-                    in_path = os.path.join(root, filename)
-                    if save_dir is None:
-                        out_path = in_path
+    failures = 0
+    max_value = max(maxfiles, len(units))
+    corpus = None
+    if corpus_filename and save:
+        corpus = NodeSequenceWriter(corpus_filename)
+    try:
+        with progressbar.ProgressBar(max_value=max_value) as bar:
+            for i, (in_path, out_path) in enumerate(units):
+                bar.update(i + 1)
+                if in_path not in todo_paths:
+                    # Unchanged since the last incremental run
+                    outputs = manifest.outputs(in_path)
+                    if outputs:
+                        with open(outputs[0], 'r') as file:
+                            seq = json.load(file)
+                    elif manifest.shared(in_path):
+                        seq = old_corpus[old_corpus.index(in_path)]
                     else:
-                        out_path = os.path.join(save_dir, filename)
-                    out_path = out_path.replace('.c', out_ext)
-                    seq, t_n = cfile_to_nodesequence(in_path)
-                    i += 1
-                    if seq is None:
+                        # failed to parse
                         continue
-                    if save:
-                        os.chdir(cwd)
-                        # allow json saving of dictionary
-                        with open(out_path, 'w') as file:
-                            json.dump(seq, file)
-                    os.chdir(cwd)
+                    if corpus is not None:
+                        corpus.append(seq, name=in_path)
                     seqs.append(seq)
-                    bar.update(i)
-                os.chdir(cwd)
+                    continue
+                _, seq = next(results)
+                if seq is None:
+                    failures += 1
+                    if manifest is not None:
+                        manifest.update(in_path, outputs=[])
+                    continue
+                outputs = []
+                shared = []
+                if save and json_files:
+                    # allow json saving of dictionary
+                    with open(out_path, 'w') as file:
+                        json.dump(seq, file)
+                    outputs.append(out_path)
+                if corpus is not None:
+                    corpus.append(seq, name=in_path)
+                    shared.append(corpus_filename)
+                if manifest is not None:
+                    manifest.update(in_path, outputs=outputs, shared=shared)
+                seqs.append(seq)
+    except BaseException:
+        if corpus is not None:
+            corpus.discard()
+        raise
+    finally:
+        results.close()
+    if corpus is not None:
+        corpus.close()
 
+    if failures:
+        print('%d of %d cfiles failed to parse' % (failures, len(todo)))
+    if manifest is not None:
+        manifest.remove_missing()
+        manifest.save()
     return seqs
@@ -1,60 +1,32 @@
-import ganapg_preprocess_tokens as gtok
-import ganapg_vocabulary as gvoc
-import ganapg_preprocess_ast as gast
 import ganapg_config as cfg
+from ganapg_pipeline import Pipeline, MODEL_STEPS
 
 
 class PreprocPipeline():
-
-    default_steps = ['obfuscate',
-                     'symbols',
-                     'posneg',
-                     'vocabgen',
-                     'vocabhash'
-                     ]
+    """
+        Runs only the preprocessing steps of a config, through the step
+        graph of Pipeline (see Pipeline.plan).
+    """
 
     default_data_dir = '/home/bbradt/AGAN/data/codeflaws/'
 
-    def __init__(self, method='cf_tokens_seqgan', data_dir=default_data_dir):
+    def __init__(self, method='cf_tokens_seqgan', data_dir=default_data_dir,
+                 steps=None):
+        self.method = method
         self.m = getattr(cfg, method)
         self.data_dir = data_dir
+        self.steps = steps
+        if self.steps is None:
+            self.steps = [s for s in self.m['steps'] if s not in MODEL_STEPS]
 
-    def run(self):
-        #  Run with default parameters for codeflaws with seqgan
-        for step in self.steps:
-            if step is 'obfuscate':
-                print('Obfuscating cfiles')
-                gtok.obfuscate_cfiles(data_dir=self.data_dir,
-                                      recurse=1, save_dir='./obfuscated_c/',
-                                      save=True)
-            elif step is 'symbols':
-                print('Converting symbols to tokens')
-                gtok.convert_cfiles_symbols(data_dir='./cf_obfs/',
-                                            save_dir='./cf_nosym/',
-                                            save=True)
-            elif step is 'posneg':
-                print('Creating positive/negative splits')
-                gtok.codeflaws_posneg(data_dir='./cf_nosym/',
-                                      save_dir='./cf_posneg/',
-                                      save=True)
-            elif step is 'vocabgen':
-                print('Generating vocabulary')
-                gvoc.generate_vocab_to_file(data_dir='./cf_posneg/',
-                                            save_dir='./cf_vocab/',
-                                            save=True)
-            elif step is 'vocabhash':
-                print('Hashing codeflaws files')
-                gvoc.hash_files(data_dir='./cf_posneg/',
-                                vocabfile='./cf_vocab/vocab.txt',
-                                save_dir='./cf_hashed/')
-            elif step is 'astseq':
-                print('Generating AST sequences')
-                gast.cfiles_to_nodesequences(data_dir=self.method['data_dir'],
-                                             save_dir=self.method['save_dirs']
-                                             [step],
-                                             save=self.method['save'])
+    def run(self, step_workers=None):
+        skip = [s for s in self.m['steps'] if s not in self.steps]
+        pipeline = Pipeline(method=self.method, skip=skip,
+                            data_dir=self.data_dir)
+        pipeline.run(step_workers=step_workers)
+        return pipeline
 
 
 if __name__ == '__main__':
     PP = PreprocPipeline()
-    PP.cf_run()
+    PP.run()
@@ -17,16 +17,157 @@ import os
 import subprocess
 import re
 from sklearn.model_selection import train_test_split
-from ganapg_util import json_to_dict, pad_string
+from ganapg_util import pad_string
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+from ganapg_symbols import SymbolTranslator, get_translator
+from ganapg_symbols import get_inverse_translator
+from ganapg_cache import FileManifest, step_fingerprint, file_hash
+from ganapg_walk import scan_files, scan_tree, run_units, PROCESS
+from ganapg_walk import shard_filename, is_shard
 
+OBFS_MANIFEST = '.obfuscate.manifest'
+SYMBOLS_MANIFEST = '.symbols.manifest'
 
-def obfuscate_cfile(c_file, out_path, gcc_path='/usr/bin/gcc'):
-    if os.path.exists(gcc_path):
+
+CGC_POS_LABELS = 'pos_labels.txt'
+CGC_NEG_LABELS = 'neg_labels.txt'
+CGC_PATCHED_RE = re.compile(r'^\s*#\s*(ifdef|ifndef)\s+(PATCHED\w*)\s*$|'
+                            r'^\s*#\s*(if|elif)\s+(!?)\s*defined\s*\(?\s*'
+                            r'(PATCHED\w*)\s*\)?\s*$')
+C_DIRECTIVE_RE = re.compile(r'^\s*#\s*(if|ifdef|ifndef|elif|else|endif)\b')
+CWE_RE = re.compile(r'CWE-\d+')
+C_SPECIAL_RE = re.compile(r'["\'/]')
+C_INCLUDE_RE = re.compile(r'^\s*#\s*include\b')
+C_INCLUDE_LINE_RE = re.compile(r'^[ \t]*#[ \t]*include\b.*$',
+                               flags=re.MULTILINE)
+
+
+def _is_spliced(line):
+    """ True if line ends with a backslash-newline (a line splice) """
+    return line.rstrip('\r\n').endswith('\\') and line.endswith('\n')
+
+
+def _skip_c_literal(line, i, quote=None):
+    """
+        Given the index of an opening quote in line, return the index just
+        past the matching closing quote (or the end of the line), and the
+        quote if the literal continues on the next line through a line
+        splice (None otherwise). With quote given, i is already inside a
+        literal opened by that quote on an earlier line.
+    """
+    if quote is None:
+        quote = line[i]
+        i += 1
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == quote:
+            return i, None
+    return n, quote if _is_spliced(line) else None
+
+
+def strip_c_stream(lines, strip_includes=True):
+    """
+        Pure python alternative to running gcc -fpreprocessed over a file.
+        A small streaming lexer which removes block and line comments, and
+        optionally #include directives, in a single pass over an iterable of
+        lines. String and character literals are copied untouched, so comment
+        markers and quotes inside them are not mistaken for code.
+        Comments are replaced by a single space, as gcc does. Line splices
+        (a backslash at the end of a line) are followed, so a // comment or
+        a literal ending in one carries on over the next line.
+    """
+    in_comment = False
+    in_include = False
+    in_line_comment = False
+    literal = None
+    for line in lines:
+        if in_include or in_line_comment:
+            # continuation of an #include directive or a // comment
+            in_include = in_include and _is_spliced(line)
+            in_line_comment = in_line_comment and _is_spliced(line)
+            yield '\n' if line.endswith('\n') else ''
+            continue
+        if (strip_includes and not in_comment and literal is None and
+                C_INCLUDE_RE.match(line)):
+            in_include = _is_spliced(line)
+            yield ' \n'
+            continue
+        out = []
+        i = 0
+        n = len(line)
+        if literal is not None:
+            i, literal = _skip_c_literal(line, 0, quote=literal)
+            out.append(line[:i])
+        while i < n:
+            if in_comment:
+                end = line.find('*/', i)
+                if end < 0:
+                    i = n
+                    break
+                in_comment = False
+                out.append(' ')
+                i = end + 2
+                continue
+            match = C_SPECIAL_RE.search(line, i)
+            if match is None:
+                out.append(line[i:])
+                break
+            j = match.start()
+            out.append(line[i:j])
+            c = line[j]
+            if c == '/':
+                nxt = line[j + 1:j + 2]
+                if nxt == '*':
+                    in_comment = True
+                    i = j + 2
+                elif nxt == '/':
+                    out.append(' ')
+                    if line.endswith('\n'):
+                        out.append('\n')
+                    in_line_comment = _is_spliced(line)
+                    i = n
+                else:
+                    out.append(c)
+                    i = j + 1
+            else:
+                end, literal = _skip_c_literal(line, j)
+                out.append(line[j:end])
+                i = end
+        if in_comment and line.endswith('\n'):
+            out.append('\n')
+        yield ''.join(out)
+
+
+def strip_c_text(c_text, strip_includes=True):
+    """ Run strip_c_stream over a whole string """
+    return ''.join(strip_c_stream(c_text.splitlines(True),
+                                  strip_includes=strip_includes))
+
+
+def obfuscate_cfile(c_file, out_path, gcc_path='/usr/bin/gcc', method='gcc'):
+    """
+        Strip comments and include statements from a c file, and place all
+        of its code on one line.
+
+        method selects how comments are removed:
+            'gcc'    - run gcc -fpreprocessed over the file (if gcc exists)
+            'python' - use the in-process lexer strip_c_stream, which avoids
+                       spawning a process per file
+    """
+    if method == 'python':
+        with open(c_file, "r") as file:
+            c_text = ''.join(strip_c_stream(file))
+    elif os.path.exists(gcc_path):
         try:
             # Use GCC to remove comments, if gcc is available
-            gcc_cmd = ('%s -fpreprocessed -dD -E %s'
-                       % (gcc_path, c_file))
-            c_text = subprocess.check_output(gcc_cmd, shell=True)
+            gcc_cmd = [gcc_path, '-fpreprocessed', '-dD', '-E', c_file]
+            c_text = subprocess.check_output(gcc_cmd)
+            c_text = c_text.decode('utf-8', 'replace')
         except subprocess.CalledProcessError:
             with open(c_file, "r") as file:
                 c_text = file.read()
@@ -35,8 +176,13 @@ def obfuscate_cfile(c_file, out_path, gcc_path='/usr/bin/gcc'):
         with open(c_file, "r") as file:
             c_text = file.read()
 
+    return flatten_c_text(c_text)
+
+
+def flatten_c_text(c_text):
+    """ Remove include statements and place all code on one line """
     # Remove all include statements
-    c_text = re.sub('#include.*>', ' ', str(c_text), flags=re.DOTALL)
+    c_text = C_INCLUDE_LINE_RE.sub(' ', c_text)
 
     # Place all code on one line
     c_text = str(c_text).strip().replace('\n', '').replace('\t', '')
@@ -44,37 +190,86 @@ def obfuscate_cfile(c_file, out_path, gcc_path='/usr/bin/gcc'):
     return c_text
 
 
+def _obfuscate_unit(unit):
+    """ Worker for obfuscate_cfiles, unpacks a single work unit """
+    in_path, out_path, gcc_path, method = unit
+    return obfuscate_cfile(in_path, out_path=out_path, gcc_path=gcc_path,
+                           method=method)
+
+
 def obfuscate_cfiles(data_dir='.', extension='.obfs', save=False,
-                     gcc_path='/usr/bin/gcc',  save_dir=None, recurse=0):
+                     gcc_path='/usr/bin/gcc',  save_dir=None, recurse=0,
+                     workers=1, chunksize=16, method='gcc',
+                     incremental=False, manifest_name=OBFS_MANIFEST,
+                     executor=PROCESS):
     """
         Recursively obfuscate c files in a directory by placing all code on
         one line, removing include statements, and removing comments.
         This simplifies data assembly and processing by allowing one instance
         (one c-file) on one line in the training and testing sets.
+
+        With workers > 1 the files are fanned out to a pool of processes
+        (or threads, see ganapg_walk.run_units). Results are streamed back
+        in walk order, so the returned c_texts (and the written files) are
+        the same as for a serial run.
+
+        method is passed to obfuscate_cfile ('gcc' or 'python').
+
+        With incremental=True (and save=True), a FileManifest stored in
+        save_dir (or data_dir) is used to only obfuscate files which are new
+        or changed since the last run; the saved outputs of the other files
+        are read back. Outputs of source files which were removed are
+        deleted.
     """
-    walk = os.walk(data_dir)
+    if save_dir and not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+    units = []
+    for in_path in scan_files(data_dir, '.c'):
+        if save_dir:
+            out_path = os.path.join(save_dir, os.path.basename(in_path))
+        else:
+            out_path = in_path
+        # Replace the file extension to avoid duplication in data
+        out_path = os.path.splitext(out_path)[0] + extension
+        units.append((in_path, out_path, gcc_path, method))
+
+    manifest = None
+    todo = units
+    if incremental and save:
+        fingerprint = step_fingerprint(obfuscate_cfiles, method=method,
+                                       gcc_path=gcc_path,
+                                       extension=extension)
+        manifest = FileManifest(os.path.join(save_dir or data_dir,
+                                             manifest_name),
+                                fingerprint=fingerprint)
+        todo = [unit for unit in units
+                if manifest.is_changed(unit[0])]
+        print('Obfuscating %d of %d cfiles' % (len(todo), len(units)))
+    todo_paths = set([unit[0] for unit in todo])
+
     c_texts = []
-    for root, dirnames, filenames in walk:
-        for filename in filenames:
-            if os.path.splitext(filename)[1] == '.c':
-                in_path = os.path.join(root, filename)
-                if save_dir:
-                    if not os.path.exists(save_dir):
-                        os.mkdir(save_dir)
-                    out_path = os.path.join(save_dir, filename)
-                else:
-                    out_path = in_path
-                # Replace the file extension to avoid duplication in data
-                out_path = out_path.replace('.c', extension)
-
-                c_text = obfuscate_cfile(in_path, out_path=out_path,
-                                         gcc_path=gcc_path)
-
-                # Write to file
-                if save:
-                    with open(out_path, 'w') as f:
-                        f.write(c_text)
-                c_texts.append(c_text)
+    results = run_units(_obfuscate_unit, todo, workers=workers,
+                        executor=executor, chunksize=chunksize)
+    try:
+        for in_path, out_path, _, _ in units:
+            if in_path not in todo_paths:
+                # Unchanged since the last incremental run
+                with open(out_path, 'r') as f:
+                    c_texts.append(f.read())
+                continue
+            c_text = next(results)
+            # Write to file
+            if save:
+                with open(out_path, 'w') as f:
+                    f.write(c_text)
+            if manifest is not None:
+                manifest.update(in_path, outputs=[out_path])
+            c_texts.append(c_text)
+    finally:
+        results.close()
+    if manifest is not None:
+        manifest.remove_missing()
+        manifest.save()
     return c_texts
 
 
@@ -83,26 +278,17 @@ def traintest_split(data_dir='.', in_extension='.obfs',
                     save=True, trainfile='train', testfile='target', recurse=0,
                     testsize=0.1):
     """
-        Implements the sklearn train_test_split function in a recursive fashion
+        Implements the sklearn train_test_split function over every file
+        with in_extension below data_dir
 
     """
-    walk = os.walk(data_dir)
     all_data = []
-    for root, dirnames, filenames in walk:
-        if recurse:
-            # Until the recursion level is 0, go through all child dirs
-            for dirname in dirnames:
-                all_data += traintest_split(data_dir=dirname,
-                                            in_extension=in_extension,
-                                            recurse=recurse - 1)
-        for filename in filenames:
-            if os.path.splitext(filename)[1] == in_extension:
-                in_path = os.path.join(root, filename)
-                with open(in_path, 'r') as file:
-                    text = file.read()
-                    all_data.append(text)
-
-    train, test = train_test_split(all_data, shuffle=True, testsize=testsize)
+    for in_path in scan_files(data_dir, in_extension):
+        with open(in_path, 'r') as file:
+            all_data.append(file.read())
+
+    train, test = train_test_split(all_data, shuffle=True,
+                                   test_size=testsize)
     if save_dir:
         if not os.path.exists(save_dir):
             os.mkdir(save_dir)
@@ -119,9 +305,141 @@ def traintest_split(data_dir='.', in_extension='.obfs',
     return train, test, all_data
 
 
+class AlignedWriter():
+    """
+        Write aligned line files (e.g. pos and neg) one record at a time, so
+        that line i of every file belongs to record i. Each text is written
+        on a single line.
+
+        With shard_size, every file is split into aligned shards kept in a
+        directory named after it (pos/0000, neg/0000, pos/0001, ..., see
+        ganapg_walk.record_files), and a new shard of every file is started
+        once the largest file of the current shard holds shard_size
+        characters. Stale shards of an earlier, larger run are removed on
+        close, as are the shards of an earlier sharded run when writing
+        unsharded (and the other way around).
+    """
+    def __init__(self, filenames, shard_size=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE):
+        self.filenames = list(filenames)
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        self.shard = 0
+        self.n_records = 0
+        self.written = []
+        self.files = []
+        self.sizes = []
+        if shard_size is not None:
+            for filename in self.filenames:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                if not os.path.isdir(filename):
+                    os.makedirs(filename)
+        self._open()
+
+    def _shard_filename(self, filename, shard):
+        if self.shard_size is None:
+            return filename
+        return shard_filename(filename, shard)
+
+    def _open(self):
+        self.files = [BufferedWriter(self._shard_filename(f, self.shard),
+                                     buffer_size=self.buffer_size)
+                      for f in self.filenames]
+        self.sizes = [0] * len(self.files)
+
+    def _close_shard(self):
+        for file in self.files:
+            file.close()
+            self.written.append(file.filename)
+        self.files = []
+
+    def write(self, *texts):
+        if len(texts) != len(self.files):
+            raise ValueError('Expected %d texts, got %d' % (len(self.files),
+                                                            len(texts)))
+        if (self.shard_size is not None and self.n_records and
+                max(self.sizes) >= self.shard_size):
+            self._close_shard()
+            self.shard += 1
+            self._open()
+        for k, text in enumerate(texts):
+            line = ' '.join(text.splitlines()) + '\n'
+            self.files[k].write(line)
+            self.sizes[k] += len(line)
+        self.n_records += 1
+
+    def close(self):
+        if self.shard_size is None:
+            for filename in self.filenames:
+                if os.path.isdir(filename):
+                    # shards of an earlier run, in the way of the file
+                    for name in os.listdir(filename):
+                        if is_shard(name):
+                            os.remove(os.path.join(filename, name))
+                    os.rmdir(filename)
+            self._close_shard()
+            return
+        self._close_shard()
+        for filename in self.filenames:
+            shard = self.shard + 1
+            while os.path.exists(self._shard_filename(filename, shard)):
+                os.remove(self._shard_filename(filename, shard))
+                shard += 1
+
+    def discard(self):
+        for file in self.files:
+            file.discard()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+
+def iter_codeflaws_pairs(data_dir='.', extension='.obfs', skipped=None):
+    """
+        Walk a codeflaws directory and yield
+            (contestid, problem, neg_text, pos_text)
+        for every subject folder which holds both its buggy and its accepted
+        submission. Folders are visited in sorted order, and only one pair
+        is held in memory at a time. Folders whose name does not follow the
+        codeflaws scheme, or which miss either file, are appended to
+        skipped (if given).
+    """
+    for root, dirnames, filenames in scan_tree(data_dir):
+        for dirname in dirnames:
+            parts = dirname.split('-')
+            if len(parts) != 5 or parts[2] != 'bug':
+                if skipped is not None:
+                    skipped.append(os.path.join(root, dirname))
+                continue
+            contestid, problem, _, negid, posid = parts
+            pos_filename = '-'.join([contestid, problem, posid]) + extension
+            neg_filename = '-'.join([contestid, problem, negid]) + extension
+            pospath = os.path.join(root, dirname, pos_filename)
+            negpath = os.path.join(root, dirname, neg_filename)
+            if not (os.path.exists(pospath) and os.path.exists(negpath)):
+                if skipped is not None:
+                    skipped.append(os.path.join(root, dirname))
+                continue
+            with open(negpath, 'r') as file:
+                neg_text = file.read()
+            with open(pospath, 'r') as file:
+                pos_text = file.read()
+            yield contestid, problem, neg_text, pos_text
+
+
 def codeflaws_posneg(header='', data_dir='.', extension='.obfs', save=True,
                             posfile='pos', negfile='neg', recurse=0,
-                            save_dir=None):
+                            save_dir=None, shard_size=None,
+                            return_data=True):
     """
         This preprocessing function uses the codeflaws directory naming scheme
         to split files into separate data sets of positive and negative
@@ -139,133 +457,385 @@ def codeflaws_posneg(header='', data_dir='.', extension='.obfs', save=True,
                 <contestid>-<problem>-<buggy-submisionid>.c
         Accepted submission with name
                 <contestid>-<problem>-<accepted-submisionid>.c "
-    """
-    walk = os.walk(data_dir)
-    posdata = []
-    negdata = []
-    for root, dirnames, filenames in walk:
-        for dirname in dirnames:
-            contestid, problem, _, negid, posid = dirname.split('-')
-            pos_filename = '-'.join([contestid, problem, posid]) + extension
-            neg_filename = '-'.join([contestid, problem, negid]) + extension
-            
-            pospath = os.path.join(root, dirname, pos_filename)
-            negpath = os.path.join(root, dirname, neg_filename)
-            if os.path.exists(pospath):
-                with open(pospath, 'r') as file:
-                    c_text = file.read()
-                    posdata.append(c_text)
-            if os.path.exists(negpath):
-                with open(negpath, 'r') as file:
-                    c_text = file.read()
-                    negdata.append(c_text)
 
+        Pairs are streamed from iter_codeflaws_pairs and written as they
+        are read, so line i of posfile and negfile are always the two
+        halves of the same subject (incomplete subjects are skipped). With
+        shard_size the outputs are split into aligned shards, see
+        AlignedWriter. Returns (posdata, negdata), the texts of the pairs,
+        which are only collected with return_data; without it both lists
+        are empty, and memory does not grow with the corpus.
+    """
     # Write files
     if save_dir:
         if not os.path.exists(save_dir):
             os.mkdir(save_dir)
         posfile = os.path.join(save_dir, posfile)
         negfile = os.path.join(save_dir, negfile)
+    posdata = []
+    negdata = []
+    skipped = []
+    n_pairs = 0
+    writer = None
     if save:
-        with open(posfile, 'w') as file:
-            for instance in posdata:
-                file.write(instance + '\n')
-        with open(negfile, 'w') as file:
-            for instance in negdata:
-                file.write(instance + '\n')
+        writer = AlignedWriter([posfile, negfile], shard_size=shard_size)
+    try:
+        for _, _, neg_text, pos_text in iter_codeflaws_pairs(
+                data_dir, extension=extension, skipped=skipped):
+            if writer is not None:
+                writer.write(pos_text, neg_text)
+            if return_data:
+                posdata.append(pos_text)
+                negdata.append(neg_text)
+            n_pairs += 1
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is not None:
+        writer.close()
+    print('%d pos/neg pairs, %d folders skipped' % (n_pairs, len(skipped)))
     return posdata, negdata
 
 
-def cgc_posneg(header='', data_dir='.', extension='.obfs', save=True,
-               recurse=0, save_dir=None, posfile='pos', negfile='neg'):
+def resolve_patched(c_text, patched):
+    """
+        Resolve the CGC patch conditionals of a source, i.e. blocks under
+            #ifdef PATCHED / #ifndef PATCHED / #if defined(PATCHED_1) ...
+        with every PATCHED* macro defined (patched=True, the fixed program)
+        or undefined (patched=False, the vulnerable one). Other conditionals
+        are kept as they are, unless they sit inside a dropped branch.
+    """
+    out = []
+    # One frame per open conditional: [is_patched, active, taken]
+    stack = []
+    for line in c_text.splitlines(True):
+        directive = C_DIRECTIVE_RE.match(line)
+        visible = all([frame[1] for frame in stack if frame[0]])
+        if directive is None:
+            if visible:
+                out.append(line)
+            continue
+        kind = directive.group(1)
+        match = CGC_PATCHED_RE.match(line)
+        if kind in ('if', 'ifdef', 'ifndef'):
+            if match is None:
+                stack.append([False, True, True])
+                if visible:
+                    out.append(line)
+                continue
+            if match.group(1):
+                active = patched == (match.group(1) == 'ifdef')
+            else:
+                active = patched != (match.group(4) == '!')
+            stack.append([True, active, active])
+            continue
+        if not stack:
+            # unbalanced #else / #endif, keep the line
+            out.append(line)
+            continue
+        frame = stack[-1]
+        if not frame[0]:
+            if kind == 'endif':
+                stack.pop()
+            if all([f[1] for f in stack if f[0]]):
+                out.append(line)
+            continue
+        if kind == 'endif':
+            stack.pop()
+        elif kind == 'else':
+            frame[1] = not frame[2]
+            frame[2] = True
+        elif kind == 'elif':
+            active = True
+            if match is not None and match.group(3) == 'elif':
+                active = patched != (match.group(4) == '!')
+            frame[1] = active and not frame[2]
+            frame[2] = frame[2] or frame[1]
+    return ''.join(out)
+
+
+def read_cgc_labels(filename):
+    """
+        Read a CGC label file, with one source per line:
+            <path relative to the corpus directory> <label> [<label> ...]
+        e.g. "CROMU_00001/src/service.c CWE-121 CWE-122". Blank lines and
+        lines starting with '#' are ignored. Returns an ordered list of
+        (path, labels).
+    """
+    entries = []
+    with open(filename, 'r') as file:
+        for line in file:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            entries.append((fields[0], fields[1:]))
+    return entries
+
+
+def cgc_units(data_dir='.', extension='.c'):
+    """
+        Sources of the CGC corpus, as an ordered list of (path, labels).
+        The sources and labels are read from pos_labels.txt and
+        neg_labels.txt in data_dir if they exist (the labels of a source
+        listed in both are merged). Otherwise every source with extension
+        under each challenge directory which mentions PATCHED is used, with
+        the CWE ids cited in the challenge's README.md as its labels.
+    """
+    label_files = [os.path.join(data_dir, f)
+                   for f in (CGC_NEG_LABELS, CGC_POS_LABELS)]
+    if any([os.path.exists(f) for f in label_files]):
+        labels = {}
+        order = []
+        for label_file in label_files:
+            if not os.path.exists(label_file):
+                continue
+            for path, path_labels in read_cgc_labels(label_file):
+                if path not in labels:
+                    labels[path] = []
+                    order.append(path)
+                labels[path] += [l for l in path_labels
+                                 if l not in labels[path]]
+        return [(os.path.join(data_dir, path), labels[path])
+                for path in order]
+    units = []
+    for challenge in next(scan_tree(data_dir, depth=0))[1]:
+        challenge_dir = os.path.join(data_dir, challenge)
+        readme = os.path.join(challenge_dir, 'README.md')
+        labels = []
+        if os.path.exists(readme):
+            with open(readme, 'r') as file:
+                for cwe in CWE_RE.findall(file.read()):
+                    if cwe not in labels:
+                        labels.append(cwe)
+        for path in scan_files(challenge_dir, extension):
+            with open(path, 'r') as file:
+                if 'PATCHED' not in file.read():
+                    continue
+            units.append((path, labels))
+    return units
+
+
+def cgc_pair(path):
+    """
+        The (neg_text, pos_text) pair of a CGC source: its unpatched and
+        patched variants, each stripped of comments and includes and
+        placed on one line.
+    """
+    with open(path, 'r') as file:
+        c_text = file.read()
+    # Strip comments first, so they can not hide the conditionals
+    c_text = strip_c_text(c_text)
+    neg_text = flatten_c_text(resolve_patched(c_text, False))
+    pos_text = flatten_c_text(resolve_patched(c_text, True))
+    return neg_text, pos_text
+
+
+def _cgc_unit(unit):
+    """ Worker for cgc_posneg, extracts the pair of one source """
+    path, labels = unit
+    try:
+        neg_text, pos_text = cgc_pair(path)
+    except (IOError, OSError, UnicodeDecodeError):
+        return path, labels, None, None
+    return path, labels, neg_text, pos_text
+
+
+def cgc_posneg(header='', data_dir='.', extension='.c', save=True,
+               recurse=0, save_dir=None, posfile='pos', negfile='neg',
+               labelfile='labels.txt', workers=1, chunksize=16,
+               shard_size=None, return_data=True, executor=PROCESS,
+               labels=None):
     """
         This preprocessing function uses the cgc directory README scheme
         to split files into separate data sets of positive and negative
         samples.
 
         We assume no recursion is required, i.e. data_dir points directly to
-        the codeflaws directory.
+        the cgc challenge corpus directory.
 
         We assume there are two .txt files in the direcotry
 
         pos_labels.txt - with the positive CWE labels
         neg_labels.txt - with the negative CWE labels
+
+        (see read_cgc_labels and cgc_units for their format, and for what
+        happens without them). The negative sample of a source is its
+        unpatched variant and the positive its patched one (see
+        resolve_patched). Sources are processed in a pool of workers
+        processes and written as they come, in order, to the aligned
+        posfile, negfile and labelfile (one space separated line of labels
+        per pair). Sources without a patch are skipped.
+        Returns (posdata, negdata) as codeflaws_posneg does, which are only
+        collected with return_data (and empty lists otherwise). If a list
+        is given as labels, the labels of each pair are appended to it.
     """
+    units = cgc_units(data_dir, extension=extension)
+    if save_dir:
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+        posfile = os.path.join(save_dir, posfile)
+        negfile = os.path.join(save_dir, negfile)
+        labelfile = os.path.join(save_dir, labelfile)
     posdata = []
     negdata = []
+    skipped = 0
+    results = run_units(_cgc_unit, units, workers=workers,
+                        executor=executor, chunksize=chunksize)
+    writer = None
+    if save:
+        writer = AlignedWriter([posfile, negfile, labelfile],
+                               shard_size=shard_size)
+    try:
+        for path, pair_labels, neg_text, pos_text in results:
+            if neg_text is None or neg_text == pos_text:
+                skipped += 1
+                continue
+            if writer is not None:
+                writer.write(pos_text, neg_text, ' '.join(pair_labels))
+            if return_data:
+                posdata.append(pos_text)
+                negdata.append(neg_text)
+            if labels is not None:
+                labels.append(pair_labels)
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    finally:
+        results.close()
+    n_pairs = len(units) - skipped
+    if writer is not None:
+        writer.close()
+    print('%d pos/neg pairs, %d sources skipped' % (n_pairs, skipped))
     return posdata, negdata
 
 
+_worker_translator = None
+
+
+def _init_symbols_worker(symbol_json_filename):
+    """ Pool initializer, compiles the translator once per worker """
+    global _worker_translator
+    _worker_translator = get_translator(symbol_json_filename)
+
+
+def _symbols_unit(in_path):
+    """ Worker for convert_cfiles_symbols, converts a single file """
+    return convert_cfile_symbols(in_path, translator=_worker_translator)
+
+
 def convert_cfiles_symbols(data_dir='.', out_extension='.nosym', save=False,
                            save_dir=None, in_extension='',
                            symbol_json_filename="C_SYMBOL_MAP.json",
-                           recurse=0):
-    walk = os.walk(data_dir)
+                           recurse=0, incremental=False,
+                           manifest_name=SYMBOLS_MANIFEST, workers=1,
+                           chunksize=16, executor=PROCESS):
+    """
+        Convert the symbols of every file with in_extension in data_dir,
+        in a pool of workers threads or processes if workers > 1 (in walk
+        order either way).
+
+        Outputs keep their path relative to data_dir under save_dir, so
+        shards (pos/0000, neg/0000, ...) are converted to pos/0000.nosym,
+        neg/0000.nosym, ...
+
+        With incremental=True (and save=True), a FileManifest stored in
+        save_dir (or data_dir) is used to only convert files which are new
+        or changed since the last run; the saved outputs of the other files
+        are read back. Outputs of removed source files are deleted.
+    """
+    if save_dir and not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+    units = []
+    for in_path in scan_files(data_dir, in_extension):
+        if save_dir:
+            out_path = os.path.join(save_dir,
+                                    os.path.relpath(in_path, data_dir))
+        else:
+            out_path = in_path
+        if in_extension:
+            out_path = os.path.splitext(out_path)[0] + out_extension
+        else:
+            out_path += out_extension
+        units.append((in_path, out_path))
+    manifest = None
+    todo = units
+    if incremental and save:
+        fingerprint = step_fingerprint(
+            convert_cfiles_symbols, out_extension=out_extension,
+            symbol_map=file_hash(symbol_json_filename))
+        manifest = FileManifest(os.path.join(save_dir or data_dir,
+                                             manifest_name),
+                                fingerprint=fingerprint)
+        todo = [unit for unit in units if manifest.is_changed(unit[0])]
+    todo_paths = set([in_path for in_path, _ in todo])
+    results = run_units(_symbols_unit, [in_path for in_path, _ in todo],
+                        workers=workers, executor=executor,
+                        chunksize=chunksize,
+                        initializer=_init_symbols_worker,
+                        initargs=(symbol_json_filename,))
     c_texts = []
-    symbol_dict = json_to_dict(symbol_json_filename)
-    for root, dirnames, filenames in walk:
-        for filename in filenames:
-            if os.path.splitext(filename)[1] == in_extension:
-                in_path = os.path.join(root, filename)
-                if save_dir:
-                    if not os.path.exists(save_dir):
-                        os.mkdir(save_dir)
-                    out_path = os.path.join(save_dir, filename)
-                else:
-                    out_path = in_path
-                if len(in_extension) > 0:
-                    out_path = out_path.replace(in_extension,
-                                                out_extension)
-                else:
-                    out_path += out_extension
-                nosym = convert_cfile_symbols(in_path,
-                                              symbol_dict=symbol_dict)
-                c_texts.append(nosym)
-                if save:
-                    with open(out_path, 'w') as file:
-                        file.write(str(nosym))
-        return c_texts
+    try:
+        for in_path, out_path in units:
+            if in_path not in todo_paths:
+                # Unchanged since the last incremental run
+                with open(out_path, 'r') as file:
+                    c_texts.append(file.read())
+                continue
+            nosym = next(results)
+            c_texts.append(nosym)
+            if save:
+                out_dir = os.path.dirname(out_path)
+                if out_dir and not os.path.exists(out_dir):
+                    os.makedirs(out_dir)
+                with open(out_path, 'w') as file:
+                    file.write(str(nosym))
+            if manifest is not None:
+                manifest.update(in_path, outputs=[out_path])
+    finally:
+        results.close()
+    if manifest is not None:
+        manifest.remove_missing()
+        manifest.save()
+    return c_texts
 
 
 def convert_cfile_symbols(in_filename, symbol_dict=None,
-                          symbol_json_filename="C_SYMBOL_MAP.json"):
+                          symbol_json_filename="C_SYMBOL_MAP.json",
+                          translator=None):
     """
         This function converts all C operators into unique tokens which allows
         them to be viewed as tokens by the parser.
+
+        The symbols are replaced by a SymbolTranslator in a single pass,
+        always taking the longest symbol matching at each position. Pass a
+        translator to reuse one compiled translator across many files.
     """
-    if not symbol_dict or type(symbol_dict) is not dict:
-        symbol_dict = json_to_dict(symbol_json_filename)
+    if translator is None:
+        if symbol_dict and type(symbol_dict) is dict:
+            translator = SymbolTranslator(symbol_dict)
+        else:
+            translator = get_translator(symbol_json_filename)
 
     with open(in_filename, "r") as file:
-        c_text = str(file.read())
-
-    """
-    Replace the longest symbols first to avoid collision. Pad the replacement
-    strings to prevent token collision.
+        c_text = ''.join(translator.translate_stream(file))
 
-    Using solution from
-    https://stackoverflow.com/questions/11753809/sort-dictionary-by-key-length
-    """
-    for punc in sorted(symbol_dict, key=len, reverse=True):
-        c_text = c_text.replace(punc, pad_string(symbol_dict[punc], 1))
     c_text = c_text.replace("\n", " \n ")  # Pad the beginning and end of lines
     c_text = pad_string(c_text, 1)  # Pad the beginning and end of file
     return c_text
 
 
 def convert_symbols_to_cfile(in_filename, out_filename,
-                             symbol_json_filename="C_SYMBOL_MAP.json"):
+                             symbol_json_filename="C_SYMBOL_MAP.json",
+                             buffer_size=DEFAULT_BUFFER_SIZE):
     """
+        Invert convert_cfile_symbols, translating symbol tokens back into
+        C operators line by line.
     """
-    symbol_dict = json_to_dict(symbol_json_filename)
-
-    # flush the output file
-    with open(out_filename, "w") as out_file:
-        out_file.write("")
+    translator = get_inverse_translator(symbol_json_filename)
 
-    with open(in_filename, "r") as in_file:
-        for line in in_file:
-            for k, v in symbol_dict.items():
-                line = line.replace(v.strip(), k)
-            with open(out_filename, "a") as out_file:
-                out_file.write(line+'\n')
+    with open(in_filename, "r") as in_file, \
+            BufferedWriter(out_filename, buffer_size=buffer_size) as out_file:
+        for line in translator.translate_stream(in_file):
+            out_file.write(line.rstrip('\n') + '\n')
@@ -17,6 +17,26 @@ So they have been included here with slight renaming to avoid collision"""
 pycp_RE_CHILD_ARRAY = re.compile(r'(.*)\[(.*)\]')
 pycp_RE_INTERNAL_ATTR = re.compile('__.*__')
 
+# Child attributes which hold a list of nodes (the ** children of
+# pycparser's _c_ast.cfg). Node sequences store every child as a list of
+# edges, so this is needed to tell them from single children again.
+pycp_ARRAY_CHILDREN = {'Case': ('stmts',),
+                       'Compound': ('block_items',),
+                       'DeclList': ('decls',),
+                       'Default': ('stmts',),
+                       'EnumeratorList': ('enumerators',),
+                       'ExprList': ('exprs',),
+                       'FileAST': ('ext',),
+                       'FuncDef': ('param_decls',),
+                       'InitList': ('exprs',),
+                       'NamedInitializer': ('name',),
+                       'ParamList': ('params',),
+                       'Struct': ('decls',),
+                       'Union': ('decls',)}
+# Node attributes (not children) which hold lists
+pycp_LIST_ATTRS = set(['quals', 'align', 'storage', 'funcspec', 'dim_quals',
+                       'names'])
+
 
 class pycp_CJsonError(Exception):
     pass
@@ -91,13 +111,96 @@ def pycp_to_dict(node):
             result[child_name] = pycp_to_dict(child)
 
     # Any child attributes that were missing need "None" values in the json.
-    for child_attr in pycp_child_attrs_of(klass):
+    # (sorted, so that the key order does not depend on set ordering)
+    for child_attr in sorted(pycp_child_attrs_of(klass)):
         if child_attr not in result:
             result[child_attr] = None
 
     return result
 
 
+class CNode():
+    """
+        Compact, dict free representation of a pycparser node, built by
+        pycp_to_cnode.
+
+            nodetype - name of the node class, e.g. 'FuncDef'
+            fields   - field names, in the key order of pycp_to_dict
+                       (attributes, coord, children, missing children).
+                       Nodes with the same fields share one tuple.
+            values   - the value of each field: attribute values, the
+                       coordinate string, a CNode, a list of CNodes for
+                       array children, or None
+            size     - number of nodes in the subtree rooted here
+    """
+    __slots__ = ('nodetype', 'fields', 'values', 'size')
+
+    def __init__(self, nodetype, fields=(), values=()):
+        self.nodetype = nodetype
+        self.fields = fields
+        self.values = values
+        self.size = 1
+
+    def items(self):
+        return zip(self.fields, self.values)
+
+    def children(self):
+        """ The child CNodes, in order """
+        for value in self.values:
+            if isinstance(value, CNode):
+                yield value
+            elif isinstance(value, list):
+                for child in value:
+                    if isinstance(child, CNode):
+                        yield child
+
+
+def pycp_to_cnode(ast):
+    """
+        Convert a pycparser ast into a tree of CNodes, iteratively, holding
+        the same information as pycp_to_dict without a dict per node.
+    """
+    layouts = {}
+    root = CNode(ast.__class__.__name__)
+    order = [root]
+    stack = [(ast, root)]
+    while stack:
+        node, cnode = stack.pop()
+        klass = node.__class__
+        fields = list(klass.attr_names) + ['coord']
+        values = [getattr(node, attr) for attr in klass.attr_names]
+        values.append(str(node.coord) if node.coord else None)
+        arrays = {}
+        for child_name, child in node.children():
+            child_cnode = CNode(child.__class__.__name__)
+            order.append(child_cnode)
+            stack.append((child, child_cnode))
+            match = pycp_RE_CHILD_ARRAY.match(child_name)
+            if match:
+                array_name = match.group(1)
+                if array_name not in arrays:
+                    arrays[array_name] = []
+                    fields.append(array_name)
+                    values.append(arrays[array_name])
+                arrays[array_name].append(child_cnode)
+            else:
+                fields.append(child_name)
+                values.append(child_cnode)
+        present = set(fields)
+        for child_attr in sorted(pycp_child_attrs_of(klass)):
+            if child_attr not in present:
+                fields.append(child_attr)
+                values.append(None)
+        fields = tuple(fields)
+        cnode.fields = layouts.setdefault(fields, fields)
+        cnode.values = tuple(values)
+    # parents come before their children in order
+    for cnode in reversed(order):
+        for child in cnode.children():
+            cnode.size += child.size
+    return root
+
+
 def pycp_parse_coord(coord_str):
     """
     !!! FROM PYCPARSER !!!
@@ -146,4 +249,28 @@ def pycp_from_dict(node_dict):
 
     # Use keyword parameters, which works thanks to beautifully consistent
     # ast Node initializers.
-    return klass(**objs)
\ No newline at end of file
+    return klass(**objs)
+
+
+def pycp_complete_dict(node_dict):
+    """
+        Make the fields of a single node dict (not its children) match the
+        constructor of its node class, so that pycp_from_dict accepts it:
+        missing list attributes become [], other missing fields None, and
+        fields the class does not have are dropped. Raises
+        pycp_CJsonError for an unknown node type.
+    """
+    class_name = node_dict.get('_nodetype')
+    klass = getattr(c_ast, str(class_name), None)
+    if not (isinstance(klass, type) and issubclass(klass, c_ast.Node)):
+        raise pycp_CJsonError('Unknown node type %s' % class_name)
+    fields = set(klass.attr_names) | pycp_child_attrs_of(klass)
+    for key in list(node_dict.keys()):
+        if key != '_nodetype' and key not in fields:
+            del node_dict[key]
+    for attr in klass.attr_names:
+        if attr not in node_dict:
+            node_dict[attr] = [] if attr in pycp_LIST_ATTRS else None
+    for child_attr in fields:
+        node_dict.setdefault(child_attr, None)
+    return node_dict
@@ -6,39 +6,228 @@ Created on Mon Nov 13 04:14:26 2017
 @author: bbradt
 """
 import os
+import json
+import numpy as np
 
+from ganapg_ngram import NgramModel, ngram_exists, load_ngram
+from ganapg_cache import paths_fingerprint, code_fingerprint
+from ganapg_cache import params_fingerprint
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+from ganapg_walk import run_units, chunks, record_files
 
-from python_markov.markov.chain.markov_perf import markov_perf as markov
+MARKOV_META = 'markov.json'
 
 
 class Ganapg_Markov():
     """
-        Implement the python-markov library
-        which is a simple model, but which is not
+        Markov chain baseline over the tokens of the training file.
+
+        Tokens are encoded to integer ids, every line of the training file is
+        one sequence, and the chain is an NgramModel of order m, so many
+        prefixes can be continued (or scored) in one batched call.
+
+        If save is set, the built chain is saved to save_dir together with
+        its vocabulary and a fingerprint of the training file, and later
+        builds memory map the saved chain instead of rebuilding it as long
+        as the fingerprint matches.
     """
     def __init__(self, data_dir='.', in_filename='pos',
-                 save_dir=None, save=True):
-        file_contents = []
-        with open(os.path.join(data_dir, in_filename), "r") as in_file:
-            for line in in_file:
-                file_contents += line.split()
-        self.data = file_contents
-
-    def build(self):
-        self.chain = markov(self.data)
-
-    def predict(self, text, N, m=2):
-        prediction = ''
-        text=text.replace('\n', '')
-        text_slice = text.split()[-m:]
-        print(text_slice)
-        for i in range(N):
+                 save_dir=None, save=True, m=2):
+        self.in_filename = os.path.join(data_dir, in_filename)
+        self.save_dir = save_dir
+        self.save = save
+        self.m = m
+        self.vocab = {}
+        self.tokens = []
+        self.data = None
+        self.chain = None
+        self.saved = False
+
+    def load_data(self):
+        self.vocab = {}
+        self.tokens = []
+        self.data = []
+        # the shards of a sharded training file, in order
+        for in_filename in record_files(self.in_filename):
+            with open(in_filename, "r") as in_file:
+                for line in in_file:
+                    self.data.append(self.encode(line, grow=True))
+
+    def encode(self, text, grow=False):
+        """
+            Integer ids of the tokens of text. Unknown tokens are added to
+            the vocabulary if grow, and encoded as -1 otherwise.
+        """
+        ids = []
+        for token in text.split():
+            if token not in self.vocab:
+                if not grow:
+                    ids.append(-1)
+                    continue
+                self.vocab[token] = len(self.tokens)
+                self.tokens.append(token)
+            ids.append(self.vocab[token])
+        return np.array(ids, dtype=np.int64)
+
+    def decode(self, ids):
+        return ' '.join([self.tokens[i] for i in ids if i >= 0])
+
+    def fingerprint(self):
+        """ Fingerprint of the training file, order and model code """
+        data = paths_fingerprint(record_files(self.in_filename))
+        return params_fingerprint({'data': data,
+                                   'm': self.m,
+                                   'code': code_fingerprint(NgramModel)})
+
+    def build(self, force=False):
+        """
+            Build the chain, or load it from save_dir if it was saved from
+            the same training file. Returns True if the chain was rebuilt.
+        """
+        fingerprint = self.fingerprint()
+        if not force and self.load_model(fingerprint):
+            return False
+        if self.data is None:
+            self.load_data()
+        self.chain = NgramModel(self.m).build(self.data, len(self.tokens))
+        self.saved = False
+        if self.save and self.save_dir:
+            self.save_model(fingerprint)
+        return True
+
+    def save_model(self, fingerprint=None):
+        meta_filename = os.path.join(self.save_dir, MARKOV_META)
+        if os.path.exists(meta_filename):
+            os.remove(meta_filename)
+        self.chain.save(self.save_dir)
+        with BufferedWriter(meta_filename) as file:
+            json.dump({'fingerprint': fingerprint or self.fingerprint(),
+                       'in_filename': self.in_filename,
+                       'tokens': self.tokens}, file)
+        self.saved = True
+
+    def load_model(self, fingerprint=None, mmap_mode='r'):
+        """
+            Memory map the chain saved in save_dir. Returns False if there
+            is none, or if it was built from different training data.
+        """
+        if not self.save_dir:
+            return False
+        meta_filename = os.path.join(self.save_dir, MARKOV_META)
+        if not (os.path.exists(meta_filename) and
+                ngram_exists(self.save_dir)):
+            return False
+        with open(meta_filename, 'r') as file:
             try:
-                next_prediction = self.chain[tuple(text_slice)]
-                prediction += next_prediction + ' '
-                text_slice = text_slice[1:]
-                text_slice.append(next_prediction)
-            except KeyError:
-                text_slice = text_slice[1:]
-                continue
-        return(prediction)
+                meta = json.load(file)
+            except ValueError:
+                return False
+        if fingerprint is not None and meta['fingerprint'] != fingerprint:
+            return False
+        self.chain = load_ngram(self.save_dir, mmap_mode=mmap_mode)
+        self.m = self.chain.m
+        self.tokens = meta['tokens']
+        self.vocab = {token: i for i, token in enumerate(self.tokens)}
+        self.saved = True
+        return True
+
+    def _prefixes(self, texts, m):
+        prefixes = [self.encode(text) for text in texts]
+        if m is not None and m < self.m:
+            # hide the older context tokens, so the chain backs off to m
+            kept = [p[max(len(p) - m, 0):] if m else p[:0] for p in prefixes]
+            prefixes = [np.concatenate([np.full(self.m - len(p), -1,
+                                                dtype=np.int64), p])
+                        for p in kept]
+        return prefixes
+
+    def predict_batch(self, texts, N, m=None):
+        """ Continue every text of texts by N tokens, in one batch """
+        predictions = self.chain.predict(self._prefixes(texts, m), N)
+        return [self.decode(row) for row in predictions]
+
+    def predict(self, text, N, m=None):
+        return self.predict_batch([text], N, m=m)[0]
+
+    def evaluate_batch(self, texts, N):
+        """
+            Continue and score every text of texts. Returns a list of
+            (number of tokens, log likelihood, prediction) per text.
+        """
+        prefixes = self._prefixes(texts, None)
+        predictions = self.chain.predict(prefixes, N)
+        scores = self.chain.score(prefixes)
+        return [(len(prefix), score, self.decode(row))
+                for prefix, score, row in zip(prefixes, scores, predictions)]
+
+    def score(self, texts):
+        """ Log likelihood of every text of texts under the chain """
+        return self.chain.score([self.encode(text) for text in texts])
+
+
+_worker_markov = None
+
+
+def _init_markov_worker(save_dir):
+    """ Pool initializer, maps the saved chain once per worker process """
+    global _worker_markov
+    _worker_markov = Ganapg_Markov(save_dir=save_dir)
+    if not _worker_markov.load_model():
+        raise IOError('No markov chain saved in %s' % save_dir)
+
+
+def _evaluate_unit(unit):
+    """ Worker for evaluate_file, evaluates one chunk of lines """
+    lines, N = unit
+    return _worker_markov.evaluate_batch(lines, N)
+
+
+def _read_lines(in_filename):
+    """
+        The lines of in_filename, or of its shards in order. A blank last
+        line without a newline (the padding convert_cfile_symbols leaves at
+        the end of a file) is not a record, and is skipped.
+    """
+    for filename in record_files(in_filename):
+        with open(filename, 'r') as in_file:
+            for line in in_file:
+                if line.endswith('\n') or line.strip():
+                    yield line
+
+
+def evaluate_file(markov, in_filename, out_filename, N=100, workers=1,
+                  chunk_lines=1024, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+        Treat every line of in_filename (e.g. neg, or the shards of a
+        sharded neg, see ganapg_walk.record_files) as a separate program:
+        continue it by N tokens and score it under the chain. Writes one
+        tab separated row per line to out_filename,
+            line, number of tokens, log likelihood, prediction
+        where the log likelihood (natural log, see NgramModel.log_prob) is
+        that of the tokens of the line.
+        Lines are evaluated in chunks of chunk_lines, spread over workers
+        processes which each memory map the chain saved in markov.save_dir.
+        A chain which was not saved is evaluated in this process.
+        Returns the number of lines evaluated.
+    """
+    n_lines = 0
+    with BufferedWriter(out_filename, buffer_size=buffer_size) as out_file:
+        units = ((chunk, N) for chunk in chunks(_read_lines(in_filename),
+                                                 chunk_lines))
+        if workers > 1 and markov.saved:
+            results = run_units(_evaluate_unit, units, workers=workers,
+                                initializer=_init_markov_worker,
+                                initargs=(markov.save_dir,))
+        else:
+            results = (markov.evaluate_batch(lines, N) for lines, N in units)
+        try:
+            out_file.write('line\ttokens\tloglik\tprediction\n')
+            for rows in results:
+                for n_tokens, score, prediction in rows:
+                    out_file.write('%d\t%d\t%.6f\t%s\n' % (n_lines, n_tokens,
+                                                             score,
+                                                             prediction))
+                    n_lines += 1
+        finally:
+            results.close()
+    return n_lines
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dependency graph of pipeline steps, run with independent steps in parallel.
+
+Every step declares the paths it reads and writes, as a path or a
+(path, extensions) tuple (the form taken by ganapg_cache.tree_fingerprint).
+When a step is added to a StepGraph it depends on every earlier step it
+conflicts with: one which writes what it reads, reads what it writes, or
+writes what it writes. So the graph keeps the order in which steps were
+added wherever it matters, and steps which touch different files may run
+at the same time.
+
+Steps with the same key (e.g. the obfuscation of the codeflaws corpus,
+which is the same in every codeflaws config) are merged when added, so
+shared upstream steps run once for all the configs in a graph.
+
+    graph = StepGraph()
+    graph.add(Step('obfuscate', fn, inputs=[(data_dir, ['.c'])],
+                   outputs=[(data_dir, ['.obfs'])], key='obfuscate'))
+    ...
+    graph.run(workers=4)
+
+Steps run in threads, as they spend their time in child processes (the
+process pools of the preprocessing steps, gcc, the models). Pools made in
+these threads do not fork them, see ganapg_walk.make_pool.
+
+@author: bbradt
+"""
+
+import os
+import sys
+import queue
+import threading
+
+
+def _entry(entry):
+    """ (absolute path, set of extensions or None) of a path entry """
+    if isinstance(entry, tuple):
+        path, extensions = entry
+    else:
+        path, extensions = entry, None
+    if extensions is not None:
+        extensions = set(extensions)
+        if None in extensions:
+            # not known yet, so any file
+            extensions = None
+    return os.path.abspath(path), extensions
+
+
+def _extensions_overlap(a, b):
+    # '.seq.hash' files are also '.hash' files
+    return any([x.endswith(y) or y.endswith(x) for x in a for y in b])
+
+
+def _contains(outer, inner):
+    """ True if the path entry outer may cover files of inner """
+    outer_path, outer_exts = outer
+    inner_path, inner_exts = inner
+    if inner_path != outer_path and \
+            not inner_path.startswith(outer_path.rstrip(os.sep) + os.sep):
+        return False
+    if outer_exts is None:
+        return True
+    if inner_exts is not None:
+        return _extensions_overlap(outer_exts, inner_exts)
+    if inner_path == outer_path:
+        return True
+    # a file (or directory) below outer
+    extension = os.path.splitext(inner_path)[1]
+    return extension == '' or _extensions_overlap(outer_exts, [extension])
+
+
+def paths_overlap(paths_a, paths_b):
+    """ True if two lists of path entries may refer to the same files """
+    for a in paths_a:
+        for b in paths_b:
+            if _contains(a, b) or _contains(b, a):
+                return True
+    return False
+
+
+class Step():
+    """
+        A node of a StepGraph. fn() is called with no arguments once all
+        the steps it depends on have finished, and its return value is
+        kept in result.
+
+            name      - shown in progress messages
+            inputs    - path entries the step reads
+            outputs   - path entries the step writes
+            key       - identity of the work the step does; steps added
+                        with the key of a step already in the graph are
+                        merged into it (None never merges)
+            exclusive - run while no other step runs, for steps which
+                        change process wide state (tensorflow flags,
+                        sys.stdout)
+    """
+    def __init__(self, name, fn, inputs=(), outputs=(), key=None,
+                 exclusive=False):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.key = key
+        self.exclusive = exclusive
+        self.deps = []
+        self.result = None
+        self.done = False
+        self._inputs = [_entry(entry) for entry in self.inputs]
+        self._outputs = [_entry(entry) for entry in self.outputs]
+
+    def conflicts(self, other):
+        """ True if self and other can not run at the same time """
+        return (paths_overlap(self._outputs, other._inputs) or
+                paths_overlap(self._inputs, other._outputs) or
+                paths_overlap(self._outputs, other._outputs))
+
+
+class StepGraph():
+    """
+        Steps in the order they were added, with their dependencies.
+        A step only ever depends on steps added before it, so the graph
+        has no cycles and the order of addition is a valid serial order.
+    """
+    def __init__(self):
+        self.steps = []
+        self.keys = {}
+
+    def add(self, step, after=()):
+        """
+            Add step, depending on the steps in after and on every earlier
+            step it conflicts with. Returns the step in the graph, which is
+            an earlier step with the same key if there is one (that step
+            keeps its own dependencies).
+        """
+        if step.key is not None and step.key in self.keys:
+            return self.keys[step.key]
+        step.deps = list(after)
+        for other in self.steps:
+            if other not in step.deps and step.conflicts(other):
+                step.deps.append(other)
+        self.steps.append(step)
+        if step.key is not None:
+            self.keys[step.key] = step
+        return step
+
+    def __len__(self):
+        return len(self.steps)
+
+    def _ready(self, step):
+        return all([dep.done for dep in step.deps])
+
+    def run(self, workers=1, progress=print):
+        """
+            Run every step, up to workers of them at the same time. If a
+            step fails, no further steps are started, the running ones are
+            waited for and the error is raised again.
+        """
+        if workers <= 1:
+            for step in self.steps:
+                progress('Running %s' % step.name)
+                step.result = step.fn()
+                step.done = True
+            return
+        finished = queue.Queue()
+
+        def work(step):
+            try:
+                step.result = step.fn()
+                finished.put((step, None))
+            except BaseException:
+                finished.put((step, sys.exc_info()))
+
+        pending = list(self.steps)
+        running = []
+        error = None
+        while pending or running:
+            if error is None:
+                for step in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if any([s.exclusive for s in running]):
+                        break
+                    if not self._ready(step):
+                        continue
+                    if step.exclusive and running:
+                        # wait for the others rather than starve it
+                        break
+                    pending.remove(step)
+                    running.append(step)
+                    progress('Running %s' % step.name)
+                    thread = threading.Thread(target=work, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+            if not running:
+                break
+            step, exc_info = finished.get()
+            running.remove(step)
+            if exc_info is None:
+                step.done = True
+            elif error is None:
+                error = exc_info
+                progress('%s failed, waiting for %d running steps'
+                         % (step.name, len(running)))
+        if error is not None:
+            progress('%d steps were not run' % len(pending))
+            raise error[1].with_traceback(error[2])
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process driver for the bundled seq2seq library (unpacked from
+seq2seq.tar.gz into SEQ2SEQ_DIR).
+
+Training imports bin.train and calls its main function directly, with its
+tensorflow flags set from the pipeline config, instead of exporting
+environment variables for a shell script. Log records of the 'tensorflow'
+logger are forwarded to a progress callback.
+
+bin.train and bin.infer define some of the same flags, so they can not both
+be imported into one process. Inference therefore runs in the current
+process only if bin.train has not been imported there, and otherwise in a
+fresh child process (python ganapg_seq2seq.py '<json arguments>'), whose
+log output is still streamed back to the progress callback.
+
+@author: bbradt
+"""
+
+import os
+import sys
+import json
+import logging
+import importlib
+import subprocess as sp
+import ganapg_config as cfg
+from ganapg_util import BufferedWriter
+
+TRAIN_CONFIG = 'train_seq2seq.yml'
+MODEL_CONFIG = 'nmt_small.yml'
+OVERRIDES_CONFIG = 'ganapg_train.yml'
+INFER_TASKS = [{'class': 'DecodeText'}]
+
+
+def print_progress(message):
+    """
+        Default progress callback. Writes to stderr, as inference output
+        on stdout is captured into the predictions file.
+    """
+    sys.stderr.write('%s\n' % message)
+    sys.stderr.flush()
+
+
+class ProgressHandler(logging.Handler):
+    """ Forward log records to a progress callback """
+    def __init__(self, callback):
+        logging.Handler.__init__(self)
+        self.callback = callback
+
+    def emit(self, record):
+        try:
+            self.callback(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def _import_entry_point(name, seq2seq_dir=cfg.SEQ2SEQ_DIR):
+    """ Import bin.<name> from the seq2seq library """
+    seq2seq_dir = os.path.abspath(seq2seq_dir)
+    if seq2seq_dir not in sys.path:
+        sys.path.insert(0, seq2seq_dir)
+    return importlib.import_module('bin.%s' % name)
+
+
+def _set_flags(FLAGS, flags):
+    # Mark the flags as parsed without reading the pipeline's own argv
+    try:
+        FLAGS([sys.argv[0]])
+    except TypeError:
+        # tensorflow < 1.5, where tf.flags wraps argparse
+        FLAGS._parse_flags(args=[])
+    for key, value in flags.items():
+        setattr(FLAGS, key, value)
+
+
+def _run_main(module, flags, progress):
+    """
+        Call module.main with flags set, forwarding tensorflow logging to
+        progress instead of tensorflow's own stderr handler.
+    """
+    import tensorflow as tf
+    logger = logging.getLogger('tensorflow')
+    handlers = logger.handlers[:]
+    handler = ProgressHandler(progress)
+    for old_handler in handlers:
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    tf.logging.set_verbosity(tf.logging.INFO)
+    try:
+        _set_flags(module.FLAGS, flags)
+        module.main([sys.argv[0]])
+    finally:
+        logger.removeHandler(handler)
+        for old_handler in handlers:
+            logger.addHandler(old_handler)
+
+
+def _buckets_flag(buckets):
+    if not buckets:
+        return None
+    return ','.join([str(int(b)) for b in buckets])
+
+
+def train(vocab_source, vocab_target, train_sources, train_targets,
+          dev_sources, dev_targets, output_dir, train_steps, batch_size=32,
+          buckets=None, model_config=MODEL_CONFIG,
+          seq2seq_dir=cfg.SEQ2SEQ_DIR, progress=print_progress):
+    """
+        Train a seq2seq model in this process. Sources and targets are
+        lists of files of space separated tokens; buckets is a list of
+        sequence length boundaries (or None to disable bucketing).
+    """
+    train_module = _import_entry_point('train', seq2seq_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    config_dir = os.path.join(os.path.abspath(seq2seq_dir), 'example_configs')
+    # The config files are applied over the flags by bin.train, so the
+    # values taken from the pipeline config go in the last config file
+    # (json is valid yaml)
+    overrides = {'batch_size': batch_size,
+                 'train_steps': train_steps,
+                 'buckets': _buckets_flag(buckets)}
+    overrides_filename = os.path.join(output_dir, OVERRIDES_CONFIG)
+    with BufferedWriter(overrides_filename) as file:
+        json.dump(overrides, file)
+    config_paths = [os.path.join(config_dir, model_config),
+                    os.path.join(config_dir, TRAIN_CONFIG),
+                    overrides_filename]
+    flags = {'config_paths': ','.join(config_paths),
+             'model_params': {'vocab_source': vocab_source,
+                              'vocab_target': vocab_target},
+             'input_pipeline_train': {
+                 'class': 'ParallelTextInputPipeline',
+                 'params': {'source_files': list(train_sources),
+                            'target_files': list(train_targets)}},
+             'input_pipeline_dev': {
+                 'class': 'ParallelTextInputPipeline',
+                 'params': {'source_files': list(dev_sources),
+                            'target_files': list(dev_targets)}},
+             'output_dir': output_dir}
+    flags.update(overrides)
+    _run_main(train_module, flags, progress)
+    return output_dir
+
+
+def _infer(model_dir, sources, out_filename, batch_size=32, tasks=None,
+           seq2seq_dir=cfg.SEQ2SEQ_DIR, progress=print_progress):
+    infer_module = _import_entry_point('infer', seq2seq_dir)
+    flags = {'tasks': tasks or INFER_TASKS,
+             'input_pipeline': {'class': 'ParallelTextInputPipeline',
+                                'params': {'source_files': list(sources)}},
+             'model_dir': model_dir,
+             'batch_size': batch_size}
+    stdout = sys.stdout
+    # The inference tasks print their predictions, so stdout is captured
+    # into out_filename, except while reporting progress
+    with BufferedWriter(out_filename) as out_file:
+        def report(message):
+            sys.stdout = stdout
+            try:
+                progress(message)
+            finally:
+                sys.stdout = out_file
+        sys.stdout = out_file
+        try:
+            _run_main(infer_module, flags, report)
+        finally:
+            sys.stdout = stdout
+    return out_filename
+
+
+def infer(model_dir, sources, out_filename, batch_size=32, tasks=None,
+          seq2seq_dir=cfg.SEQ2SEQ_DIR, progress=print_progress):
+    """
+        Decode every line of the source files with the model trained in
+        model_dir, writing one prediction per line to out_filename.
+    """
+    if 'bin.train' not in sys.modules:
+        return _infer(model_dir, sources, out_filename,
+                      batch_size=batch_size, tasks=tasks,
+                      seq2seq_dir=seq2seq_dir, progress=progress)
+    args = {'model_dir': os.path.abspath(model_dir),
+            'sources': [os.path.abspath(s) for s in sources],
+            'out_filename': os.path.abspath(out_filename),
+            'batch_size': batch_size,
+            'tasks': tasks,
+            'seq2seq_dir': os.path.abspath(seq2seq_dir)}
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = sp.Popen([sys.executable, os.path.join(module_dir,
+                                                  'ganapg_seq2seq.py'),
+                     json.dumps(args)],
+                    cwd=module_dir, stderr=sp.PIPE, universal_newlines=True)
+    for line in proc.stderr:
+        progress(line.rstrip('\n'))
+    if proc.wait() != 0:
+        raise RuntimeError('seq2seq inference failed with exit code %d'
+                           % proc.returncode)
+    return out_filename
+
+
+if __name__ == '__main__':
+    _infer(**json.loads(sys.argv[1]))
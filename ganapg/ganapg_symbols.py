@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Symbol translation between C operators and the unique tokens defined in
+C_SYMBOL_MAP.json. The translator is compiled once from the symbol map and
+then rewrites text in a single left-to-right pass.
+
+@author: bbradt
+"""
+
+import re
+from ganapg_util import json_to_dict
+
+
+class SymbolTranslator():
+    """
+        Translate symbols in a text according to a symbol map, e.g.
+        {'->': ' @indmemsel@ ', '-': ' @minus@ '}.
+
+        All symbols are compiled into one regular expression with the longest
+        symbols first, so at each position of the text the longest matching
+        symbol is replaced. The text is scanned once, and replacement strings
+        are never rescanned, so the '-' inside ' @minus@ ' can not be
+        translated again, as happened with one str.replace per symbol.
+    """
+    def __init__(self, symbol_dict):
+        self.symbol_dict = dict(symbol_dict)
+        symbols = sorted(self.symbol_dict, key=len, reverse=True)
+        self.pattern = re.compile('|'.join([re.escape(s) for s in symbols]))
+
+    def _replace(self, match):
+        return self.symbol_dict[match.group(0)]
+
+    def translate(self, text):
+        """ Translate all symbols in text """
+        return self.pattern.sub(self._replace, text)
+
+    def translate_stream(self, fileobj):
+        """
+            Translate an open file (or any iterable of lines) lazily, one
+            line at a time. Symbols never span lines, so this gives the same
+            result as translating the whole text at once.
+        """
+        for line in fileobj:
+            yield self.translate(line)
+
+    def inverse(self):
+        """
+            Return a translator which maps the (stripped) tokens back to
+            their symbols, e.g. '@indmemsel@' to '->'.
+        """
+        return SymbolTranslator({v.strip(): k
+                                 for k, v in self.symbol_dict.items()})
+
+
+_translators = {}
+_inverse_translators = {}
+
+
+def get_translator(symbol_json_filename="C_SYMBOL_MAP.json"):
+    """
+        Return the translator for a symbol map file, compiling it only the
+        first time the file is requested.
+    """
+    if symbol_json_filename not in _translators:
+        symbol_dict = json_to_dict(symbol_json_filename)
+        _translators[symbol_json_filename] = SymbolTranslator(symbol_dict)
+    return _translators[symbol_json_filename]
+
+
+def get_inverse_translator(symbol_json_filename="C_SYMBOL_MAP.json"):
+    """ Return the cached inverse of get_translator(symbol_json_filename) """
+    if symbol_json_filename not in _inverse_translators:
+        translator = get_translator(symbol_json_filename)
+        _inverse_translators[symbol_json_filename] = translator.inverse()
+    return _inverse_translators[symbol_json_filename]
@@ -8,6 +8,7 @@ Created on Sun Nov 12 21:11:41 2017
 import sys
 import json
 import os
+import tempfile
 
 
 """ Python Versioning for Convenience """
@@ -49,20 +50,82 @@ def pad_string(string, pad_len):
     return string
 
 
-def walklevel(some_dir, level=1):
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+def _process_umask():
+    """
+        The umask of the process. os.umask can only read it by setting it,
+        so it is read once, at import, before any step threads start.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = _process_umask()
+
+
+class BufferedWriter():
     """
-        Modified walk function with restricted recursion
-        https://stackoverflow.com/questions/229186/
-                os-walk-without-digging-into-directories-below
+        Buffered output sink shared by the preprocessing functions which
+        write their results line by line. The output file is opened once,
+        writes go through a buffer of buffer_size bytes, and the data is
+        written to a temporary file in the same directory which is renamed
+        onto filename only when the writer is closed successfully. Readers
+        therefore never see a partially written file.
+
+        Use as a context manager:
+            with BufferedWriter(out_filename) as out_file:
+                for line in lines:
+                    out_file.write(line + '\n')
     """
-    some_dir = some_dir.rstrip(os.path.sep)
-    assert os.path.isdir(some_dir)
-    num_sep = some_dir.count(os.path.sep)
-    for root, dirs, files in os.walk(some_dir):
-        yield root, dirs, files
-        num_sep_this = root.count(os.path.sep)
-        if num_sep + level <= num_sep_this:
-            del dirs[:]
+    def __init__(self, filename, buffer_size=DEFAULT_BUFFER_SIZE,
+                 mode='w'):
+        self.filename = filename
+        out_dir = os.path.dirname(os.path.abspath(filename))
+        fd, self.tmp_filename = tempfile.mkstemp(
+                dir=out_dir, prefix='.%s.' % os.path.basename(filename),
+                suffix='.tmp')
+        self.file = os.fdopen(fd, mode, buffer_size)
+        self.closed = False
+
+    def write(self, data):
+        self.file.write(data)
+
+    def writelines(self, lines):
+        self.file.writelines(lines)
+
+    def close(self):
+        """ Flush the buffer and move the output into place """
+        if self.closed:
+            return
+        self.file.close()
+        # mkstemp creates files readable only by the owner
+        os.chmod(self.tmp_filename, 0o666 & ~UMASK)
+        if hasattr(os, 'replace'):
+            os.replace(self.tmp_filename, self.filename)
+        else:
+            os.rename(self.tmp_filename, self.filename)
+        self.closed = True
+
+    def discard(self):
+        """ Close without writing anything to filename """
+        if self.closed:
+            return
+        self.file.close()
+        os.remove(self.tmp_filename)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
 
 
 def query_yes_no(question, default="yes"):
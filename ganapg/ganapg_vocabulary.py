@@ -13,7 +13,13 @@ methods (e.g. seq2seq does not require vectorziation, but SeqGAN does)
 
 import os
 import re
+from collections import Counter
 from ganapg_util import pad_string as pad
+from ganapg_util import BufferedWriter, DEFAULT_BUFFER_SIZE
+from ganapg_corpus import CorpusWriter, remove_corpus
+from ganapg_walk import scan_files, scan_tree, is_shard
+
+UNK_TOKEN = 'UNK'
 
 
 def list_to_vocabfile(vocab_list, filename):
@@ -48,37 +54,90 @@ def vocabfile_to_hashdict(vocabfile):
 
 
 def hash_files(data_dir='.', vocab_hashdict=None, vocabfile=None, save=True,
-               out_filenames=None, save_dir=None):
-    for _, _, filenames in os.walk(data_dir):
-        for i, filename in enumerate(filenames):
-            out_filename = None
-            if out_filenames and i < len(out_filenames):
-                out_filename = out_filenames[i]
-            hash_file(filename, data_dir=data_dir,
-                      vocab_hashdict=vocab_hashdict,
-                      save=save, vocabfile=vocabfile,
-                      out_filename=out_filename,
-                      save_dir=save_dir)
+               out_filenames=None, save_dir=None, unk_token=None,
+               binary=False):
+    """
+        Hash every file below data_dir with hash_file, in sorted order;
+        out_filenames[i] (if given) names the output of the i-th file.
+        Returns the Counter of unknown tokens.
+    """
+    if (not vocab_hashdict or type(vocab_hashdict) is not dict) and vocabfile:
+        # Load the vocabulary once for all files
+        vocab_hashdict = vocabfile_to_hashdict(vocabfile)
+    unknown = Counter()
+    for i, path in enumerate(scan_files(data_dir)):
+        out_filename = None
+        if out_filenames and i < len(out_filenames):
+            out_filename = out_filenames[i]
+        # relative to data_dir, so files in subdirectories are found
+        hash_file(os.path.relpath(path, data_dir), data_dir=data_dir,
+                  vocab_hashdict=vocab_hashdict,
+                  save=save, vocabfile=vocabfile,
+                  out_filename=out_filename,
+                  save_dir=save_dir, unknown=unknown,
+                  unk_token=unk_token, binary=binary)
+    print('%d unknown tokens (%d unique)' % (sum(unknown.values()),
+                                            len(unknown)))
+    return unknown
+
+
+def vocab_index(vocab_hashdict):
+    """
+        Build the lookup index used by the hashing engine. Keys are cast to
+        stripped strings once, so that each input token can be resolved with
+        a single dictionary lookup instead of a scan over the vocabulary.
+    """
+    return {str(k).strip(): v for k, v in vocab_hashdict.items()}
+
+
+def hash_line(in_line, index, unknown=None, unk_hash=None):
+    """
+        Hash a single line token-wise using an index built by vocab_index.
+        Token order and repeated tokens are preserved. Tokens missing from
+        the index are counted in the unknown Counter (if given), and are
+        either dropped or replaced by unk_hash.
+    """
+    hashes = []
+    for token in in_line.split():
+        h = index.get(token)
+        if h is None:
+            if unknown is not None:
+                unknown[token] += 1
+            if unk_hash is None:
+                continue
+            h = unk_hash
+        hashes.append(h)
+    return hashes
 
 
 def hash_file(in_filename, data_dir='.', vocab_hashdict=None, save=True,
               vocabfile=None, out_filename=None, save_dir=None,
-              out_extension='.hash'):
+              out_extension='.hash', unknown=None, unk_token=None,
+              buffer_size=DEFAULT_BUFFER_SIZE, binary=False):
     """
         Use a given hashdict, or load a dict to hash a particular file
         token-wise, and line-by-line.
+
+        Each token is looked up once in a prebuilt index, so the cost is
+        linear in the size of the file. Tokens which are not in the
+        vocabulary are counted in unknown (a collections.Counter, if given)
+        and are dropped, unless unk_token names a vocabulary entry to
+        replace them with.
+
+        With binary=True the hashes are also written as a memory mappable
+        binary corpus (see ganapg_corpus) next to out_filename. Otherwise
+        a corpus left there by an earlier run is deleted.
     """
     in_filepath = os.path.join(data_dir, in_filename)
     if not out_filename:
         #  if no filename was entered, just modify the in_filename
-        in_extension = os.path.splitext(in_filename)[1]
         if save_dir:
-            if not os.path.exists(save_dir):
-                os.mkdir(save_dir)
             out_filename = os.path.join(save_dir, in_filename)
+            if not os.path.exists(os.path.dirname(out_filename)):
+                os.makedirs(os.path.dirname(out_filename))
         else:
             out_filename = in_filepath
-        out_filename = out_filename.replace(in_extension, out_extension)
+        out_filename = os.path.splitext(out_filename)[0] + out_extension
         print(out_filename)
 
     if not vocab_hashdict or type(vocab_hashdict) is not dict:
@@ -87,42 +146,83 @@ def hash_file(in_filename, data_dir='.', vocab_hashdict=None, save=True,
                                     you must enter a vocabulary or a file
                                     containing a vocabulary""")
         vocab_hashdict = vocabfile_to_hashdict(vocabfile)
+    index = vocab_index(vocab_hashdict)
+    unk_hash = index.get(unk_token) if unk_token is not None else None
+    if unknown is None:
+        unknown = Counter()
+    n_unknown = sum(unknown.values())
+
+    out_lines = []
+    out_file = None
+    corpus = None
     if save:
-        with open(out_filename, 'wb') as out_file:
-            # Flush the output
-            out_file.write(b'')
-    out_txt = ''
-    with open(in_filepath, 'r') as in_file:
-        for in_line in in_file:
-            """
-                The keys of the vocab_dict should be strings (but we cast just
-                to be sure), some of which occur in the input line. Thus,
-                we can use pythonic list comprehension to get token-wise
-                hashed string, with each hashed string separated by spaces.
-            """
-            out_line = " ".join([str(v) for k, v in vocab_hashdict.items()
-                                if str(k).strip() in in_line.split()])
-            out_line = out_line.replace('\n', '')  # to prevent double newlines
-            if save:
-                with open(out_filename, 'a') as out_file:
-                    out_file.write(' '.join(out_line.split()) + '\n')
-            out_txt += ' '.join(out_line.split()) + '\n'
+        out_file = BufferedWriter(out_filename, buffer_size=buffer_size)
+        if binary:
+            corpus = CorpusWriter(out_filename, buffer_size=buffer_size)
+        else:
+            # one from an earlier binary run would no longer match the text
+            remove_corpus(out_filename)
+    sinks = [sink for sink in (out_file, corpus) if sink is not None]
+    try:
+        with open(in_filepath, 'r') as in_file:
+            for in_line in in_file:
+                hashes = hash_line(in_line, index, unknown=unknown,
+                                   unk_hash=unk_hash)
+                out_line = ' '.join([str(h) for h in hashes]) + '\n'
+                out_lines.append(out_line)
+                if out_file is not None:
+                    out_file.write(out_line)
+                if corpus is not None:
+                    corpus.append(hashes)
+    except Exception:
+        for sink in sinks:
+            sink.discard()
+        raise
+    for sink in sinks:
+        sink.close()
+    out_txt = ''.join(out_lines)
+    n_unknown = sum(unknown.values()) - n_unknown
+    if n_unknown:
+        print('%s: %d unknown tokens' % (in_filename, n_unknown))
     return out_txt
 
 
+def hashdict_to_tokenlist(vocab_hashdict):
+    """
+        Invert a hashdict into a list indexed by hash, so that decoding a
+        hash is a single array lookup.
+    """
+    token_list = [None] * (max(vocab_hashdict.values()) + 1)
+    for k, v in vocab_hashdict.items():
+        token_list[v] = k
+    return token_list
+
+
+def unhash_line(in_line, token_list):
+    """
+        Decode one line of hashes using a list built by hashdict_to_tokenlist.
+        Anything which is not a known hash is passed through unchanged.
+    """
+    tokens = []
+    n = len(token_list)
+    for h in in_line.split():
+        token = None
+        if h.isdigit() and int(h) < n:
+            token = token_list[int(h)]
+        tokens.append(h if token is None else token)
+    return tokens
+
+
 def unhash_file(in_filename, vocab_hashdict=None,
-                vocab_filename=None, out_filename=None):
+                vocab_filename=None, out_filename=None,
+                buffer_size=DEFAULT_BUFFER_SIZE):
     """
-        Invert the hashing process from the hash_file function. We can
-        exploit the design of the hash_file to do this without rewriting.
+        Invert the hashing process from the hash_file function, streaming
+        the input line by line and decoding each hash by array lookup.
     """
     if not out_filename:
         #  if no filename was entered, just modify the in_filename
-        in_extension = os.path.split(in_filename)[1]
-        if len(in_extension) > 0:
-            out_filename = in_filename.replace(in_extension, '.unhash')
-        else:
-            out_filename += '.unhash'
+        out_filename = os.path.splitext(in_filename)[0] + '.unhash'
 
     if not vocab_hashdict or type(vocab_hashdict) is not dict:
         if not vocab_filename:
@@ -131,43 +231,137 @@ def unhash_file(in_filename, vocab_hashdict=None,
                                     or a file containing a vocabulary""")
         vocab_hashdict = vocabfile_to_hashdict(vocab_filename)
 
-    # We can just pass the inverse hash to the above function to invert
-    inverse_hash = {v: k for k, v in vocab_hashdict.items()}
-    hash_file(in_filename, vocab_hashdict=inverse_hash,
-              out_filename=out_filename)
+    token_list = hashdict_to_tokenlist(vocab_hashdict)
+    with open(in_filename, 'r') as in_file, \
+            BufferedWriter(out_filename, buffer_size=buffer_size) as out_file:
+        for in_line in in_file:
+            out_file.write(' '.join(unhash_line(in_line, token_list)) + '\n')
+
+
+def _vocab_filenames(data_dir, in_filenames=None, in_extension=None):
+    """
+        Names (relative to data_dir) of the files in data_dir, and of the
+        shards in its shard directories (e.g. pos/0000, see
+        ganapg_walk.record_files)
+    """
+    if type(in_filenames) is list:
+        return in_filenames
+    if type(in_filenames) is str:
+        return [in_filenames]
+    _, dirnames, filenames = next(scan_tree(data_dir, depth=0))
+    for dirname in dirnames:
+        shards = next(scan_tree(os.path.join(data_dir, dirname), depth=0))[2]
+        filenames += [os.path.join(dirname, f) for f in shards
+                      if is_shard(f)]
+    if in_extension:
+        filenames = [f for f in filenames
+                     if os.path.splitext(f)[1] == in_extension]
+    return filenames
+
+
+def count_vocab(data_dir, in_filenames=None, in_extension=None, counts=None):
+    """
+        First pass of the vocabulary builder: stream the training files line
+        by line and count the frequency of every token. Only the counts are
+        kept in memory, never the corpus itself.
+    """
+    if counts is None:
+        counts = Counter()
+    for in_filename in _vocab_filenames(data_dir, in_filenames,
+                                        in_extension):
+        with open(os.path.join(data_dir, in_filename)) as train:
+            for line in train:
+                counts.update(line.split())
+    return counts
+
+
+def prune_vocab(counts, min_count=1, max_size=None, base_vocab=(),
+                unk_token=UNK_TOKEN, reserve_unk=False):
+    """
+        Second pass of the vocabulary builder: turn token counts into an
+        ordered vocabulary.
+
+        Tokens are sorted by decreasing frequency, ties broken
+        alphabetically, so the result is deterministic. Tokens seen fewer
+        than min_count times are dropped, and the vocabulary is cut to at
+        most max_size entries. Words in base_vocab are always kept.
+        If tokens are dropped (or with reserve_unk), unk_token (unless None)
+        is put first in the vocabulary, so that they can be hashed to it;
+        it counts towards max_size. Otherwise no entry is added, and the
+        ids of the tokens stay the same. A ValueError is raised if max_size
+        can not hold the base words and unk_token.
+    """
+    base = set(base_vocab)
+    ranked = sorted(set(counts) | base,
+                    key=lambda word: (-counts.get(word, 0), word))
+    vocab = [word for word in ranked
+             if word in base or counts[word] >= min_count]
+    pruned = len(vocab) < len(ranked) or \
+        (max_size is not None and len(vocab) > max_size)
+    n_unk = 0
+    if unk_token and (pruned or reserve_unk):
+        n_unk = 1
+        base.discard(unk_token)
+        vocab = [word for word in vocab if word != unk_token]
+    if max_size is not None and len(vocab) + n_unk > max_size:
+        n_free = max_size - len(base) - n_unk
+        if n_free < 0:
+            raise ValueError('max_size %d can not hold the %d base words%s'
+                             % (max_size, len(base),
+                                ' and %s' % unk_token if n_unk else ''))
+        kept = []
+        for word in vocab:
+            if word in base:
+                kept.append(word)
+            elif n_free > 0:
+                kept.append(word)
+                n_free -= 1
+        vocab = kept
+    if n_unk:
+        vocab = [unk_token] + vocab
+    return vocab
 
 
 def generate_vocab(data_dir, in_filenames=None, in_extension=None,
-                   vocab_list=None, vocab_filename=None):
+                   vocab_list=None, vocab_filename=None, min_count=1,
+                   max_size=None, unk_token=UNK_TOKEN, counts=None,
+                   reserve_unk=False):
+    """
+        Build a vocabulary from the training files in data_dir, streaming
+        the files through count_vocab and ordering/pruning the counts with
+        prune_vocab. The words in vocab_list (or in the vocab_filename base
+        vocabulary) are always included.
+        Returns the list of unique tokens, most frequent first. Pass a
+        Counter as counts to also get the token frequencies.
+    """
     if not vocab_list or type(vocab_list) is not list:
         if not vocab_filename:
             vocab_list = []
         else:
             vocab_list = vocabfile_to_list(vocab_filename)
-    if type(in_filenames) is not list:
-        if type(in_filenames) is str:
-            in_filenames = [in_filenames]
-        else:
-            for _, _, filenames in os.walk(data_dir):
-                in_filenames = filenames
-                if in_extension:
-                    in_filenames = [f for f in filenames
-                                    if os.path.split(f)[1] is in_extension]
-
-    for in_filename in in_filenames:
-        with open(os.path.join(data_dir, in_filename)) as train:
-            vocab_list += [word for line in train for word in line.split()]
 
     # Remove whitespace, tabs, and newlines from tokens
-    vocab_list = [re.sub('\n\t', '', word.strip()) for word in vocab_list]
+    base_vocab = [re.sub('\n\t', '', word.strip()) for word in vocab_list]
+    base_vocab = [word for word in base_vocab if word]
 
-    # Only return unique tokens
-    return set(vocab_list)
+    counts = count_vocab(data_dir, in_filenames=in_filenames,
+                         in_extension=in_extension, counts=counts)
+    return prune_vocab(counts, min_count=min_count, max_size=max_size,
+                       base_vocab=base_vocab, unk_token=unk_token,
+                       reserve_unk=reserve_unk)
 
 
 def generate_vocab_to_file(data_dir, in_filenames=None, vocab_list=None,
                            in_extension=None, save_dir=None,
-                           vocab_filename=None, out_filename=None):
+                           vocab_filename=None, out_filename=None,
+                           min_count=1, max_size=None, unk_token=UNK_TOKEN,
+                           counts_filename=None, reserve_unk=False):
+    """
+        Generate a vocabulary (see generate_vocab) and write it one token
+        per line, most frequent first. If counts_filename is given, the
+        token frequencies are written there as tab separated token, count
+        lines in the same order.
+    """
     if not out_filename:
         out_filename = "vocab.txt"
     if save_dir:
@@ -176,10 +370,21 @@ def generate_vocab_to_file(data_dir, in_filenames=None, vocab_list=None,
         out_filename = os.path.join(save_dir, out_filename)
     if not os.path.exists(os.path.dirname(out_filename)):
         os.makedirs(os.path.dirname(out_filename))
+    counts = Counter()
     vocab_list = generate_vocab(data_dir, in_filenames=in_filenames,
+                                in_extension=in_extension,
                                 vocab_list=vocab_list,
-                                vocab_filename=vocab_filename)
+                                vocab_filename=vocab_filename,
+                                min_count=min_count, max_size=max_size,
+                                unk_token=unk_token, counts=counts,
+                                reserve_unk=reserve_unk)
+    print('Vocabulary of %d tokens (%d distinct in corpus)'
+          % (len(vocab_list), len(counts)))
 
-    with open(out_filename, "w") as file:
+    with BufferedWriter(out_filename) as file:
         for word in vocab_list:
             file.write(word + '\n')
+    if counts_filename:
+        with BufferedWriter(counts_filename) as file:
+            for word in vocab_list:
+                file.write('%s\t%d\n' % (word, counts.get(word, 0)))
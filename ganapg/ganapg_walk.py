@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Corpus scanning and work distribution shared by the preprocessing steps.
+
+scan_tree walks a directory once with os.scandir, in sorted order, and
+scan_files lists the files under it which match a set of extensions, down
+to a given depth. run_units maps a worker function over work units in
+order, serially or in a pool of threads or processes, so each step only
+has to say what one unit of work is:
+
+    paths = scan_files(data_dir, '.c')
+    for result in run_units(_unit, paths, workers=8, executor=PROCESS):
+        ...
+
+Hidden files and directories (manifests, and the temporary files of
+writes in progress) are skipped unless hidden=True.
+
+Line files of records (e.g. pos and neg) may be split into shards, kept in
+a directory named after the file: pos/0000, pos/0001, ... Steps which
+convert each file keep the layout (pos/0000.nosym, ...), and record_files
+finds the shards of a record file by the name it would have unsharded
+(e.g. pos.nosym).
+
+@author: bbradt
+"""
+
+import os
+import re
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+SERIAL = 'serial'
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTORS = [SERIAL, THREAD, PROCESS]
+SHARD_FORMAT = '%04d'
+SHARD_RE = re.compile(r'^\d{4,}$')
+
+
+def _listdir(path, hidden=False):
+    """ Sorted (dirnames, filenames) of a directory, from one scandir """
+    dirnames = []
+    filenames = []
+    for entry in os.scandir(path):
+        if not hidden and entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            dirnames.append(entry.name)
+        else:
+            filenames.append(entry.name)
+    dirnames.sort()
+    filenames.sort()
+    return dirnames, filenames
+
+
+def scan_tree(data_dir='.', depth=None, hidden=False):
+    """
+        Like os.walk (top down), with sorted names: yields
+            (root, dirnames, filenames)
+        for data_dir and the directories below it, at most depth levels
+        down (data_dir alone for depth=0, everything for None).
+    """
+    stack = [(data_dir, 0)]
+    while stack:
+        root, level = stack.pop()
+        dirnames, filenames = _listdir(root, hidden=hidden)
+        yield root, dirnames, filenames
+        if depth is None or level < depth:
+            stack.extend([(os.path.join(root, dirname), level + 1)
+                          for dirname in reversed(dirnames)])
+
+
+def _extension_set(extensions):
+    if extensions is None:
+        return None
+    if isinstance(extensions, str):
+        return set([extensions])
+    return set(extensions)
+
+
+def scan_files(data_dir='.', extensions=None, depth=None, hidden=False):
+    """
+        Paths of the files under data_dir whose extension (as given by
+        os.path.splitext, so '' for none) is in extensions, a string or a
+        list (all files if None), at most depth directories down. The paths
+        are sorted as by scan_tree, and include data_dir.
+    """
+    extensions = _extension_set(extensions)
+    paths = []
+    for root, _, filenames in scan_tree(data_dir, depth=depth,
+                                        hidden=hidden):
+        for filename in filenames:
+            if (extensions is None or
+                    os.path.splitext(filename)[1] in extensions):
+                paths.append(os.path.join(root, filename))
+    return paths
+
+
+def shard_filename(path, shard):
+    """ Name of shard number shard of the record file path """
+    return os.path.join(path, SHARD_FORMAT % shard)
+
+
+def is_shard(filename):
+    """ True if filename (a base name) is a shard, whatever its extension """
+    return SHARD_RE.match(filename.split('.', 1)[0]) is not None
+
+
+def record_files(path):
+    """
+        The files holding the records of path, in order: path itself if it
+        is a file, otherwise the shards in the directory named like path
+        without its extensions (pos/0000.nosym, ... for pos.nosym;
+        pos/0000, ... for pos). A missing path is returned as is.
+    """
+    if os.path.isfile(path):
+        return [path]
+    dirname, filename = os.path.split(path)
+    stem = filename.split('.', 1)[0]
+    extension = filename[len(stem):]
+    base = os.path.join(dirname, stem)
+    if not os.path.isdir(base):
+        return [path]
+    return [os.path.join(base, filename)
+            for filename in _listdir(base)[1]
+            if is_shard(filename) and
+            filename[len(filename.split('.', 1)[0]):] == extension]
+
+
+def chunks(iterable, size):
+    """ Lists of size consecutive items of iterable (the last may be short) """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _process_context():
+    """
+        The multiprocessing context for a process pool. Forking copies the
+        locks held by other threads, so pools made outside the main thread
+        (e.g. by steps run in parallel by ganapg_scheduler) start their
+        workers from a fork server instead.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return multiprocessing.get_context()
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def make_pool(workers, executor=PROCESS, initializer=None, initargs=()):
+    """
+        A pool of workers threads or processes, forked only from the main
+        thread (see _process_context)
+    """
+    if executor == THREAD:
+        return ThreadPool(workers, initializer=initializer,
+                          initargs=initargs)
+    if executor == PROCESS:
+        return _process_context().Pool(workers, initializer=initializer,
+                                       initargs=initargs)
+    raise ValueError('Unknown executor %s, expected one of %s'
+                     % (executor, ', '.join(EXECUTORS)))
+
+
+def run_units(fn, units, workers=1, executor=PROCESS, chunksize=1,
+              initializer=None, initargs=()):
+    """
+        Yield fn(unit) for every unit of units, in order. With workers > 1
+        (and an executor other than SERIAL) the units are spread over a
+        pool of threads or processes, chunksize at a time; otherwise they
+        run in this thread, after calling initializer(*initargs). units may
+        be a lazy iterable. The pool is shut down when the generator is
+        exhausted or closed, so close it when stopping early.
+    """
+    if workers <= 1 or executor == SERIAL:
+        if initializer is not None:
+            initializer(*initargs)
+        for unit in units:
+            yield fn(unit)
+        return
+    pool = make_pool(workers, executor=executor, initializer=initializer,
+                     initargs=initargs)
+    try:
+        for result in pool.imap(fn, units, chunksize=chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
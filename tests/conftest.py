@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+The ganapg modules import each other by their flat names (they are run
+from inside ganapg/), so the tests put that directory on the path.
+"""
+
+import os
+import sys
+
+GANAPG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'ganapg')
+sys.path.insert(0, os.path.abspath(GANAPG_DIR))
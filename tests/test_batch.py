@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the length bucketed batching of ganapg_batch.
+"""
+
+import os
+import numpy as np
+import pytest
+from ganapg_batch import BucketBatcher, auto_buckets, pad_batch
+from ganapg_batch import read_sequences, file_lengths, PAD_ID
+from ganapg_corpus import write_corpus, TOKENS_EXT, OFFSETS_EXT
+
+LENGTHS = [1, 2, 3, 50, 51, 52, 400, 2, 3, 401]
+
+
+def _seqs(lengths):
+    return [np.arange(n, dtype=np.int32) + 1 for n in lengths]
+
+
+def test_auto_buckets():
+    assert auto_buckets([]) == []
+    assert auto_buckets(LENGTHS, n_buckets=1) == []
+    boundaries = auto_buckets(LENGTHS, n_buckets=3)
+    assert boundaries == sorted(boundaries)
+    assert len(boundaries) == 2
+
+
+def test_pad_batch():
+    batch, lengths = pad_batch(_seqs([2, 4]), pad_id=0)
+    assert batch.tolist() == [[1, 2, 0, 0], [1, 2, 3, 4]]
+    assert lengths.tolist() == [2, 4]
+
+
+def test_default_pad_is_not_a_token():
+    batch, lengths = pad_batch([np.array([0, 3], dtype=np.int32),
+                                np.array([0], dtype=np.int32)])
+    assert batch.tolist() == [[0, 3], [0, PAD_ID]]
+    assert ((batch != PAD_ID).sum(axis=1) == lengths).all()
+
+
+def test_every_pair_once_in_its_bucket():
+    batcher = BucketBatcher(_seqs(LENGTHS), _seqs(LENGTHS),
+                            boundaries=[10, 100], batch_size=2, seed=0)
+    batches = batcher.index_batches()
+    assert sorted([i for index in batches for i in index]) == \
+        list(range(len(LENGTHS)))
+    for index in batches:
+        assert len(index) <= 2
+        assert len(set(batcher.buckets[index].tolist())) == 1
+
+
+def test_token_budget():
+    batcher = BucketBatcher(_seqs(LENGTHS), boundaries=[10, 100],
+                            max_tokens=110, shuffle=False)
+    for index in batcher.index_batches():
+        longest = max([LENGTHS[i] for i in index])
+        assert len(index) == 1 or longest * len(index) <= 110
+
+
+def test_batches_and_padding():
+    sources = _seqs(LENGTHS)
+    targets = _seqs([n + 1 for n in LENGTHS])
+    batcher = BucketBatcher(sources, targets, boundaries=[10, 100],
+                            batch_size=4, shuffle=False)
+    for src, src_len, tgt, tgt_len, index in batcher:
+        assert src.shape == (len(index), max(src_len))
+        assert tgt_len.tolist() == [LENGTHS[i] + 1 for i in index]
+    unbucketed = BucketBatcher(sources, boundaries=[], batch_size=4,
+                               shuffle=True, seed=1)
+    assert batcher.padding_ratio() < unbucketed.padding_ratio()
+
+
+def test_mismatched_pairs():
+    with pytest.raises(ValueError):
+        BucketBatcher(_seqs([1, 2]), _seqs([1]))
+
+
+def test_read_sequences(tmpdir):
+    text = tmpdir.join('pos.hash')
+    text.write('1 2 3\n4\n')
+    assert [s.tolist() for s in read_sequences(str(text))] == [[1, 2, 3],
+                                                               [4]]
+    vocab = tmpdir.join('vocab.txt')
+    vocab.write('UNK\nint\nmain\n')
+    tokens = tmpdir.join('pos')
+    tokens.write('int main\nint foo\n')
+    sequences = read_sequences(str(tokens), vocabfile=str(vocab))
+    assert len(sequences) == 2 and len(sequences[1]) == 2
+
+
+def test_stale_corpus_is_not_read(tmpdir):
+    text = tmpdir.join('pos.hash')
+    write_corpus(str(text), [[9, 9]])
+    text.write('1 2 3\n4\n')
+    stale = os.path.getmtime(str(text)) - 10
+    for ext in (TOKENS_EXT, OFFSETS_EXT):
+        os.utime(str(text) + ext, (stale, stale))
+    assert [s.tolist() for s in read_sequences(str(text))] == [[1, 2, 3],
+                                                               [4]]
+    assert file_lengths(str(text)).tolist() == [3, 1]
+    write_corpus(str(text), [[5, 6, 7, 8]])
+    assert [s.tolist() for s in read_sequences(str(text))] == [[5, 6, 7, 8]]
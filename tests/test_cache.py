@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the step and file fingerprints of ganapg_cache.
+"""
+
+import json
+import ganapg_cache as gcache
+import ganapg_symbols
+from ganapg_cache import StepCache, FileManifest
+from ganapg_cache import paths_fingerprint, code_fingerprint, step_fingerprint
+from ganapg_preprocess_tokens import convert_cfiles_symbols
+
+
+def _module_names(fn):
+    module = gcache.sys.modules[fn.__module__]
+    return [m.__name__ for m in gcache._project_modules(module)]
+
+
+def test_code_fingerprint_covers_imported_modules():
+    names = _module_names(convert_cfiles_symbols)
+    for name in ['ganapg_preprocess_tokens', 'ganapg_symbols',
+                 'ganapg_util', 'ganapg_walk']:
+        assert name in names
+    assert not [name for name in names if not name.startswith('ganapg')]
+
+
+def test_code_fingerprint_changes_with_helper(monkeypatch):
+    before = code_fingerprint(convert_cfiles_symbols)
+    source_file = gcache.inspect.getsourcefile
+    walk_file = source_file(gcache.sys.modules['ganapg_walk'])
+
+    def edited(module):
+        if module.__name__ == 'ganapg_walk':
+            return __file__
+        return source_file(module)
+    monkeypatch.setattr(gcache.inspect, 'getsourcefile', edited)
+    assert walk_file != __file__
+    assert code_fingerprint(convert_cfiles_symbols) != before
+
+
+def test_paths_fingerprint_ignores_none(tmpdir):
+    tmpdir.join('a.c').write('int a;')
+    assert paths_fingerprint([None]) == paths_fingerprint([])
+    assert (paths_fingerprint([str(tmpdir), None]) ==
+            paths_fingerprint([str(tmpdir)]))
+
+
+def test_step_cache(tmpdir):
+    data = tmpdir.join('in.txt')
+    data.write('x')
+    out = tmpdir.join('out.txt')
+    calls = []
+
+    def step(value):
+        calls.append(value)
+        out.write(str(value))
+    cache = StepCache(str(tmpdir.join('cache')))
+    args = ('key', step, [str(data)], [str(out)])
+    assert cache.call(*args, value=1) == (True, None)
+    assert cache.call(*args, value=1) == (False, None)
+    assert cache.call(*args, value=2) == (True, None)
+    data.write('xy')
+    assert cache.call(*args, value=2) == (True, None)
+    assert calls == [1, 2, 2]
+
+
+def test_manifest_skips_unchanged_files(tmpdir):
+    src = tmpdir.join('a.c')
+    src.write('int a;')
+    out = tmpdir.join('a.obfs')
+    out.write('int a;')
+    path = str(tmpdir.join('.manifest'))
+    manifest = FileManifest(path, fingerprint='one')
+    assert manifest.is_changed(str(src))
+    manifest.update(str(src), outputs=[str(out)])
+    manifest.save()
+    manifest = FileManifest(path, fingerprint='one')
+    assert not manifest.is_changed(str(src))
+    src.write('int b;')
+    assert manifest.is_changed(str(src))
+
+
+def test_manifest_fingerprint_change(tmpdir):
+    src = tmpdir.join('a.c')
+    src.write('int a;')
+    path = str(tmpdir.join('.manifest'))
+    manifest = FileManifest(path, fingerprint='one')
+    manifest.update(str(src), outputs=[])
+    manifest.save()
+    assert FileManifest(path, fingerprint='two').is_changed(str(src))
+    assert not FileManifest(path, fingerprint='one').is_changed(str(src))
+
+
+def test_manifest_keeps_shared_outputs(tmpdir):
+    src = tmpdir.join('a.c')
+    src.write('int a;')
+    out = tmpdir.join('a.json')
+    out.write('[]')
+    corpus = tmpdir.join('corpus')
+    corpus.write('')
+    path = str(tmpdir.join('.manifest'))
+    manifest = FileManifest(path)
+    manifest.update(str(src), outputs=[str(out)], shared=[str(corpus)])
+    manifest.save()
+    corpus.remove()
+    assert FileManifest(path).is_changed(str(src))
+    corpus.write('')
+    manifest = FileManifest(path)
+    assert manifest.remove_missing() == [str(src)]
+    assert not out.exists() and corpus.exists()
+
+def test_step_fingerprint_params():
+    one = step_fingerprint(convert_cfiles_symbols, symbol_map='a')
+    assert one == step_fingerprint(convert_cfiles_symbols, symbol_map='a')
+    assert one != step_fingerprint(convert_cfiles_symbols, symbol_map='b')
+
+
+def test_symbol_map_change_reconverts(tmpdir, monkeypatch):
+    data_dir = tmpdir.mkdir('data')
+    data_dir.join('a').write('a = b + c;')
+    symbol_map = tmpdir.join('map.json')
+    symbol_map.write(json.dumps({'+': ' PLUS '}))
+    args = dict(data_dir=str(data_dir), save=True,
+                save_dir=str(tmpdir.join('out')), incremental=True,
+                symbol_json_filename=str(symbol_map))
+    assert 'PLUS' in convert_cfiles_symbols(**args)[0]
+    # a new map of the same size, in a new process (translators are
+    # compiled once per process)
+    symbol_map.write(json.dumps({'+': ' ADDS '}))
+    monkeypatch.setattr(ganapg_symbols, '_translators', {})
+    assert 'ADDS' in convert_cfiles_symbols(**args)[0]
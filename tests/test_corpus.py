@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the binary hashed corpus format of ganapg_corpus.
+"""
+
+import os
+import numpy as np
+import pytest
+from ganapg_corpus import CorpusWriter, CorpusReader, corpus_exists
+from ganapg_corpus import write_corpus, text_to_corpus
+
+LINES = [[1, 2, 3], [], [7], [2 ** 31 - 1, 0]]
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('pos.hash'))
+    write_corpus(path, LINES)
+    assert corpus_exists(path)
+    corpus = CorpusReader(path)
+    assert len(corpus) == len(LINES)
+    assert [line.tolist() for line in corpus] == LINES
+    assert corpus[-1].tolist() == LINES[-1]
+    assert corpus.lengths().tolist() == [3, 0, 1, 2]
+    with pytest.raises(IndexError):
+        corpus[len(LINES)]
+
+
+def test_empty_corpus(tmpdir):
+    path = str(tmpdir.join('empty.hash'))
+    write_corpus(path, [])
+    corpus = CorpusReader(path)
+    assert len(corpus) == 0
+    assert list(corpus) == []
+
+
+def test_discard_writes_nothing(tmpdir):
+    path = str(tmpdir.join('pos.hash'))
+    with pytest.raises(RuntimeError):
+        with CorpusWriter(path) as corpus:
+            corpus.append([1, 2])
+            raise RuntimeError('interrupted')
+    assert not corpus_exists(path)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_text_to_corpus(tmpdir):
+    text = tmpdir.join('neg.hash')
+    text.write('4 5 6\n\n8\n')
+    path = text_to_corpus(str(text))
+    corpus = CorpusReader(path)
+    assert [line.tolist() for line in corpus] == [[4, 5, 6], [], [8]]
+    assert corpus[0].dtype == np.int32
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the n-gram model of ganapg_ngram.
+"""
+
+import numpy as np
+from ganapg_ngram import NgramModel, load_ngram, ngram_exists, TABLES
+
+SEQS = [[0, 1, 2, 3], [0, 1, 2, 4], [0, 1, 5], [2, 3]]
+
+
+def test_counts():
+    model = NgramModel(m=2).build(SEQS)
+    assert model.vocab_size == 6
+    # order 0 counts every token, order 1 every token after the first
+    assert model.context_counts[0].sum() == 13
+    assert model.context_counts[1].sum() == 9
+    assert model.context_counts[2].sum() == 5
+
+
+def test_ngrams_do_not_cross_lines():
+    model = NgramModel(m=1).build([[1], [2]])
+    # the only order 1 pairs would be (1, 2), across the line break
+    assert len(model.pair_keys[1]) == 0
+
+
+def test_next_tokens_and_backoff():
+    model = NgramModel(m=2).build(SEQS)
+    contexts = np.array([[0, 1],     # seen: 2 (twice) beats 5
+                         [1, 2],     # seen: 3 and 4 tie, smallest wins
+                         [5, 2],     # backs off to order 1: 2 -> 3
+                         [2, 3],     # nothing follows 3: order 0
+                         [-1, 9],    # unknown token: order 0
+                         [-1, -1]])
+    # at order 0, 0, 1 and 2 are seen 3 times each, and 0 is smallest
+    assert model.next_tokens(contexts).tolist() == [2, 3, 3, 0, 0, 0]
+
+
+def test_predict():
+    model = NgramModel(m=2).build(SEQS)
+    out = model.predict([[0], [0, 1, 2], []], N=3)
+    assert out.tolist() == [[1, 2, 3], [3, 0, 1], [0, 1, 2]]
+
+
+def test_save_load(tmpdir):
+    model = NgramModel(m=2).build(SEQS)
+    out_dir = str(tmpdir.join('model'))
+    assert not ngram_exists(out_dir)
+    model.save(out_dir)
+    assert ngram_exists(out_dir)
+    loaded = load_ngram(out_dir)
+    assert (loaded.m, loaded.vocab_size) == (model.m, model.vocab_size)
+    for name in TABLES:
+        for saved, table in zip(getattr(model, name), getattr(loaded, name)):
+            assert isinstance(table, np.memmap) or not len(table)
+            assert np.array_equal(saved, table)
+    prefixes = [[0], [2], [4, 4]]
+    assert np.array_equal(loaded.predict(prefixes, 5),
+                          model.predict(prefixes, 5))
+    assert np.allclose(loaded.score(SEQS), model.score(SEQS))
+
+
+def _all_outcomes(model, context):
+    # every token of the vocabulary, and one unknown token
+    tokens = list(range(model.vocab_size)) + [-1]
+    contexts = np.tile(np.array(context, dtype=np.int64), (len(tokens), 1))
+    return np.exp(model.log_prob(contexts, tokens))
+
+
+def test_log_prob_is_normalized():
+    model = NgramModel(m=2).build(SEQS)
+    for context in [[0, 1], [1, 2], [5, 2], [2, 3], [-1, 0], [-1, 9],
+                    [-1, -1]]:
+        probs = _all_outcomes(model, context)
+        assert np.all(probs > 0)
+        assert np.isclose(probs.sum(), 1.0)
+
+
+def test_log_prob_prefers_seen_ngrams():
+    model = NgramModel(m=2).build(SEQS)
+    probs = _all_outcomes(model, [0, 1])
+    # 2 followed 0 1 twice, 5 once, the others never
+    assert probs[2] > probs[5] > probs[3]
+    # which fall back on their unigram counts
+    assert probs[3] > probs[4]
+
+
+def test_score_sums_log_probs():
+    model = NgramModel(m=1).build(SEQS)
+    unigram = (np.array([3, 3, 3, 2, 1, 1]) + 1.0) / (13 + 6 + 1)
+    # first token: order 0 only; second: 0 was followed by 1 three times,
+    # by one distinct token
+    expected = (np.log(unigram[0]) +
+                np.log((3 + 1 * unigram[1]) / (3 + 1)))
+    assert np.isclose(model.score([[0, 1]])[0], expected)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the columnar node sequence corpus of ganapg_nodeseq.
+"""
+
+import pytest
+from ganapg_nodeseq import NodeSequenceWriter, NodeSequenceReader
+from ganapg_nodeseq import write_nodesequences
+
+SEQS = [[{'_nodetype': 'FileAST', '_children_ext': [1], 't_i': 0},
+         {'_nodetype': 'Decl', 'name': 'a', 'quals': [], 'storage': [],
+          'funcspec': None, 'bitsize': None, 't_i': 1}],
+        [],
+        [{'_nodetype': 'Constant', 'type': 'int', 'value': '1', 't_i': 5,
+          'big': 2 ** 70, 'flag': True, 'mixed': ['x', 3, None],
+          'nested': [[1, 2], {'k': 'v'}], 'unicode': u'é'},
+         {'t_i': 6}]]
+NAMES = ['a.c', 'empty.c', 'b.c']
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('seq.nseq'))
+    write_nodesequences(path, SEQS, names=NAMES)
+    corpus = NodeSequenceReader(path)
+    assert len(corpus) == 3
+    assert list(corpus) == SEQS
+    assert corpus[-1] == SEQS[-1]
+    assert corpus.names() == NAMES
+    assert corpus.name(1) == 'empty.c'
+    assert corpus.index('b.c') == 2
+    assert corpus.types(0) == ['FileAST', 'Decl']
+    assert corpus.types(2) == ['Constant', None]
+    with pytest.raises(IndexError):
+        corpus[3]
+
+
+def test_decoded_lists_are_copies(tmpdir):
+    path = str(tmpdir.join('seq.nseq'))
+    write_nodesequences(path, SEQS, names=NAMES)
+    corpus = NodeSequenceReader(path)
+    corpus[0][0]['_children_ext'].append(9)
+    assert corpus[0] == SEQS[0]
+
+
+def test_discard_writes_nothing(tmpdir):
+    path = tmpdir.join('seq.nseq')
+    with pytest.raises(RuntimeError):
+        with NodeSequenceWriter(str(path)) as corpus:
+            corpus.append(SEQS[0], name='a.c')
+            raise RuntimeError('interrupted')
+    assert not path.check()
+
+
+def test_not_a_corpus(tmpdir):
+    path = tmpdir.join('seq.nseq')
+    path.write('not a corpus at all')
+    with pytest.raises(ValueError):
+        NodeSequenceReader(str(path))
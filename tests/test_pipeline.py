@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+End to end tests of the preprocessing steps of ganapg_pipeline.
+"""
+
+import os
+import pytest
+from ganapg_pipeline import Pipeline
+from ganapg_walk import record_files
+
+
+def _codeflaws(tmpdir, n=2):
+    data_dir = tmpdir.mkdir('codeflaws')
+    for i in range(n):
+        subject = data_dir.mkdir('10%d-A-bug-1%d-2%d' % (i, i, i))
+        subject.join('10%d-A-1%d.c' % (i, i)).write(
+            'int main() { int a = %d; return a; }\n' % i)
+        subject.join('10%d-A-2%d.c' % (i, i)).write(
+            'int main() { int b = %d; return b + 1; }\n' % i)
+    return str(data_dir)
+
+
+def _lines(path):
+    lines = []
+    for filename in record_files(path):
+        with open(filename) as file:
+            lines += file.read().splitlines()
+    return lines
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_ast_posneg(tmpdir, monkeypatch, binary):
+    data_dir = _codeflaws(tmpdir)
+    monkeypatch.chdir(str(tmpdir))
+    pipeline = Pipeline(method='cf_ast_seqgan', data_dir=data_dir,
+                        skip=['vocabgen', 'vocabhash', 'seqgan'],
+                        cache=False)
+    pipeline.binary = binary
+    pipeline.run(step_workers=1)
+    posneg_dir = str(tmpdir.join('cf_ast_seqgan_posneg'))
+    pos = _lines(os.path.join(posneg_dir, 'pos'))
+    neg = _lines(os.path.join(posneg_dir, 'neg'))
+    assert len(pos) == len(neg) == 2
+    assert pos != neg
+    assert all([line.split() for line in pos + neg])
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the aligned pos/neg outputs of ganapg_preprocess_tokens and the
+steps which read them.
+"""
+
+import os
+from ganapg_preprocess_tokens import AlignedWriter, codeflaws_posneg
+from ganapg_preprocess_tokens import convert_cfiles_symbols, cgc_posneg
+from ganapg_vocabulary import generate_vocab
+from ganapg_walk import record_files
+
+SYMBOL_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'ganapg', 'C_SYMBOL_MAP.json')
+
+
+def _codeflaws(tmpdir, n=5):
+    data_dir = tmpdir.mkdir('codeflaws')
+    for i in range(n):
+        subject = data_dir.mkdir('10%d-A-bug-1%d-2%d' % (i, i, i))
+        subject.join('10%d-A-1%d.obfs' % (i, i)).write('int a = %d ;' % i)
+        subject.join('10%d-A-2%d.obfs' % (i, i)).write('int b = %d ;' % i)
+    # not a codeflaws subject
+    data_dir.mkdir('README')
+    return str(data_dir)
+
+
+def _lines(path):
+    lines = []
+    for filename in record_files(path):
+        with open(filename) as file:
+            lines += file.read().splitlines()
+    return lines
+
+
+def test_posneg_unsharded(tmpdir):
+    save_dir = str(tmpdir.join('posneg'))
+    pos, neg = codeflaws_posneg(data_dir=_codeflaws(tmpdir),
+                                save_dir=save_dir)
+    assert pos == ['int b = %d ;' % i for i in range(5)]
+    assert neg == ['int a = %d ;' % i for i in range(5)]
+    assert record_files(os.path.join(save_dir, 'pos')) == \
+        [os.path.join(save_dir, 'pos')]
+    assert _lines(os.path.join(save_dir, 'neg')) == neg
+
+
+def test_posneg_return_type(tmpdir):
+    assert codeflaws_posneg(data_dir=_codeflaws(tmpdir),
+                            save_dir=str(tmpdir.join('posneg')),
+                            return_data=False) == ([], [])
+
+
+def test_posneg_sharded(tmpdir):
+    data_dir = _codeflaws(tmpdir)
+    save_dir = str(tmpdir.join('posneg'))
+    pos, neg = codeflaws_posneg(data_dir=data_dir, save_dir=save_dir,
+                                shard_size=20)
+    pos_shards = record_files(os.path.join(save_dir, 'pos'))
+    neg_shards = record_files(os.path.join(save_dir, 'neg'))
+    assert len(pos_shards) == len(neg_shards) == 3
+    assert pos_shards[0] == os.path.join(save_dir, 'pos', '0000')
+    assert _lines(os.path.join(save_dir, 'pos')) == pos
+    assert _lines(os.path.join(save_dir, 'neg')) == neg
+    for pos_shard, neg_shard in zip(pos_shards, neg_shards):
+        assert len(_lines(pos_shard)) == len(_lines(neg_shard))
+
+
+def test_switch_sharding(tmpdir):
+    pos = str(tmpdir.join('pos'))
+    with AlignedWriter([pos], shard_size=1) as writer:
+        for i in range(3):
+            writer.write('line %d' % i)
+    assert len(record_files(pos)) == 3
+    with AlignedWriter([pos], shard_size=1) as writer:
+        writer.write('line 0')
+    assert len(record_files(pos)) == 1
+    with AlignedWriter([pos]) as writer:
+        writer.write('line 0')
+    assert os.path.isfile(pos)
+    with AlignedWriter([pos], shard_size=1) as writer:
+        writer.write('line 0')
+    assert os.path.isdir(pos)
+
+
+def test_sharded_outputs_reach_later_steps(tmpdir):
+    save_dir = str(tmpdir.join('posneg'))
+    codeflaws_posneg(data_dir=_codeflaws(tmpdir), save_dir=save_dir,
+                     shard_size=20)
+    symbols_dir = str(tmpdir.join('symbols'))
+    convert_cfiles_symbols(data_dir=save_dir, save_dir=symbols_dir,
+                           save=True, symbol_json_filename=SYMBOL_MAP)
+    shards = record_files(os.path.join(symbols_dir, 'pos.nosym'))
+    assert shards[0] == os.path.join(symbols_dir, 'pos', '0000.nosym')
+    assert len(shards) == 3
+    vocab = generate_vocab(symbols_dir)
+    assert 'int' in vocab and 'b' in vocab and 'a' in vocab
+
+
+def _cgc(tmpdir):
+    data_dir = tmpdir.mkdir('cgc')
+    challenge = data_dir.mkdir('CROMU_00001')
+    challenge.join('README.md').write('Overflow, see CWE-121 and CWE-122')
+    challenge.mkdir('src').join('service.c').write(
+        'int f(int n) {\n'
+        '#ifdef PATCHED\n'
+        '  if (n > 8) return 0;\n'
+        '#endif\n'
+        '  return n;\n'
+        '}\n')
+    data_dir.mkdir('KPRCA_00002').mkdir('src').join('main.c').write(
+        'int main() { return 0; }\n')
+    return str(data_dir)
+
+
+def test_cgc_posneg_matches_codeflaws_shape(tmpdir):
+    labels = []
+    save_dir = str(tmpdir.join('posneg'))
+    pos, neg = cgc_posneg(data_dir=_cgc(tmpdir), save_dir=save_dir,
+                          labels=labels)
+    assert len(pos) == len(neg) == len(labels) == 1
+    assert 'n > 8' in pos[0] and 'n > 8' not in neg[0]
+    assert labels == [['CWE-121', 'CWE-122']]
+    assert _lines(os.path.join(save_dir, 'labels.txt')) == \
+        ['CWE-121 CWE-122']
+    assert cgc_posneg(data_dir=_cgc(tmpdir.mkdir('again')),
+                      save=False, return_data=False) == ([], [])
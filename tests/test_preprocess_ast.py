@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for AST flattening and token encoding in ganapg_preprocess_ast.
+"""
+
+import os
+import pytest
+from pycparser import c_parser, c_generator
+from ganapg_pycp import pycp_to_dict, pycp_to_cnode
+from ganapg_preprocess_ast import ast_to_nodesequence, iter_cnode_sequence
+from ganapg_preprocess_ast import nodesequence_to_ast, nodesequence_to_ctext
+from ganapg_preprocess_ast import NodeTokenEncoder, cfile_to_nodesequence
+from ganapg_preprocess_ast import cfiles_to_nodesequences
+from ganapg_nodeseq import NodeSequenceReader
+
+C_TEXT = '''
+int add(int a, int b) { return a + b; }
+int main() { int x = add(1, 2); if (x > 2) { x = x * 2; } return x; }
+'''
+
+
+def _parse(c_text=C_TEXT):
+    return c_parser.CParser().parse(c_text)
+
+
+def _seq(c_text=C_TEXT):
+    return list(iter_cnode_sequence(pycp_to_cnode(_parse(c_text))))
+
+
+def test_cnode_sequence_matches_dict_path():
+    ast = _parse()
+    seq, last = ast_to_nodesequence(pycp_to_dict(ast))
+    assert _seq() == seq
+    assert last == len(seq) - 1
+    assert [node['t_i'] for node in seq] == list(range(len(seq)))
+
+
+def test_sequence_round_trip():
+    expected = c_generator.CGenerator().visit(_parse())
+    assert nodesequence_to_ctext(_seq()) == expected
+    assert (c_generator.CGenerator().visit(
+        _parse(nodesequence_to_ctext(_seq()))) == expected)
+    assert nodesequence_to_ast(_seq())['_nodetype'] == 'FileAST'
+
+
+def test_cfile_to_nodesequence(tmpdir):
+    c_file = tmpdir.join('a.c')
+    c_file.write(C_TEXT)
+    seq, last = cfile_to_nodesequence(str(c_file))
+    assert [node['_nodetype'] for node in seq] == \
+        [node['_nodetype'] for node in _seq()]
+    c_file.write('int main( {')
+    assert cfile_to_nodesequence(str(c_file)) == (None, False)
+
+
+def test_encoder_shared_vocabulary():
+    encoder = NodeTokenEncoder()
+    first = encoder.transform(_seq())
+    second = encoder.transform(_seq())
+    assert first.dtype.name == 'int32'
+    assert first.tolist() == second.tolist()
+    names = encoder.get_feature_names()
+    assert len(names) == len(set(names)) == max(first) + 1
+    assert not [name for name in names
+                if name.startswith('t_i=') or name.startswith('coord=')]
+
+
+def test_encoder_relative_children():
+    encoder = NodeTokenEncoder()
+    features = encoder.node_features({'_nodetype': 'Compound', 't_i': 7,
+                                      '_children_block_items': [8, 10]})
+    assert features == ['_nodetype=Compound', '_children_block_items0=+1',
+                        '_children_block_items1=+3']
+
+
+def test_encoder_frozen():
+    encoder = NodeTokenEncoder().fit([_seq('int a;')])
+    size = len(encoder.get_feature_names())
+    tokens = encoder.transform(_seq())
+    assert len(encoder.get_feature_names()) == size
+    assert encoder.n_unknown > 0
+    assert max(tokens) < size
+
+
+def test_encoder_hashed():
+    encoder = NodeTokenEncoder(n_features=64)
+    tokens = encoder.transform(_seq())
+    assert 0 <= min(tokens) and max(tokens) < 64
+    assert encoder.get_feature_names() == [str(i) for i in range(64)]
+    with pytest.raises(ValueError):
+        encoder.inverse_transform(tokens)
+
+
+def test_encoder_inverse_transform():
+    encoder = NodeTokenEncoder()
+    tokens = encoder.transform(_seq())
+    seq = encoder.inverse_transform(tokens)
+    assert (nodesequence_to_ctext(seq) ==
+            c_generator.CGenerator().visit(_parse()))
+
+
+def test_incremental_corpus_keeps_shared_file(tmpdir):
+    data_dir = tmpdir.mkdir('src')
+    data_dir.join('a.c').write(C_TEXT)
+    data_dir.join('b.c').write('int b() { return 2; }\n')
+    corpus_filename = str(tmpdir.join('seq.nseq'))
+
+    def run():
+        return cfiles_to_nodesequences(
+            data_dir=str(data_dir), save_dir=str(tmpdir), incremental=True,
+            json_files=False, corpus_filename=corpus_filename)
+
+    assert len(run()) == 2
+    assert len(NodeSequenceReader(corpus_filename)) == 2
+    data_dir.join('b.c').remove()
+    seqs = run()
+    assert os.path.exists(corpus_filename)
+    corpus = NodeSequenceReader(corpus_filename)
+    assert corpus.names() == [str(data_dir.join('a.c'))]
+    assert seqs == [corpus[0]]
+    # unchanged files are read back from the corpus, not parsed again
+    assert run() == seqs
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the step dependency graph of ganapg_scheduler.
+"""
+
+import os
+import threading
+import pytest
+from ganapg_scheduler import Step, StepGraph, paths_overlap, _entry
+from ganapg_walk import run_units, PROCESS
+
+
+def _overlap(a, b):
+    return paths_overlap([_entry(entry) for entry in a],
+                         [_entry(entry) for entry in b])
+
+
+def _step(name, inputs=(), outputs=(), **kwargs):
+    return Step(name, lambda: name, inputs=inputs, outputs=outputs, **kwargs)
+
+
+def test_paths_overlap():
+    assert _overlap(['data'], ['data'])
+    assert _overlap(['data'], [os.path.join('data', 'a.c')])
+    assert not _overlap(['data'], ['data2'])
+    assert _overlap([('data', ['.c'])], [os.path.join('data', 'sub')])
+    assert _overlap([('data', ['.c'])], [os.path.join('data', 'a.c')])
+    assert not _overlap([('data', ['.c'])], [os.path.join('data', 'a.h')])
+    assert not _overlap([('data', ['.c'])], [('data', ['.obfs'])])
+    # '.seq.hash' files are also '.hash' files
+    assert _overlap([('data', ['.hash'])], [('data', ['.seq.hash'])])
+    # extensions not known yet match any file
+    assert _overlap([('data', [None])], [('data', ['.c'])])
+
+
+def test_conflicts_keep_order():
+    graph = StepGraph()
+    obfuscate = graph.add(_step('obfuscate', inputs=[('data', ['.c'])],
+                                outputs=[('data', ['.obfs'])]))
+    symbols = graph.add(_step('symbols', inputs=[('data', ['.obfs'])],
+                              outputs=[('data', ['.nosym'])]))
+    other = graph.add(_step('other', inputs=['other'], outputs=['out']))
+    clean = graph.add(_step('clean', outputs=[('data', ['.c'])]))
+    assert obfuscate.deps == []
+    assert symbols.deps == [obfuscate]
+    assert other.deps == []
+    # writes what obfuscate reads
+    assert clean.deps == [obfuscate]
+
+
+def test_same_key_merges():
+    graph = StepGraph()
+    first = graph.add(_step('obfuscate', outputs=['data'], key='obfs'))
+    second = graph.add(_step('obfuscate again', outputs=['other'],
+                             key='obfs'))
+    unkeyed = graph.add(_step('unkeyed', outputs=['x']))
+    assert second is first
+    assert graph.add(_step('unkeyed', outputs=['x'])) is not unkeyed
+    assert len(graph) == 3
+    graph.run(workers=2, progress=lambda message: None)
+    assert first.result == 'obfuscate'
+
+
+def test_exclusive_runs_alone():
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def fn(name):
+        def run():
+            with lock:
+                running.append(name)
+                overlaps.append(list(running))
+            with lock:
+                running.remove(name)
+        return run
+
+    graph = StepGraph()
+    for i in range(4):
+        graph.add(Step('step%d' % i, fn('step%d' % i), outputs=['o%d' % i],
+                       exclusive=(i == 2)))
+    graph.run(workers=4, progress=lambda message: None)
+    assert all([step.done for step in graph.steps])
+    assert ['step2'] in overlaps
+    assert not [names for names in overlaps
+                if 'step2' in names and len(names) > 1]
+
+
+def test_failure_stops_later_steps():
+    def fail():
+        raise KeyError('failed')
+
+    graph = StepGraph()
+    graph.add(Step('fail', fail, outputs=['a']))
+    later = graph.add(_step('later', inputs=['a']))
+    with pytest.raises(KeyError):
+        graph.run(workers=2, progress=lambda message: None)
+    assert not later.done
+
+
+def test_process_pool_in_step():
+    def pooled():
+        return list(run_units(abs, [-1, -2, -3], workers=2,
+                              executor=PROCESS))
+
+    graph = StepGraph()
+    step = graph.add(Step('pooled', pooled, outputs=['a']))
+    graph.add(_step('other', outputs=['b']))
+    graph.run(workers=2, progress=lambda message: None)
+    assert step.result == [1, 2, 3]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the python comment stripper of ganapg_preprocess_tokens.
+"""
+
+from ganapg_preprocess_tokens import strip_c_text, obfuscate_cfile
+
+
+def test_block_and_line_comments():
+    text = 'int a; /* one\ntwo */ int b; // three\nint c;\n'
+    # the newlines of a block comment are kept, so line numbers hold
+    assert strip_c_text(text) == 'int a; \n  int b;  \nint c;\n'
+
+
+def test_includes():
+    text = '#include <stdio.h>\n  # include "a.h"\nint a;\n'
+    assert strip_c_text(text) == ' \n \nint a;\n'
+    assert strip_c_text(text, strip_includes=False) == text
+
+
+def test_string_literals():
+    text = 'char *s = "/* not */ // a comment";\n'
+    assert strip_c_text(text) == text
+    text = 'char *s = "say \\"//\\"";  // gone\n'
+    assert strip_c_text(text) == 'char *s = "say \\"//\\"";   \n'
+
+
+def test_char_literals():
+    text = "char q = '\"'; char b = '\\\\'; /* x */ char s = '/';\n"
+    assert strip_c_text(text) == ("char q = '\"'; char b = '\\\\';   "
+                                  "char s = '/';\n")
+
+
+def test_spliced_line_comment():
+    text = 'int a; // c \\\ncontinued\nint b;\n'
+    assert strip_c_text(text) == 'int a;  \n\nint b;\n'
+
+
+def test_spliced_string_literal():
+    text = 'char *s = "a\\\n// b"; /* c */\nint d;\n'
+    assert strip_c_text(text) == 'char *s = "a\\\n// b";  \nint d;\n'
+
+
+def test_spliced_code_and_include():
+    text = 'int b = 1 \\\n+ 2;\n#include \\\n<stdio.h>\nint c;\n'
+    assert strip_c_text(text) == 'int b = 1 \\\n+ 2;\n \n\nint c;\n'
+
+
+def test_obfuscate_python(tmpdir):
+    c_file = tmpdir.join('a.c')
+    c_file.write('#include <stdio.h>\n'
+                 'int main() { // entry\n'
+                 '\treturn 0; /* done */\n'
+                 '}\n')
+    text = obfuscate_cfile(str(c_file), None, method='python')
+    assert text == 'int main() {  return 0;  }'
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the atomic BufferedWriter of ganapg_util.
+"""
+
+import os
+import stat
+import pytest
+from ganapg_util import BufferedWriter, UMASK
+
+
+def test_close_moves_output_into_place(tmpdir):
+    path = str(tmpdir.join('out.txt'))
+    with BufferedWriter(path) as file:
+        file.write('a\n')
+        assert not os.path.exists(path)
+    assert open(path).read() == 'a\n'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~UMASK
+    assert os.listdir(str(tmpdir)) == ['out.txt']
+
+
+def test_close_leaves_umask(tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, 'umask', lambda mask: calls.append(mask))
+    with BufferedWriter(str(tmpdir.join('out.txt'))) as file:
+        file.write('a\n')
+    assert calls == []
+
+
+def test_discard(tmpdir):
+    with pytest.raises(RuntimeError):
+        with BufferedWriter(str(tmpdir.join('out.txt'))) as file:
+            file.write('a\n')
+            raise RuntimeError('interrupted')
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for vocabulary building and hashing in ganapg_vocabulary.
+"""
+
+from collections import Counter
+import pytest
+from ganapg_vocabulary import prune_vocab, vocab_index, hash_line
+from ganapg_vocabulary import UNK_TOKEN, hash_file
+from ganapg_corpus import corpus_exists, CorpusReader
+
+COUNTS = Counter({'a': 5, 'b': 3, 'c': 3, 'd': 1})
+
+
+def test_order_and_no_unk_without_pruning():
+    assert prune_vocab(COUNTS) == ['a', 'b', 'c', 'd']
+    assert prune_vocab(COUNTS, max_size=4) == ['a', 'b', 'c', 'd']
+    assert prune_vocab(COUNTS, reserve_unk=True) == \
+        [UNK_TOKEN, 'a', 'b', 'c', 'd']
+    assert prune_vocab(COUNTS, unk_token=None, reserve_unk=True) == \
+        ['a', 'b', 'c', 'd']
+
+
+def test_min_count():
+    assert prune_vocab(COUNTS, min_count=3) == [UNK_TOKEN, 'a', 'b', 'c']
+    assert prune_vocab(COUNTS, min_count=3, unk_token=None) == \
+        ['a', 'b', 'c']
+
+
+def test_max_size_counts_unk_and_base():
+    vocab = prune_vocab(COUNTS, max_size=3, base_vocab=['int'])
+    assert vocab == [UNK_TOKEN, 'a', 'int']
+    for max_size in range(2, 5):
+        vocab = prune_vocab(COUNTS, max_size=max_size, base_vocab=['int'])
+        assert len(vocab) <= max_size
+        assert vocab[0] == UNK_TOKEN and 'int' in vocab
+    assert prune_vocab(COUNTS, max_size=5, base_vocab=['int']) == \
+        ['a', 'b', 'c', 'd', 'int']
+
+
+def test_max_size_too_small():
+    with pytest.raises(ValueError):
+        prune_vocab(COUNTS, max_size=2, base_vocab=['int', 'char'])
+    assert prune_vocab(COUNTS, max_size=2, base_vocab=['int', 'char'],
+                       unk_token=None) == ['char', 'int']
+
+
+def test_unk_in_base_or_counts_once():
+    for reserve_unk in [True, False]:
+        vocab = prune_vocab(COUNTS + Counter({UNK_TOKEN: 9}),
+                            base_vocab=[UNK_TOKEN], reserve_unk=reserve_unk)
+        assert vocab.count(UNK_TOKEN) == 1 and vocab[0] == UNK_TOKEN
+
+
+def test_hash_unseen_tokens_to_unk():
+    index = vocab_index({word: i for i, word in
+                         enumerate(prune_vocab(COUNTS,
+                                               reserve_unk=True))})
+    unknown = Counter()
+    hashes = hash_line('a z b', index, unknown=unknown,
+                       unk_hash=index[UNK_TOKEN])
+    assert hashes == [index['a'], index[UNK_TOKEN], index['b']]
+    assert unknown == Counter({'z': 1})
+
+
+def test_text_only_hash_removes_old_corpus(tmpdir):
+    tmpdir.join('pos').write('a b\nc\n')
+    hashdict = {'a': 0, 'b': 1, 'c': 2}
+    out_filename = str(tmpdir.join('pos.hash'))
+    hash_file('pos', data_dir=str(tmpdir), vocab_hashdict=hashdict,
+              binary=True)
+    assert [line.tolist() for line in CorpusReader(out_filename)] == \
+        [[0, 1], [2]]
+    hash_file('pos', data_dir=str(tmpdir), vocab_hashdict=hashdict)
+    assert not corpus_exists(out_filename)
+    assert tmpdir.join('pos.hash').read() == '0 1\n2\n'